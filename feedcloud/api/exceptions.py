@@ -1,2 +1,10 @@
 class AuthorizationFailedError(Exception):
     pass
+
+
+class InvalidRequestError(Exception):
+    pass
+
+
+class ServiceBusyError(Exception):
+    pass
@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration of the `events` service, which serves the Server-Sent
+Events streams with the gevent worker class.
+
+Usage: gunicorn -c python:feedcloud.api.gunicorn_events feedcloud.api:app
+"""
+
+worker_class = "gevent"
+# A few more than SSE_MAX_CONNECTIONS, so the streams over the limit still get
+# their 503 response
+worker_connections = 1100
+
+
+def post_fork(server, worker):
+    # gevent patches the standard library, but psycopg2 waits for the database
+    # in C. Without this every query (e.g. loading the current user) and the
+    # setup of the LISTEN connection would block all the streams of the worker.
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
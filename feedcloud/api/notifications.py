@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from typing import Dict, Iterator, Set
+
+from feedcloud import constants, database, settings
+
+from . import exceptions
+
+logger = logging.getLogger("feedcloud.Notifications")
+
+
+class NotificationListener:
+    """
+    NotificationListener listens on a Postgres notification channel and fans out
+    the received events to the subscribers of each user.
+
+    A single dedicated connection is used per process, no matter how many clients
+    are subscribed. The listener is started lazily on the first subscription.
+
+    Each subscribed client holds a request thread of the server for as long as
+    it's connected, so at most `SSE_MAX_CONNECTIONS` clients can subscribe per
+    process.
+    """
+
+    def __init__(self, channel: str, *, poll_timeout: float = 5.0):
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+
+        self._subscribers: Dict[int, Set[queue.Queue]] = collections.defaultdict(set)
+        self._n_subscribers = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ready = threading.Event()
+
+    def subscribe(self, user_id: int) -> queue.Queue:
+        """
+        Return a queue which receives the events of the user. Raise
+        `ServiceBusyError` if too many clients are subscribed already.
+        """
+        events = queue.Queue(maxsize=settings.SSE_QUEUE_SIZE)
+        with self._lock:
+            if self._n_subscribers >= settings.SSE_MAX_CONNECTIONS:
+                raise exceptions.ServiceBusyError(
+                    "Too many event streams, try again later"
+                )
+
+            self._subscribers[user_id].add(events)
+            self._n_subscribers += 1
+            self._ensure_started()
+
+        return events
+
+    def unsubscribe(self, user_id: int, events: queue.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is None:
+                return
+
+            if events not in subscribers:
+                return
+
+            subscribers.discard(events)
+            self._n_subscribers -= 1
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """
+        Wait until the listener is connected and listening on the channel.
+        """
+        return self._ready.wait(timeout)
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(
+            target=self._run, name="notification-listener", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Notification listener failed. Reconnecting...")
+                self._ready.clear()
+                time.sleep(settings.SSE_RECONNECT_SECONDS)
+
+    def _listen(self) -> None:
+        connection = database.connect_unpooled()
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+
+            self._ready.set()
+            logger.info(f"Listening on channel '{self.channel}'")
+
+            while True:
+                readable, _, _ = select.select([connection], [], [], self.poll_timeout)
+                if not readable:
+                    continue
+
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    self._dispatch(notify.payload)
+        finally:
+            connection.close()
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+            user_id = event.pop("user_id")
+        except (ValueError, KeyError):
+            logger.warning(f"Ignoring invalid notification: {payload}")
+            return
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # The client is not keeping up. Dropping the event is fine since
+                # the client can always fetch the entries through the API.
+                logger.warning(f"Dropping notification for user {user_id}")
+
+
+listener = NotificationListener(constants.NEW_ENTRIES_CHANNEL)
+
+
+def stream_new_entry_events(user_id: int) -> "EventStream":
+    """
+    Return a stream of Server-Sent Events for the new entries of the given user.
+    The client is subscribed right away, so `ServiceBusyError` is raised before
+    the response is started.
+    """
+    return EventStream(user_id, listener.subscribe(user_id))
+
+
+class EventStream:
+    """
+    Iterable of Server-Sent Events lines. The subscription is released when the
+    response is closed, even if it was never iterated.
+
+    A comment line is sent as heartbeat when there are no events, so that
+    proxies don't close the connection and disconnected clients are detected.
+    """
+
+    def __init__(self, user_id: int, events: queue.Queue):
+        self.user_id = user_id
+        self.events = events
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            yield ": connected\n\n"
+
+            while True:
+                try:
+                    event = self.events.get(timeout=settings.SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                yield f"event: new-entries\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        listener.unsubscribe(self.user_id, self.events)
@@ -1,5 +1,11 @@
+import datetime
+import functools
+import operator
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Type
+
+import flask
 from marshmallow import Schema, fields
-from marshmallow.validate import OneOf
+from marshmallow.validate import OneOf, Range
 
 from feedcloud import database
 
@@ -11,6 +17,7 @@ class UserSchema(Schema):
 
 class AuthResponseSchema(Schema):
     token = fields.String(required=True)
+    refresh_token = fields.String()
 
 
 class MessageSchema(Schema):
@@ -24,30 +31,342 @@ class MinimalFeedSchema(Schema):
 class FeedSchema(Schema):
     id = fields.Integer(required=True)
     url = fields.String(required=True)
+    retention_max_age_days = fields.Integer(allow_none=True)
+    retention_max_entries = fields.Integer(allow_none=True)
+    retention_keep_unread = fields.Boolean(allow_none=True)
 
 
 class FeedListSchema(Schema):
     feeds = fields.Nested(FeedSchema, many=True)
 
 
+class FeedImportResultSchema(Schema):
+    added = fields.Integer(required=True)
+    existing = fields.Integer(required=True)
+
+
+class ForceRunSchema(Schema):
+    feed_id = fields.Integer(required=True)
+    status = fields.String(required=True)
+    requested_at = fields.DateTime(required=True)
+    last_run_at = fields.DateTime(allow_none=True)
+
+
+class FeedUpdateRunSchema(Schema):
+    timestamp = fields.DateTime()
+    status = fields.String()
+    failure_count = fields.Integer()
+    next_run_schedule = fields.DateTime()
+    n_downloaded = fields.Integer()
+    n_ignored = fields.Integer()
+
+
+class FeedDailyStatsSchema(Schema):
+    day = fields.Date()
+    n_success = fields.Integer()
+    n_failure = fields.Integer()
+    n_downloaded = fields.Integer()
+    n_ignored = fields.Integer()
+
+
+class FeedHealthSchema(Schema):
+    feed_id = fields.Integer()
+    last_run = fields.Nested(FeedUpdateRunSchema, allow_none=True)
+    days = fields.Nested(FeedDailyStatsSchema, many=True)
+
+
 class EntrySchema(Schema):
     id = fields.Integer()
     original_id = fields.String()
     title = fields.String()
-    summary = fields.String()
+    excerpt = fields.String()
     link = fields.String()
     published_at = fields.DateTime()
     feed_id = fields.Integer()
     status = fields.String()
 
 
+class EntryDetailSchema(EntrySchema):
+    summary = fields.String()
+
+
 class EntryListSchema(Schema):
     entries = fields.Nested(EntrySchema, many=True)
 
 
+class ArchivedEntrySchema(EntryDetailSchema):
+    saved_at = fields.DateTime()
+
+
+class ArchivedEntryListSchema(Schema):
+    entries = fields.Nested(ArchivedEntrySchema, many=True)
+    next_cursor = fields.String(allow_none=True)
+
+
+class RiverFeedSchema(Schema):
+    id = fields.Integer(required=True)
+    url = fields.String(required=True)
+    entries = fields.Nested(EntrySchema, many=True)
+
+
+class RiverSchema(Schema):
+    feeds = fields.Nested(RiverFeedSchema, many=True)
+
+
+class EntryRemovalSchema(Schema):
+    # `None` when all the entries of the feed are removed, with the feed
+    entry_id = fields.Integer(allow_none=True)
+    feed_id = fields.Integer(required=True)
+
+
+class EntryChangeListSchema(Schema):
+    entries = fields.Nested(EntrySchema, many=True)
+    removed = fields.Nested(EntryRemovalSchema, many=True)
+    cursor = fields.String(allow_none=True)
+    has_more = fields.Boolean(required=True)
+
+
+class EntrySearchResultSchema(EntrySchema):
+    rank = fields.Float()
+
+
+class EntrySearchResultListSchema(Schema):
+    entries = fields.Nested(EntrySearchResultSchema, many=True)
+    next_cursor = fields.String(allow_none=True)
+
+
 class EntryStatusChangeRequestSchema(Schema):
     status = fields.String(required=True, validate=OneOf(database.Entry.STATUS_LIST))
 
 
+class FeedRetentionRequestSchema(Schema):
+    """
+    Retention policy of a feed. A null value means the server default is used,
+    and 0 disables the limit.
+    """
+
+    max_age_days = fields.Integer(required=True, allow_none=True, validate=Range(min=0))
+    max_entries = fields.Integer(required=True, allow_none=True, validate=Range(min=0))
+    keep_unread = fields.Boolean(required=True, allow_none=True)
+
+
 class MarshmallowErrorSchema(Schema):
     errors = fields.Mapping(keys=fields.String(), values=fields.List(fields.String))
+
+
+def _isoformat(value: datetime.datetime) -> str:
+    return value.isoformat()
+
+
+class CompiledSerializer:
+    """
+    A fast, dump-only replacement for a flat marshmallow schema.
+
+    Marshmallow resolves every field through several layers of method calls,
+    which dominates the CPU time when dumping thousands of objects. This class
+    inspects the schema once and builds a list of (key, attribute, converter)
+    tuples. It produces exactly the same output as `schema.dump()` for the
+    supported field types. Other fields fall back to marshmallow.
+    """
+
+    def __init__(self, schema_class: Type[Schema], only: Sequence[str] = None):
+        schema = schema_class(only=only)
+        dump_fields = schema.dump_fields.items()
+
+        self._keys = [field.data_key or name for name, field in dump_fields]
+        self._converters = [self._compile(field) for _, field in dump_fields]
+        self._getter = operator.attrgetter(
+            *[field.attribute or name for name, field in dump_fields]
+        )
+        if len(self._keys) == 1:
+            # attrgetter() returns a single value instead of a tuple in this case
+            getter = self._getter
+            self._getter = lambda obj: (getter(obj),)
+
+    @staticmethod
+    def _compile(field: fields.Field) -> Callable[[Any], Any]:
+        if type(field) is fields.Integer and not field.as_string:
+            return int
+
+        if type(field) is fields.String:
+            return str
+
+        if type(field) is fields.DateTime and field.format in (None, "iso"):
+            return _isoformat
+
+        return lambda value: field._serialize(value, None, None)
+
+    def dump(self, obj: Any) -> dict:
+        values = self._getter(obj)
+        return {
+            key: None if value is None else convert(value)
+            for key, convert, value in zip(self._keys, self._converters, values)
+        }
+
+    def dump_many(self, objs: Iterable[Any]) -> List[dict]:
+        return [self.dump(obj) for obj in objs]
+
+
+_feed_serializer = CompiledSerializer(FeedSchema)
+_river_feed_serializer = CompiledSerializer(RiverFeedSchema, only=("id", "url"))
+_entry_removal_serializer = CompiledSerializer(EntryRemovalSchema)
+_entry_detail_serializer = CompiledSerializer(EntryDetailSchema)
+_entry_search_result_serializer = CompiledSerializer(EntrySearchResultSchema)
+_archived_entry_serializer = CompiledSerializer(ArchivedEntrySchema)
+
+ENTRY_FIELDS = frozenset(EntrySchema().dump_fields)
+ENTRY_DETAIL_FIELDS = frozenset(EntryDetailSchema().dump_fields)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_entry_serializer(
+    schema_class: Type[Schema], fields: Optional[Sequence[str]]
+) -> CompiledSerializer:
+    return CompiledSerializer(schema_class, only=fields)
+
+
+def get_entry_serializer(
+    fields: Optional[Sequence[str]] = None, *, detail: bool = False
+) -> CompiledSerializer:
+    """
+    Return a serializer for `EntrySchema` (or `EntryDetailSchema` if `detail` is
+    true), optionally limited to the given fields.
+    """
+    schema_class = EntryDetailSchema if detail else EntrySchema
+    return _get_entry_serializer(schema_class, tuple(fields) if fields else None)
+
+
+def dump_entry_detail(entry: Any) -> dict:
+    """
+    Same as `EntryDetailSchema().dump(entry)`, only faster.
+    """
+    return _entry_detail_serializer.dump(entry)
+
+
+def dump_archived_entry_list(
+    entries: Iterable[Any], *, next_cursor: Optional[str]
+) -> dict:
+    """
+    Same as `ArchivedEntryListSchema().dump(...)`, only faster.
+    """
+    return dict(
+        entries=_archived_entry_serializer.dump_many(entries),
+        next_cursor=next_cursor,
+    )
+
+
+def dump_feed_list(feeds: Iterable[Any]) -> dict:
+    """
+    Same as `FeedListSchema().dump(dict(feeds=feeds))`, only faster.
+    """
+    return dict(feeds=_feed_serializer.dump_many(feeds))
+
+
+def dump_river(feeds: Iterable[Any]) -> dict:
+    """
+    Same as `RiverSchema().dump(dict(feeds=feeds))`, only faster.
+    """
+    serializer = get_entry_serializer()
+    return dict(
+        feeds=[
+            dict(
+                _river_feed_serializer.dump(feed),
+                entries=serializer.dump_many(feed.entries),
+            )
+            for feed in feeds
+        ]
+    )
+
+
+def dump_entry_list(
+    entries: Iterable[Any], *, fields: Optional[Sequence[str]] = None
+) -> dict:
+    """
+    Same as `EntryListSchema().dump(dict(entries=entries))`, only faster.
+    """
+    serializer = get_entry_serializer(fields)
+    return dict(entries=serializer.dump_many(entries))
+
+
+def dump_entry_change_list(
+    entries: Iterable[Any],
+    *,
+    removed: Iterable[Any],
+    cursor: Optional[str],
+    has_more: bool,
+) -> dict:
+    """
+    Same as `EntryChangeListSchema().dump(...)`, only faster.
+    """
+    return dict(
+        entries=get_entry_serializer().dump_many(entries),
+        removed=_entry_removal_serializer.dump_many(removed),
+        cursor=cursor,
+        has_more=has_more,
+    )
+
+
+def dump_entry_search_result_list(
+    entries: Iterable[Any], *, next_cursor: Optional[str]
+) -> dict:
+    """
+    Same as `EntrySearchResultListSchema().dump(...)`, only faster.
+    """
+    return dict(
+        entries=_entry_search_result_serializer.dump_many(entries),
+        next_cursor=next_cursor,
+    )
+
+
+def stream_entry_list(
+    entries: Iterable[Any],
+    *,
+    fields: Optional[Sequence[str]] = None,
+    chunk_size: int = 100,
+) -> Iterator[str]:
+    """
+    Serialize entries incrementally as a JSON document with the same structure as
+    `EntryListSchema`, but with `EntryDetailSchema` for the entries. Entries are
+    written in chunks to avoid tiny writes.
+    """
+    yield '{"entries":['
+
+    separator = ""
+    for chunk in _chunked(_iter_entry_json(entries, fields), chunk_size):
+        yield separator + ",".join(chunk)
+        separator = ","
+
+    yield "]}\n"
+
+
+def stream_entry_ndjson(
+    entries: Iterable[Any],
+    *,
+    fields: Optional[Sequence[str]] = None,
+    chunk_size: int = 100,
+) -> Iterator[str]:
+    """
+    Serialize entries incrementally as newline-delimited JSON, one entry per line.
+    """
+    for chunk in _chunked(_iter_entry_json(entries, fields), chunk_size):
+        yield "\n".join(chunk) + "\n"
+
+
+def _iter_entry_json(
+    entries: Iterable[Any], fields: Optional[Sequence[str]]
+) -> Iterator[str]:
+    serializer = get_entry_serializer(fields, detail=True)
+    for entry in entries:
+        yield flask.json.dumps(serializer.dump(entry), separators=(",", ":"))
+
+
+def _chunked(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
@@ -1,9 +1,26 @@
-from typing import List, Optional
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import threading
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
 
+import sqlalchemy as sa
 import sqlalchemy.orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
 
-from feedcloud import database, helpers, ingest
-from feedcloud.database import Entry, Feed, User
+from feedcloud import database, helpers, ingest, metrics, settings
+from feedcloud.database import (
+    Article,
+    Entry,
+    EntryArchive,
+    EntryRemoval,
+    Feed,
+    FeedDailyStats,
+    FeedUpdateRun,
+    User,
+)
 
 from . import exceptions
 
@@ -11,31 +28,171 @@ from . import exceptions
 def find_user(
     username: str, session: sqlalchemy.orm.Session, raise_error_if_missing: bool = True
 ) -> Optional[User]:
-    user = session.query(User).filter(User.username == username).one_or_none()
+    user = (
+        session.query(User)
+        .filter(User.username == username, User.deleted_at.is_(None))
+        .one_or_none()
+    )
     if not user and raise_error_if_missing:
         raise exceptions.AuthorizationFailedError("User not found")
 
     return user
 
 
-def authenticate_user(username: str, password: str) -> bool:
+# The authenticated user of a request, as identified by the access token
+CurrentUser = collections.namedtuple("CurrentUser", "id username is_admin")
+
+_user_cache = helpers.TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
+
+
+def get_current_user(user_id: int) -> CurrentUser:
+    """
+    Return the user with the given ID, which is taken from the access token.
+
+    Users are cached, so most requests don't query the `user` table at all.
+    Changes made through this process invalidate the cache right away; changes
+    made elsewhere (e.g. through the CLI) are picked up when the entry expires.
+    """
+    user = _user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    with database.get_session() as session:
+        db_user = session.get(User, user_id)
+        if not db_user or db_user.deleted_at:
+            raise exceptions.AuthorizationFailedError("User not found")
+
+        user = _make_current_user(db_user)
+
+    _user_cache.set(user_id, user)
+    return user
+
+
+def invalidate_cached_user(user_id: Optional[int] = None) -> None:
+    """
+    Remove a user from the cache, or all the users if `user_id` is not given.
+    """
+    if user_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.invalidate(user_id)
+
+
+@sa.event.listens_for(User, "after_update")
+@sa.event.listens_for(User, "after_delete")
+def _on_user_changed(mapper: Any, connection: Any, target: User) -> None:
+    invalidate_cached_user(target.id)
+
+
+def _make_current_user(user: User) -> CurrentUser:
+    return CurrentUser(id=user.id, username=user.username, is_admin=user.is_admin)
+
+
+# Users who changed something recently, see `_get_read_session`
+_recent_writes = helpers.TTLCache(
+    settings.USER_CACHE_SIZE, settings.REPLICA_READ_YOUR_WRITES_SECONDS
+)
+
+
+def _get_read_session(user: CurrentUser) -> sqlalchemy.orm.Session:
+    """
+    Return a session for read-only queries of the user.
+
+    Reads go to the replica (if configured), unless the user has changed
+    something through this process in the last
+    `REPLICA_READ_YOUR_WRITES_SECONDS`. Those reads go to the primary, so users
+    always see their own changes even if the replica is lagging behind.
+    """
+    if _recent_writes.get(user.id):
+        return database.get_session()
+
+    return database.get_read_session()
+
+
+def _record_write(user: CurrentUser) -> None:
+    _recent_writes.set(user.id, True)
+
+
+def authenticate_user(username: str, password: str) -> Optional[CurrentUser]:
+    """
+    Check the credentials of a user. Return the user if they are valid,
+    otherwise `None`.
+
+    If the password hash was made with a different cost factor than
+    `settings.PASSWORD_HASH_ROUNDS`, it's replaced with a new hash.
+    """
     with database.get_session() as session:
         user = find_user(username, session, raise_error_if_missing=False)
         if not user:
-            return False
+            return None
+
+        current_user = _make_current_user(user)
+        password_hash = user.password_hash
+
+    # Don't hold a database connection while bcrypt is running
+    is_valid, new_password_hash = _run_password_check(password, password_hash)
+    if not is_valid:
+        return None
 
-        return helpers.check_password(password, user.password_hash)
+    if new_password_hash:
+        with database.get_session() as session:
+            session.query(User).filter(
+                User.id == current_user.id, User.password_hash == password_hash
+            ).update({User.password_hash: new_password_hash})
+            session.commit()
+
+    return current_user
+
+
+_password_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_CHECK_WORKERS, thread_name_prefix="password-check"
+)
+_password_check_slots = threading.BoundedSemaphore(
+    settings.PASSWORD_CHECK_WORKERS + settings.PASSWORD_CHECK_QUEUE_SIZE
+)
+
+
+def _run_password_check(password: str, password_hash: str) -> Tuple[bool, str]:
+    """
+    Run `_check_password` on the password executor, so that bcrypt can only use
+    a bounded number of threads. Raise `ServiceBusyError` if too many checks are
+    already pending.
+
+    The request thread waits for the result, so the number of pending checks is
+    also the number of request threads logins can take.
+    """
+    if not _password_check_slots.acquire(blocking=False):
+        raise exceptions.ServiceBusyError("Too many login attempts, try again later")
+
+    try:
+        future = _password_executor.submit(_check_password, password, password_hash)
+        return future.result()
+    finally:
+        _password_check_slots.release()
+
+
+def _check_password(password: str, password_hash: str) -> Tuple[bool, str]:
+    """
+    Return whether the password is valid, and its new hash if it needs to be
+    rehashed (or an empty string).
+    """
+    if not helpers.check_password(password, password_hash):
+        return False, ""
+
+    if helpers.password_needs_rehash(password_hash):
+        return True, helpers.hash_password(password)
+
+    return True, ""
 
 
 def create_new_user(
-    current_username: str, username: str, password: str, is_admin: bool = False
+    current_user: CurrentUser, username: str, password: str, is_admin: bool = False
 ) -> bool:
-    with database.get_session() as session:
-        user = find_user(current_username, session)
-        if not user.is_admin:
-            raise exceptions.AuthorizationFailedError("Only admins can add new users")
+    if not current_user.is_admin:
+        raise exceptions.AuthorizationFailedError("Only admins can add new users")
 
-        new_user = session.query(User).filter(User.username == username).one_or_none()
+    with database.get_session() as session:
+        new_user = find_user(username, session, raise_error_if_missing=False)
         if new_user:
             return False
 
@@ -49,13 +206,38 @@ def create_new_user(
         return True
 
 
-def register_feed(username: str, url: str) -> bool:
+def delete_user(current_user: CurrentUser, username: str) -> bool:
+    """
+    Mark a user and all of their feeds as deleted. They are hidden right away
+    and removed by the `delete_user` task in the background.
+    """
+    if not current_user.is_admin:
+        raise exceptions.AuthorizationFailedError("Only admins can delete users")
+
     with database.get_session() as session:
-        user = find_user(username, session)
+        user = find_user(username, session, raise_error_if_missing=False)
+        if not user:
+            return False
+
+        if user.id == current_user.id:
+            raise ValueError("Users can't delete themselves")
+
+        now = datetime.datetime.now()
+        user.deleted_at = now
+        session.query(Feed).filter(
+            Feed.user_id == user.id, Feed.deleted_at.is_(None)
+        ).update({Feed.deleted_at: now}, synchronize_session=False)
+        session.commit()
+
+        ingest.delete_user.send(user.id)
+        return True
 
+
+def register_feed(user: CurrentUser, url: str) -> bool:
+    with database.get_session() as session:
         feed = (
             session.query(Feed)
-            .filter(Feed.url == url, Feed.user_id == user.id)
+            .filter(Feed.url == url, Feed.user_id == user.id, Feed.deleted_at.is_(None))
             .one_or_none()
         )
 
@@ -65,94 +247,864 @@ def register_feed(username: str, url: str) -> bool:
         feed = Feed(url=url, user_id=user.id)
         session.add(feed)
         session.commit()
+        _record_write(user)
         return True
 
 
-def unregister_feed(username: str, feed_id: int) -> bool:
+def import_feeds(user: CurrentUser, urls: Sequence[str]) -> Tuple[int, int]:
+    """
+    Register many feeds at once, e.g. from an OPML file. Return the number of
+    added feeds and the number of feeds which were already registered.
+
+    All feeds are inserted with a single INSERT ... ON CONFLICT DO NOTHING. Their
+    first fetch is spread evenly over `FEED_IMPORT_SPREAD_SECONDS`, so the
+    scheduler doesn't enqueue all of them at once.
+    """
+    urls = list(dict.fromkeys(urls))
+    if len(urls) > settings.FEED_IMPORT_MAX_FEEDS:
+        raise ValueError(
+            f"Too many feeds, at most {settings.FEED_IMPORT_MAX_FEEDS} can be imported"
+        )
+
+    if not urls:
+        return 0, 0
+
+    now = datetime.datetime.now()
+    step = settings.FEED_IMPORT_SPREAD_SECONDS / len(urls)
+    values = [
+        dict(
+            url=url,
+            user_id=user.id,
+            first_fetch_at=now + datetime.timedelta(seconds=idx * step),
+        )
+        for idx, url in enumerate(urls)
+    ]
+    insert = (
+        postgresql.insert(Feed)
+        .values(values)
+        .on_conflict_do_nothing(
+            index_elements=[Feed.url, Feed.user_id],
+            index_where=Feed.deleted_at.is_(None),
+        )
+        .returning(Feed.id)
+    )
+
     with database.get_session() as session:
-        user = find_user(username, session)
+        n_added = len(session.execute(insert).all())
+        session.commit()
+
+    if n_added:
+        _record_write(user)
 
+    return n_added, len(urls) - n_added
+
+
+def unregister_feed(user: CurrentUser, feed_id: int) -> bool:
+    with database.get_session() as session:
         feed = (
             session.query(Feed)
-            .filter(Feed.id == feed_id, Feed.user_id == user.id)
+            .filter(
+                Feed.id == feed_id, Feed.user_id == user.id, Feed.deleted_at.is_(None)
+            )
             .one_or_none()
         )
 
         if not feed:
             return False
 
-        session.delete(feed)
+        # Deleting the entries can take a long time for big feeds, so it's done
+        # in the background. The feed is hidden from now on.
+        feed.deleted_at = datetime.datetime.now()
+        session.add(EntryRemoval(feed_id=feed.id, user_id=user.id))
         session.commit()
+        _record_write(user)
+
+        ingest.delete_feed.send(feed.id)
         return True
 
 
-def force_run_feed(username: str, feed_id: int) -> bool:
+def set_feed_retention(
+    user: CurrentUser,
+    feed_id: int,
+    *,
+    max_age_days: Optional[int],
+    max_entries: Optional[int],
+    keep_unread: Optional[bool],
+) -> bool:
+    """
+    Change the entry retention policy of a feed. `None` values mean the default
+    policy from the settings is used. The entries are purged in the background.
+    """
     with database.get_session() as session:
-        user = find_user(username, session)
-
-        feed = (
+        n_updated = (
             session.query(Feed)
-            .filter(Feed.id == feed_id, Feed.user_id == user.id)
-            .one_or_none()
+            .filter(
+                Feed.id == feed_id, Feed.user_id == user.id, Feed.deleted_at.is_(None)
+            )
+            .update(
+                {
+                    Feed.retention_max_age_days: max_age_days,
+                    Feed.retention_max_entries: max_entries,
+                    Feed.retention_keep_unread: keep_unread,
+                    Feed.version: Feed.version + 1,
+                },
+                synchronize_session=False,
+            )
         )
+        session.commit()
 
-        if not feed:
-            return False
+    if n_updated:
+        _record_write(user)
 
-        ingest.download_feed.send(feed.id)
-        return True
+    return n_updated != 0
 
 
-def get_feeds(username: str) -> List[Feed]:
-    with database.get_session() as session:
-        user = find_user(username, session)
-        if not user:
-            raise exceptions.AuthorizationFailedError("User not found")
+ForceRun = collections.namedtuple("ForceRun", "feed_id status requested_at last_run_at")
 
-        feeds = session.query(Feed).filter(Feed.user_id == user.id).all()
 
-        return feeds
+def force_run_feed(user: CurrentUser, feed_id: int) -> Optional[ForceRun]:
+    """
+    Queue a download of the feed, unless one was already queued in the last
+    `FEED_FORCE_RUN_COALESCE_SECONDS`. Return `None` if the feed is not found.
 
+    The status of the result is "queued" if a download was queued by this call,
+    "pending" if an earlier one is still queued or running, and "completed" if
+    an earlier one has finished within the window.
+    """
+    now = datetime.datetime.now()
+    window_start = now - datetime.timedelta(
+        seconds=settings.FEED_FORCE_RUN_COALESCE_SECONDS
+    )
+    feed_filter = sa.and_(
+        Feed.id == feed_id, Feed.user_id == user.id, Feed.deleted_at.is_(None)
+    )
 
-def get_entries(
-    username: str, *, feed_id: Optional[int] = None, entry_status: Optional[str] = None
-) -> List[Entry]:
-    if entry_status and entry_status not in database.Entry.STATUS_LIST:
-        raise ValueError(f"Invalid status: {entry_status}")
+    # The conditional update takes a row lock, so only one of several
+    # concurrent requests can queue the download.
+    update = (
+        sa.update(Feed)
+        .where(
+            feed_filter,
+            sa.or_(
+                Feed.force_run_requested_at.is_(None),
+                Feed.force_run_requested_at < window_start,
+            ),
+        )
+        .values(force_run_requested_at=now)
+        .returning(Feed.id, Feed.force_run_requested_at)
+        .execution_options(synchronize_session=False)
+    )
 
     with database.get_session() as session:
-        user = find_user(username, session)
+        feed = session.execute(update).first()
+        session.commit()
+
+        queued = feed is not None
+        if queued:
+            ingest.force_download_feed.send(feed.id)
+        else:
+            feed = session.execute(
+                sa.select(Feed.id, Feed.force_run_requested_at).where(feed_filter)
+            ).first()
+            if not feed:
+                return None
+
+        last_run_at = session.execute(
+            sa.select(FeedUpdateRun.timestamp)
+            .where(FeedUpdateRun.feed_id == feed.id)
+            .order_by(FeedUpdateRun.timestamp.desc())
+            .limit(1)
+        ).scalar()
+
+    if queued:
+        status = "queued"
+    elif last_run_at is not None and last_run_at >= feed.force_run_requested_at:
+        status = "completed"
+    else:
+        status = "pending"
+
+    return ForceRun(
+        feed_id=feed.id,
+        status=status,
+        requested_at=feed.force_run_requested_at,
+        last_run_at=last_run_at,
+    )
+
 
+def get_feeds(user: CurrentUser) -> List[Feed]:
+    with _get_read_session(user) as session:
+        feeds = (
+            session.query(Feed)
+            .filter(Feed.user_id == user.id, Feed.deleted_at.is_(None))
+            .all()
+        )
+
+        return feeds
+
+
+def export_feeds(user: CurrentUser) -> Iterator[Any]:
+    """
+    Return an iterator over the feeds of the user, ordered by their ID. Rows are
+    fetched in batches, like `export_entries`.
+
+    The database is only queried once the iteration starts.
+    """
+    with _get_read_session(user) as session:
         query = (
-            session.query(Entry)
-            .join(Feed, Entry.feed_id == Feed.id)
-            .filter(Feed.user_id == user.id)
-            .order_by(Entry.published_at.desc())
+            session.query(Feed.id, Feed.url)
+            .filter(Feed.user_id == user.id, Feed.deleted_at.is_(None))
+            .order_by(Feed.id)
+        )
+        yield from query.yield_per(settings.EXPORT_BATCH_SIZE)
+
+
+# Update history of a feed, as returned by `get_feed_health`
+FeedHealth = collections.namedtuple("FeedHealth", "feed_id last_run days")
+
+
+def get_feed_health(
+    user: CurrentUser, feed_id: int, *, days: Optional[int] = None
+) -> Optional[FeedHealth]:
+    """
+    Return the last update run of a feed and the daily totals of its runs for
+    the last `days` days, newest first. Return `None` if the feed is not found.
+
+    Older days come from the rolled-up `FeedDailyStats`, recent days from the
+    update runs which are not rolled up yet.
+    """
+    if not days or days < 0:
+        days = settings.FEED_HEALTH_DAYS
+    days = min(days, settings.FEED_HEALTH_MAX_DAYS)
+    since = datetime.date.today() - datetime.timedelta(days=days - 1)
+
+    with _get_read_session(user) as session:
+        feed = (
+            session.query(Feed.id)
+            .filter(
+                Feed.id == feed_id, Feed.user_id == user.id, Feed.deleted_at.is_(None)
+            )
+            .one_or_none()
+        )
+        if not feed:
+            return None
+
+        last_run = (
+            session.query(FeedUpdateRun)
+            .filter(FeedUpdateRun.feed_id == feed_id)
+            .order_by(FeedUpdateRun.timestamp.desc())
+            .first()
+        )
+
+        stats = (
+            session.query(FeedDailyStats)
+            .filter(FeedDailyStats.feed_id == feed_id, FeedDailyStats.day >= since)
+            .all()
+        )
+
+        run_day = sa.cast(FeedUpdateRun.timestamp, sa.Date)
+        recent_runs = (
+            session.query(
+                run_day.label("day"),
+                sa.func.count()
+                .filter(FeedUpdateRun.status == FeedUpdateRun.SUCCESS)
+                .label("n_success"),
+                sa.func.count()
+                .filter(FeedUpdateRun.status == FeedUpdateRun.FAILED)
+                .label("n_failure"),
+                sa.func.sum(FeedUpdateRun.n_downloaded).label("n_downloaded"),
+                sa.func.sum(FeedUpdateRun.n_ignored).label("n_ignored"),
+            )
+            .filter(FeedUpdateRun.feed_id == feed_id, run_day >= since)
+            .group_by(run_day)
+            .all()
+        )
+
+        totals = {}
+        for row in itertools.chain(stats, recent_runs):
+            day = totals.setdefault(
+                row.day,
+                dict(day=row.day, n_success=0, n_failure=0, n_downloaded=0, n_ignored=0),
+            )
+            for key in ("n_success", "n_failure", "n_downloaded", "n_ignored"):
+                day[key] += getattr(row, key)
+
+        return FeedHealth(
+            feed_id=feed.id,
+            last_run=last_run,
+            days=sorted(totals.values(), key=lambda d: d["day"], reverse=True),
+        )
+
+
+def get_data_version(user: CurrentUser, *, feed_id: Optional[int] = None) -> str:
+    """
+    Return a cheap version token for the user's feeds and entries.
+
+    The token changes whenever a feed is added or removed, new entries are
+    ingested or an entry's status is changed. Ingestion and status changes both
+    store their transaction ID in `Entry.change_txid`, so looking at the latest
+    one of each feed is enough. A transaction with a lower ID can still commit
+    after it, so the latest one below `database.committed_txid_limit` is part of
+    the token as well. The other changes (feed settings, purged and archived
+    entries) bump `Feed.version`, which only increases.
+
+    This only touches the feed table and the tail of the (feed_id, change_txid)
+    index; no entry rows are read.
+    """
+    with _get_read_session(user) as session:
+
+        def get_last_change(*conditions):
+            return (
+                sa.select(Entry.change_txid)
+                .where(Entry.feed_id == Feed.id, *conditions)
+                .order_by(Entry.change_txid.desc())
+                .limit(1)
+                .correlate(Feed)
+                .scalar_subquery()
+            )
+
+        last_change = get_last_change()
+        last_committed = get_last_change(
+            Entry.change_txid < database.committed_txid_limit()
         )
 
+        query = session.query(
+            sa.func.count(Feed.id),
+            sa.func.coalesce(sa.func.sum(Feed.id), 0),
+            sa.func.coalesce(sa.func.sum(Feed.version), 0),
+            sa.func.coalesce(sa.func.max(last_change), 0),
+            sa.func.coalesce(sa.func.max(last_committed), 0),
+        ).filter(Feed.user_id == user.id, Feed.deleted_at.is_(None))
+
         if feed_id:
             query = query.filter(Feed.id == feed_id)
 
-        if entry_status:
-            query = query.filter(Entry.status == entry_status)
+        return "-".join(str(value) for value in query.one())
+
 
+# Columns of `Entry` and its `Article` which are exposed through the API
+ENTRY_COLUMNS = {
+    column.key: column
+    for column in (
+        Entry.id,
+        Entry.original_id,
+        Article.title,
+        Article.summary,
+        Article.excerpt,
+        Article.link,
+        Entry.published_at,
+        Entry.feed_id,
+        Entry.status,
+    )
+}
+
+# The list endpoints return the excerpt instead of the full summary, which can
+# be very large. The summary is only returned for a single entry and in exports.
+ENTRY_LIST_FIELDS = tuple(field for field in ENTRY_COLUMNS if field != "summary")
+
+
+def get_entries(
+    user: CurrentUser,
+    *,
+    feed_id: Optional[int] = None,
+    entry_status: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> List[Any]:
+    """
+    Return the entries of the user, newest first.
+
+    `since` (inclusive) and `until` (exclusive) limit the entries by their
+    publish date. Only the columns named in `fields` (`ENTRY_LIST_FIELDS` by
+    default) are loaded. The result is a list of rows, not ORM objects.
+    """
+    _validate_entry_status(entry_status)
+    columns = _select_entry_columns(fields or ENTRY_LIST_FIELDS)
+
+    with _get_read_session(user) as session:
+        query = _query_entries(
+            session,
+            user,
+            feed_id=feed_id,
+            entry_status=entry_status,
+            since=since,
+            until=until,
+            columns=columns,
+        )
         return query.all()
 
 
-def change_entry_status(username: str, entry_id: int, new_status: str) -> bool:
-    with database.get_session() as session:
-        user = find_user(username, session)
+# A feed with its newest entries, as returned by `get_river`
+RiverFeed = collections.namedtuple("RiverFeed", "id url entries")
+
+
+def get_river(user: CurrentUser, *, per_feed: Optional[int] = None) -> List[RiverFeed]:
+    """
+    Return the newest `per_feed` entries of each feed of the user.
+
+    All entries are fetched in a single query with a window function, which
+    reads each feed's entries in order from the (feed_id, published_at DESC)
+    index.
+    """
+    if not per_feed or per_feed < 0:
+        per_feed = settings.RIVER_ENTRIES_PER_FEED
+    per_feed = min(per_feed, settings.RIVER_MAX_ENTRIES_PER_FEED)
+
+    with _get_read_session(user) as session:
+        feeds = (
+            session.query(Feed.id, Feed.url)
+            .filter(Feed.user_id == user.id, Feed.deleted_at.is_(None))
+            .order_by(Feed.id)
+            .all()
+        )
+
+        row_number = (
+            sa.func.row_number()
+            .over(partition_by=Entry.feed_id, order_by=Entry.published_at.desc())
+            .label("row_number")
+        )
+        ranked = (
+            _query_entries(
+                session,
+                user,
+                columns=_select_entry_columns(ENTRY_LIST_FIELDS) + (row_number,),
+            )
+            .order_by(None)
+            .subquery()
+        )
+        entries = (
+            session.query(*[ranked.c[field] for field in ENTRY_LIST_FIELDS])
+            .filter(ranked.c.row_number <= per_feed)
+            .order_by(ranked.c.feed_id, ranked.c.row_number)
+            .all()
+        )
+
+        entries_by_feed = collections.defaultdict(list)
+        for entry in entries:
+            entries_by_feed[entry.feed_id].append(entry)
+
+        return [
+            RiverFeed(id=feed.id, url=feed.url, entries=entries_by_feed[feed.id])
+            for feed in feeds
+        ]
+
+
+def export_entries(
+    user: CurrentUser,
+    *,
+    feed_id: Optional[int] = None,
+    entry_status: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> Iterator[Any]:
+    """
+    Return an iterator over all the entries of the user. The filters are the
+    same as `get_entries`.
+
+    Unlike `get_entries`, rows are fetched in batches through a server-side
+    cursor, so the memory usage doesn't depend on the number of entries.
+
+    The database is only queried once the iteration starts.
+    """
+    _validate_entry_status(entry_status)
+    columns = _select_entry_columns(fields or tuple(ENTRY_COLUMNS))
+
+    return _iterate_entries(
+        user,
+        columns=columns,
+        feed_id=feed_id,
+        entry_status=entry_status,
+        since=since,
+        until=until,
+    )
+
+
+def _iterate_entries(
+    user: CurrentUser, *, columns: Sequence[Any], **filters: Any
+) -> Iterator[Any]:
+    with _get_read_session(user) as session:
+        query = _query_entries(session, user, columns=columns, **filters)
+        yield from query.yield_per(settings.EXPORT_BATCH_SIZE)
+
+
+def _select_entry_columns(fields: Sequence[str]) -> Tuple[Any, ...]:
+    invalid_fields = set(fields) - ENTRY_COLUMNS.keys()
+    if invalid_fields:
+        raise ValueError(f"Invalid fields: {', '.join(sorted(invalid_fields))}")
+
+    return tuple(ENTRY_COLUMNS[field] for field in fields)
+
+
+def _query_entries(
+    session: sqlalchemy.orm.Session,
+    user: CurrentUser,
+    *,
+    feed_id: Optional[int] = None,
+    entry_status: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    columns: Sequence[Any] = (Entry,),
+) -> sqlalchemy.orm.Query:
+    query = (
+        session.query(*columns)
+        .select_from(Entry)
+        .join(Feed, Entry.feed_id == Feed.id)
+        .join(Article, Entry.article_id == Article.id)
+        .filter(Feed.user_id == user.id, Feed.deleted_at.is_(None))
+        .order_by(Entry.published_at.desc())
+    )
+
+    # Filter on the entry column, so the planner can prune partitions
+    if feed_id:
+        query = query.filter(Entry.feed_id == feed_id)
+
+    if entry_status:
+        query = query.filter(Entry.status == entry_status)
+
+    # Time ranges are served by the (feed_id, published_at) index
+    if since:
+        query = query.filter(Entry.published_at >= since)
+
+    if until:
+        query = query.filter(Entry.published_at < until)
+
+    return query
+
+
+def _validate_entry_status(entry_status: Optional[str]) -> None:
+    if entry_status and entry_status not in database.Entry.STATUS_LIST:
+        raise ValueError(f"Invalid status: {entry_status}")
+
+
+# An entry from the archive, as returned by `get_archived_entries`
+ArchivedEntry = collections.namedtuple(
+    "ArchivedEntry", EntryArchive.FIELDS + ("feed_id",)
+)
+
+
+def get_archived_entries(
+    user: CurrentUser,
+    feed_id: int,
+    *,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Optional[Tuple[List[ArchivedEntry], Optional[str]]]:
+    """
+    Return the archived entries of a feed, newest first. `since` (inclusive) and
+    `until` (exclusive) limit the entries by their publish date. Return `None`
+    if the feed is not found.
+
+    The result is a tuple of (entries, next_cursor), the same as
+    `search_entries`. Pagination is done on (published_at, id), so entries which
+    share a publish date are not skipped at a page boundary.
+
+    Only the segments which overlap with the time range are read, newest first,
+    and reading stops as soon as the remaining segments can't contain any of the
+    newest `limit` entries.
+    """
+    limit = _sanitize_limit(limit)
+    after = _decode_archive_cursor(cursor) if cursor else None
+
+    with _get_read_session(user) as session:
+        feed = (
+            session.query(Feed.id)
+            .filter(
+                Feed.id == feed_id, Feed.user_id == user.id, Feed.deleted_at.is_(None)
+            )
+            .one_or_none()
+        )
+        if not feed:
+            return None
 
+        query = session.query(EntryArchive).filter(EntryArchive.feed_id == feed.id)
+        if since:
+            query = query.filter(EntryArchive.last_published_at >= since)
+        if until:
+            query = query.filter(EntryArchive.first_published_at < until)
+        if after:
+            query = query.filter(EntryArchive.first_published_at <= after[0])
+
+        # One more than the limit, to know whether there is a next page
+        page_size = limit + 1
+        entries: List[ArchivedEntry] = []
+        segments = query.order_by(EntryArchive.last_published_at.desc())
+        for segment in segments.yield_per(10):
+            if (
+                len(entries) >= page_size
+                and segment.last_published_at < entries[-1].published_at
+            ):
+                break
+
+            for values in helpers.decompress_json(segment.payload):
+                entry = _make_archived_entry(values, feed.id)
+                if _is_in_archive_page(entry, since, until, after):
+                    entries.append(entry)
+
+            entries.sort(key=lambda e: (e.published_at, e.id), reverse=True)
+            del entries[page_size:]
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            last = entries[-1]
+            next_cursor = helpers.encode_cursor([last.published_at.isoformat(), last.id])
+
+        return entries, next_cursor
+
+
+def _is_in_archive_page(
+    entry: ArchivedEntry,
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    after: Optional[Tuple[datetime.datetime, int]],
+) -> bool:
+    if since and entry.published_at < since:
+        return False
+    if until and entry.published_at >= until:
+        return False
+    if after and (entry.published_at, entry.id) >= after:
+        return False
+    return True
+
+
+def _decode_archive_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    values = helpers.decode_cursor(cursor)
+    try:
+        published_at, entry_id = values
+        return datetime.datetime.fromisoformat(published_at), int(entry_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def _make_archived_entry(values: List[Any], feed_id: int) -> ArchivedEntry:
+    entry = ArchivedEntry(*values, feed_id=feed_id)
+    return entry._replace(
+        saved_at=datetime.datetime.fromisoformat(entry.saved_at),
+        published_at=datetime.datetime.fromisoformat(entry.published_at),
+    )
+
+
+def get_entry(user: CurrentUser, entry_id: int) -> Optional[Any]:
+    """
+    Return a single entry of the user with all of its columns, including the
+    full summary.
+    """
+    with _get_read_session(user) as session:
+        query = _query_entries(
+            session, user, columns=_select_entry_columns(tuple(ENTRY_COLUMNS))
+        )
+        return query.filter(Entry.id == entry_id).one_or_none()
+
+
+def change_entry_status(user: CurrentUser, entry_id: int, new_status: str) -> bool:
+    with database.get_session() as session:
         entry = (
             session.query(Entry)
             .join(Feed, Entry.feed_id == Feed.id)
-            .filter(Feed.user_id == user.id, Entry.id == entry_id)
+            .filter(
+                Feed.user_id == user.id,
+                Feed.deleted_at.is_(None),
+                Entry.id == entry_id,
+            )
             .one_or_none()
         )
 
         if not entry:
             return False
 
-        entry.status = new_status
-        session.commit()
+        if entry.status != new_status:
+            entry.status = new_status
+            entry.change_txid = database.current_txid()
+            session.commit()
+            _record_write(user)
+
         return True
+
+
+# The changes of the entries, see `get_entry_changes`. `entries` are the new
+# and changed entries, `removed` the `EntryRemoval` tombstones.
+EntryChanges = collections.namedtuple("EntryChanges", "entries removed cursor has_more")
+
+# Kinds of changes, in the order they're returned within a transaction
+_ENTRY_CHANGED = 0
+_ENTRY_REMOVED = 1
+
+
+def get_entry_changes(
+    user: CurrentUser, *, cursor: Optional[str] = None, limit: Optional[int] = None
+) -> EntryChanges:
+    """
+    Return the changes of the user's entries after `cursor`, in the order of
+    their transactions: the entries which are created or whose status is
+    changed, and the entries which are removed.
+
+    `cursor` is the one returned by the previous call, or `None` to start from
+    the beginning. It stays the same when there are no new changes. Only the
+    changes below `database.committed_txid_limit` are returned, so a change
+    which commits late can't end up behind the cursor of a client.
+    """
+    limit = _sanitize_limit(limit)
+    after = _decode_change_cursor(cursor) if cursor else None
+
+    with _get_read_session(user) as session:
+        committed = database.committed_txid_limit()
+
+        columns = _select_entry_columns(ENTRY_LIST_FIELDS) + (Entry.change_txid,)
+        entries = (
+            session.query(*columns)
+            .select_from(Entry)
+            .join(Feed, Entry.feed_id == Feed.id)
+            .join(Article, Entry.article_id == Article.id)
+            .filter(
+                Feed.user_id == user.id,
+                Feed.deleted_at.is_(None),
+                Entry.change_txid < committed,
+            )
+        )
+        removals = session.query(EntryRemoval).filter(
+            EntryRemoval.user_id == user.id, EntryRemoval.change_txid < committed
+        )
+
+        if after:
+            entries = entries.filter(_is_after_change(Entry, _ENTRY_CHANGED, after))
+            removals = removals.filter(
+                _is_after_change(EntryRemoval, _ENTRY_REMOVED, after)
+            )
+
+        changes = [
+            (entry.change_txid, _ENTRY_CHANGED, entry.id, entry)
+            for entry in entries.order_by(Entry.change_txid, Entry.id)
+            .limit(limit + 1)
+            .all()
+        ]
+        changes += [
+            (removal.change_txid, _ENTRY_REMOVED, removal.id, removal)
+            for removal in removals.order_by(EntryRemoval.change_txid, EntryRemoval.id)
+            .limit(limit + 1)
+            .all()
+        ]
+
+    changes.sort(key=lambda change: change[:3])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        cursor = helpers.encode_cursor(list(changes[-1][:3]))
+
+    return EntryChanges(
+        entries=[change[3] for change in changes if change[1] == _ENTRY_CHANGED],
+        removed=[change[3] for change in changes if change[1] == _ENTRY_REMOVED],
+        cursor=cursor,
+        has_more=has_more,
+    )
+
+
+def _is_after_change(
+    model: Any, kind: int, after: Tuple[int, int, int]
+) -> sa.sql.ColumnElement:
+    txid, after_kind, after_id = after
+    if kind == after_kind:
+        return sa.tuple_(model.change_txid, model.id) > sa.tuple_(txid, after_id)
+    elif kind > after_kind:
+        return model.change_txid >= txid
+    else:
+        return model.change_txid > txid
+
+
+def _decode_change_cursor(cursor: str) -> Tuple[int, int, int]:
+    values = helpers.decode_cursor(cursor)
+    try:
+        txid, kind, change_id = values
+        return int(txid), int(kind), int(change_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def search_entries(
+    user: CurrentUser,
+    query: str,
+    *,
+    feed_id: Optional[int] = None,
+    entry_status: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Any], Optional[str]]:
+    """
+    Search the entries of the user, best matches first.
+
+    The result is a tuple of (entries, next_cursor). `next_cursor` is `None` on
+    the last page; otherwise it must be passed as `cursor` to get the next page.
+    Pagination is done on (rank, id), so no rows are skipped with OFFSET.
+    """
+    _validate_entry_status(entry_status)
+    limit = _sanitize_limit(limit)
+    after = _decode_search_cursor(cursor) if cursor else None
+
+    with _get_read_session(user) as session:
+        ts_query = database.make_search_query(query)
+        # ts_rank_cd() returns a `real`, which doesn't survive the round-trip
+        # through its text representation in the cursor. A double does.
+        rank = sa.cast(
+            sa.func.ts_rank_cd(Article.search_vector, ts_query), DOUBLE_PRECISION
+        ).label("rank")
+
+        columns = _select_entry_columns(ENTRY_LIST_FIELDS) + (rank,)
+        search = (
+            _query_entries(
+                session,
+                user,
+                feed_id=feed_id,
+                entry_status=entry_status,
+                columns=columns,
+            )
+            .filter(Article.search_vector.op("@@")(ts_query))
+            .order_by(None)
+            .order_by(rank.desc(), Entry.id.desc())
+        )
+
+        if after:
+            search = search.filter(sa.tuple_(rank, Entry.id) < sa.tuple_(*after))
+
+        entries = search.limit(limit + 1).all()
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = helpers.encode_cursor([entries[-1].rank, entries[-1].id])
+
+        return entries, next_cursor
+
+
+def _decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    values = helpers.decode_cursor(cursor)
+    try:
+        rank, entry_id = values
+        return float(rank), int(entry_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def _sanitize_limit(limit: Optional[int]) -> int:
+    if not limit or limit < 0:
+        return settings.API_PAGE_SIZE
+
+    return min(limit, settings.API_MAX_PAGE_SIZE)
+
+
+def get_metrics(user: CurrentUser) -> dict:
+    if not user.is_admin:
+        raise exceptions.AuthorizationFailedError("Only admins can view metrics")
+
+    values = metrics.snapshot()
+    values["pools"] = database.get_pool_status()
+    # The scheduler runs in its own process and stores its lag after each run
+    with _get_read_session(user) as session:
+        status = session.get(database.SchedulerStatus, 1)
+        values["scheduler"] = dict(
+            lag_seconds=status.lag_seconds if status else None,
+            updated_at=status.updated_at.isoformat() if status else None,
+        )
+
+    return values
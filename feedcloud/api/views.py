@@ -1,4 +1,6 @@
-from typing import Tuple
+import datetime
+import hashlib
+from typing import AbstractSet, List, Optional, Tuple
 
 import apispec
 import flask
@@ -8,14 +10,15 @@ from apispec_webframeworks.flask import FlaskPlugin
 from flask_jwt_extended import (
     JWTManager,
     create_access_token,
-    get_jwt_identity,
+    create_refresh_token,
+    get_jwt,
     jwt_required,
 )
 from marshmallow.exceptions import ValidationError
 
-from feedcloud import settings
+from feedcloud import database, opml, settings
 
-from . import exceptions, schemas, services
+from . import exceptions, notifications, schemas, services
 
 app = flask.Flask(__name__)
 app.config.update(settings.get_all_settings())
@@ -57,6 +60,11 @@ def authenticate():
                 content:
                     application/json:
                         schema: MarshmallowErrorSchema
+            503:
+                description: Too many pending logins
+                content:
+                    application/json:
+                        schema: MessageSchema
     """
     schema = schemas.UserSchema()
 
@@ -67,22 +75,171 @@ def authenticate():
     except ValidationError as err:
         return schemas.MarshmallowErrorSchema().dump(dict(errors=err.messages)), 400
 
-    if not services.authenticate_user(username, password):
+    try:
+        user = services.authenticate_user(username, password)
+    except exceptions.ServiceBusyError as e:
+        response = flask.jsonify(make_message(str(e)))
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
+
+    if not user:
         return make_error("Invalid username or password")
 
-    response = dict(token=create_access_token(identity=username))
+    # The user ID and admin flag are signed into the tokens, so the user doesn't
+    # need to be looked up by name on each request
+    claims = make_token_claims(user)
+    response = dict(
+        token=create_access_token(identity=user.username, additional_claims=claims),
+        refresh_token=create_refresh_token(
+            identity=user.username, additional_claims=claims
+        ),
+    )
+    return schemas.AuthResponseSchema().dump(response)
+
+
+@app.route("/auth/refresh", methods=["POST"])
+@jwt_required(refresh=True)
+def refresh_token():
+    """
+    ---
+    post:
+        description:
+            Get a new access token. The refresh token from `/auth/` must be passed
+            instead of an access token in the `Authorization` header.
+        responses:
+            200:
+                description: A new access token
+                content:
+                    application/json:
+                        schema: AuthResponseSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    user = get_current_user()
+    claims = make_token_claims(user)
+    response = dict(
+        token=create_access_token(identity=user.username, additional_claims=claims)
+    )
     return schemas.AuthResponseSchema().dump(response)
 
 
+def make_token_claims(user: services.CurrentUser) -> dict:
+    return dict(user_id=user.id, is_admin=user.is_admin)
+
+
 def make_error(msg: str) -> Tuple[dict, int]:
     return make_message(msg), 401
 
 
+@app.errorhandler(exceptions.AuthorizationFailedError)
+def handle_authorization_failed(e: exceptions.AuthorizationFailedError):
+    return make_error(str(e))
+
+
+def get_current_user() -> services.CurrentUser:
+    """
+    Return the user of the current request, based on the claims of its access
+    token. Raise `AuthorizationFailedError` if the user doesn't exist anymore.
+    """
+    user_id = get_jwt().get("user_id")
+    if user_id is None:
+        raise exceptions.AuthorizationFailedError("Invalid token")
+
+    return services.get_current_user(user_id)
+
+
 def make_message(msg: str) -> dict:
     resp_schema = schemas.MessageSchema()
     return resp_schema.dump({"message": msg})
 
 
+def make_bad_request(msg: str) -> Tuple[dict, int]:
+    return make_message(msg), 400
+
+
+def get_fields_arg(
+    valid_fields: AbstractSet[str] = schemas.ENTRY_FIELDS,
+) -> Optional[List[str]]:
+    """
+    Parse the `fields` query parameter, a comma-separated list of entry fields.
+    """
+    value = flask.request.args.get("fields")
+    if not value:
+        return None
+
+    fields = list(dict.fromkeys(f.strip() for f in value.split(",") if f.strip()))
+    invalid_fields = set(fields) - valid_fields
+    if invalid_fields:
+        raise exceptions.InvalidRequestError(
+            f"Invalid fields: {', '.join(sorted(invalid_fields))}"
+        )
+
+    return fields
+
+
+def get_status_arg() -> Optional[str]:
+    """
+    Parse the `status` query parameter, which filters the entries by status.
+    """
+    value = flask.request.args.get("status")
+    if value and value not in database.Entry.STATUS_LIST:
+        raise exceptions.InvalidRequestError(f"Invalid status: {value}")
+
+    return value
+
+
+def get_datetime_arg(name: str) -> Optional[datetime.datetime]:
+    """
+    Parse an ISO 8601 date/time query parameter. Dates with a timezone are
+    converted to the server's local time, which is how dates are stored.
+    """
+    value = flask.request.args.get(name)
+    if not value:
+        return None
+
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise exceptions.InvalidRequestError(f"Invalid date/time for '{name}'")
+
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+
+    return dt
+
+
+def make_etag(user: services.CurrentUser, feed_id: Optional[int] = None) -> str:
+    """
+    Build an ETag for a list response of the current request.
+
+    The ETag is computed before the data is loaded, so if the data changes in
+    between, the client just receives a fresh response on its next poll.
+    """
+    version = services.get_data_version(user, feed_id=feed_id)
+    key = f"{user.id}|{flask.request.full_path}|{version}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def is_not_modified(etag: str) -> bool:
+    return flask.request.if_none_match.contains(etag)
+
+
+def make_not_modified(etag: str) -> flask.Response:
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def make_cacheable(body: dict, etag: str) -> flask.Response:
+    response = flask.make_response(body, 200)
+    response.set_etag(etag)
+    return response
+
+
 @app.route("/users/", methods=["POST"])
 @jwt_required()
 def create_user():
@@ -124,9 +281,9 @@ def create_user():
     except ValidationError as err:
         return schemas.MarshmallowErrorSchema().dump(dict(errors=err.messages)), 400
 
-    username = get_jwt_identity()
+    user = get_current_user()
     try:
-        created = services.create_new_user(username, body["username"], body["password"])
+        created = services.create_new_user(user, body["username"], body["password"])
     except exceptions.AuthorizationFailedError as e:
         return make_error(str(e))
 
@@ -136,6 +293,57 @@ def create_user():
         return make_message("User already exists"), 409
 
 
+@app.route("/users/<username>", methods=["DELETE"])
+@jwt_required()
+def delete_user(username):
+    """
+    ---
+    delete:
+        description: Delete a user with all of their feeds. The user is removed
+            right away, and their data is deleted in the background.
+        parameters:
+            - in: path
+              name: username
+              required: true
+              schema:
+                  type: string
+              description: Name of the user to delete
+        responses:
+            200:
+                description: User successfully deleted
+                content:
+                    application/json:
+                        schema: MessageSchema
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            404:
+                description: User not found
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    user = get_current_user()
+    try:
+        deleted = services.delete_user(user, username)
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+    except ValueError as e:
+        return make_bad_request(str(e))
+
+    if deleted:
+        return make_message("User is deleted"), 200
+    else:
+        return make_message("User not found"), 404
+
+
 @app.route("/feeds/", methods=["POST"])
 @jwt_required()
 def register_feed():
@@ -172,9 +380,9 @@ def register_feed():
     except ValidationError as err:
         return schemas.MarshmallowErrorSchema().dump(dict(errors=err.messages)), 400
 
-    username = get_jwt_identity()
+    user = get_current_user()
     try:
-        created = services.register_feed(username, body["url"])
+        created = services.register_feed(user, body["url"])
     except exceptions.AuthorizationFailedError as e:
         return make_error(str(e))
 
@@ -184,13 +392,106 @@ def register_feed():
         return make_message("Feed already exists"), 409
 
 
+@app.route("/feeds/import", methods=["POST"])
+@jwt_required()
+def import_feeds():
+    """
+    ---
+    post:
+        description:
+            Register all the feeds of an OPML file. The file is either the request
+            body, or the `file` field of a multipart form. Feeds which are already
+            registered are skipped, and the first fetch of the new feeds is spread
+            over a time window.
+        requestBody:
+            required: true
+            content:
+                text/x-opml:
+                    schema:
+                        type: string
+        responses:
+            200:
+                description: Feeds imported successfully
+                content:
+                    application/json:
+                        schema: FeedImportResultSchema
+            400:
+                description: Invalid OPML file
+                content:
+                    application/json:
+                        schema: MessageSchema
+            413:
+                description: The OPML file is too large
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    # Flask only enforces MAX_CONTENT_LENGTH on form data, not on the raw body
+    max_length = app.config["MAX_CONTENT_LENGTH"]
+    if max_length and (flask.request.content_length or 0) > max_length:
+        return make_message("The OPML file is too large"), 413
+
+    if "file" in flask.request.files:
+        data = flask.request.files["file"].read()
+    else:
+        data = flask.request.get_data()
+
+    user = get_current_user()
+    try:
+        urls = opml.parse_opml(data)
+        added, existing = services.import_feeds(user, urls)
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+    except ValueError as e:
+        return make_bad_request(str(e))
+
+    result = dict(added=added, existing=existing)
+    return schemas.FeedImportResultSchema().dump(result), 200
+
+
+@app.route("/feeds/export", methods=["GET"])
+@jwt_required()
+def export_feeds():
+    """
+    ---
+    get:
+        description:
+            Export the feeds of the user as an OPML file. The response is streamed.
+        responses:
+            200:
+                description: The feeds of the user
+                content:
+                    text/x-opml:
+                        schema:
+                            type: string
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    user = get_current_user()
+    feeds = services.export_feeds(user)
+
+    stream = flask.stream_with_context(opml.stream_opml(feeds))
+    response = flask.Response(stream, mimetype="text/x-opml")
+    response.headers["Content-Disposition"] = 'attachment; filename="feeds.opml"'
+    return response
+
+
 @app.route("/feeds/<feed_id>", methods=["DELETE"])
 @jwt_required()
 def unregister_feed(feed_id):
     """
     ---
     delete:
-        description: Unregister a feed. The feed and all its entries will be deleted.
+        description: Unregister a feed. The feed is removed right away, and its
+            entries are deleted in the background.
         parameters:
             - in: path
               name: feed_id
@@ -216,9 +517,9 @@ def unregister_feed(feed_id):
                         schema: MessageSchema
 
     """
-    username = get_jwt_identity()
+    user = get_current_user()
     try:
-        deleted = services.unregister_feed(username, feed_id)
+        deleted = services.unregister_feed(user, feed_id)
     except exceptions.AuthorizationFailedError as e:
         return make_error(str(e))
 
@@ -238,6 +539,11 @@ def force_run_feed(feed_id):
             Force run a feed. Feed will be scheduled to be run immediately.
             If the feed was stopped due to several failures before, this successful run
             will cause the feed to be scheduled again automatically afterwards.
+
+            Force runs requested shortly after each other are coalesced. The status
+            is `queued` if a new run was scheduled, `pending` if an earlier run is
+            still queued or running, and `completed` if an earlier run has just
+            finished.
         parameters:
             - in: path
               name: feed_id
@@ -250,7 +556,7 @@ def force_run_feed(feed_id):
                 description: Feed successfully scheduled to be run
                 content:
                     application/json:
-                        schema: MessageSchema
+                        schema: ForceRunSchema
             401:
                 description: Unauthorized access
                 content:
@@ -262,14 +568,14 @@ def force_run_feed(feed_id):
                     application/json:
                         schema: MessageSchema
     """
-    username = get_jwt_identity()
+    user = get_current_user()
     try:
-        success = services.force_run_feed(username, feed_id)
+        force_run = services.force_run_feed(user, feed_id)
     except exceptions.AuthorizationFailedError as e:
         return make_error(str(e))
 
-    if success:
-        return make_message("Accepted"), 200
+    if force_run:
+        return schemas.ForceRunSchema().dump(force_run), 200
     else:
         return make_message("Feed not found"), 404
 
@@ -281,6 +587,13 @@ def get_feeds():
     ---
     get:
         description: Get the list of all registered feeds.
+        parameters:
+            - in: header
+              name: If-None-Match
+              required: false
+              schema:
+                  type: string
+              description: ETag of a previous response to revalidate.
         responses:
             401:
                 description: Unauthorized access
@@ -292,73 +605,40 @@ def get_feeds():
                 content:
                     application/json:
                         schema: FeedListSchema
+            304:
+                description: Feeds have not changed since the given ETag
     """
-    username = get_jwt_identity()
+    user = get_current_user()
     try:
-        feeds = services.get_feeds(username)
+        etag = make_etag(user)
+        if is_not_modified(etag):
+            return make_not_modified(etag)
+
+        feeds = services.get_feeds(user)
     except exceptions.AuthorizationFailedError as e:
         return make_error(str(e))
 
-    schema = schemas.FeedListSchema()
-    return schema.dump(dict(feeds=feeds)), 200
+    return make_cacheable(schemas.dump_feed_list(feeds), etag)
 
 
-@app.route("/feeds/<feed_id>/entries/", methods=["GET"])
+@app.route("/feeds/<feed_id>/retention", methods=["PUT"])
 @jwt_required()
-def get_feed_entries(feed_id):
+def set_feed_retention(feed_id):
     """
     ---
-    get:
-        description: Get the list of entries in a feed.
+    put:
+        description:
+            Change how long the entries of a feed are kept. Entries outside of
+            the policy are deleted in the background.
         parameters:
             - in: path
               name: feed_id
               required: true
               schema:
                   type: integer
-              description: Feed ID to get the entries of
-            - in: query
-              name: status
-              required: false
-              schema:
-                  type: string
-              description: Filter by entry status. Can be 'read' or 'unread'.
-        responses:
-            401:
-                description: Unauthorized access
-                content:
-                    application/json:
-                        schema: MessageSchema
-            200:
-                description: List of entries belonging to the feed
-                content:
-                    application/json:
-                        schema: EntryListSchema
-    """
-    username = get_jwt_identity()
-    status = flask.request.args.get("status")
-
-    try:
-        entries = services.get_entries(username, feed_id=feed_id, entry_status=status)
-    except (exceptions.AuthorizationFailedError, ValueError) as e:
-        return make_error(str(e))
-
-    schema = schemas.EntryListSchema()
-    return schema.dump(dict(entries=entries)), 200
-
-
-@app.route("/entries/<entry_id>", methods=["PUT"])
-@jwt_required()
-def change_entry_status(entry_id):
-    """
-    ---
-    put:
-        description: Mark an entry as read or unread.
-        parameters:
             - in: body
               required: true
-              schema:
-                  EntryStatusChangeRequestSchema
+              schema: FeedRetentionRequestSchema
         responses:
             400:
                 description: Invalid request
@@ -371,72 +651,813 @@ def change_entry_status(entry_id):
                     application/json:
                         schema: MessageSchema
             200:
-                description: Entry's status changed successfully
+                description: Retention policy changed successfully
                 content:
                     application/json:
                         schema: MessageSchema
             404:
-                description: Entry not found
+                description: Feed not found
                 content:
                     application/json:
                         schema: MessageSchema
-
     """
-    username = get_jwt_identity()
-    schema = schemas.EntryStatusChangeRequestSchema()
+    schema = schemas.FeedRetentionRequestSchema()
     try:
         body = schema.load(flask.request.json)
     except ValidationError as err:
         return schemas.MarshmallowErrorSchema().dump(dict(errors=err.messages)), 400
 
-    username = get_jwt_identity()
-    try:
-        changed = services.change_entry_status(username, entry_id, body["status"])
-    except exceptions.AuthorizationFailedError as e:
-        return make_error(str(e))
+    user = get_current_user()
+    changed = services.set_feed_retention(user, feed_id, **body)
 
     if changed:
-        return make_message("Status changed successfully"), 200
+        return make_message("Retention policy changed successfully"), 200
     else:
-        return make_message("Entry not found"), 404
+        return make_message("Feed not found"), 404
 
 
-@app.route("/entries/", methods=["GET"])
+@app.route("/feeds/<feed_id>/health", methods=["GET"])
 @jwt_required()
-def get_entries():
+def get_feed_health(feed_id):
     """
     ---
     get:
-        description: Get entries across all feeds.
+        description:
+            Get the last update run of a feed and the daily totals of its update
+            runs, newest day first.
         parameters:
+            - in: path
+              name: feed_id
+              required: true
+              schema:
+                  type: integer
             - in: query
-              name: status
+              name: days
               required: false
               schema:
-                  type: string
-              description: Filter by entry status. Can be 'read' or 'unread'.
+                  type: integer
+              description: Number of days to return.
         responses:
             401:
                 description: Unauthorized access
                 content:
                     application/json:
                         schema: MessageSchema
+            404:
+                description: Feed not found
+                content:
+                    application/json:
+                        schema: MessageSchema
             200:
-                description: List of entries belonging to the feed
+                description: Update history of the feed
                 content:
                     application/json:
-                        schema: EntryListSchema
+                        schema: FeedHealthSchema
     """
-    username = get_jwt_identity()
-    status = flask.request.args.get("status")
+    user = get_current_user()
+    days = flask.request.args.get("days", None, type=int)
+
+    health = services.get_feed_health(user, feed_id, days=days)
+    if not health:
+        return make_message("Feed not found"), 404
+
+    return schemas.FeedHealthSchema().dump(health), 200
 
-    try:
-        entries = services.get_entries(username, entry_status=status)
-    except (exceptions.AuthorizationFailedError, ValueError) as e:
-        return make_error(str(e))
 
-    schema = schemas.EntryListSchema()
-    return schema.dump(dict(entries=entries)), 200
+@app.route("/feeds/<feed_id>/archive", methods=["GET"])
+@jwt_required()
+def get_archived_entries(feed_id):
+    """
+    ---
+    get:
+        description:
+            Get the archived entries of a feed, newest first. Entries are moved
+            to the archive when they get old, and are only available here. Pass
+            the returned `next_cursor` as `cursor` to get the next page.
+        parameters:
+            - in: path
+              name: feed_id
+              required: true
+              schema:
+                  type: integer
+            - in: query
+              name: since
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published at or after this time.
+            - in: query
+              name: until
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published before this time.
+            - in: query
+              name: limit
+              required: false
+              schema:
+                  type: integer
+            - in: query
+              name: cursor
+              required: false
+              schema:
+                  type: string
+              description: Cursor of the next page, from a previous response.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            404:
+                description: Feed not found
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Archived entries of the feed
+                content:
+                    application/json:
+                        schema: ArchivedEntryListSchema
+    """
+    user = get_current_user()
+    limit = flask.request.args.get("limit", None, type=int)
+    cursor = flask.request.args.get("cursor")
+
+    try:
+        since = get_datetime_arg("since")
+        until = get_datetime_arg("until")
+        result = services.get_archived_entries(
+            user, feed_id, since=since, until=until, limit=limit, cursor=cursor
+        )
+    except (exceptions.InvalidRequestError, ValueError) as e:
+        return make_bad_request(str(e))
+
+    if result is None:
+        return make_message("Feed not found"), 404
+
+    entries, next_cursor = result
+    response = schemas.dump_archived_entry_list(entries, next_cursor=next_cursor)
+    return response, 200
+
+
+@app.route("/feeds/<feed_id>/entries/", methods=["GET"])
+@jwt_required()
+def get_feed_entries(feed_id):
+    """
+    ---
+    get:
+        description: Get the list of entries in a feed.
+        parameters:
+            - in: path
+              name: feed_id
+              required: true
+              schema:
+                  type: integer
+              description: Feed ID to get the entries of
+            - in: query
+              name: status
+              required: false
+              schema:
+                  type: string
+              description: Filter by entry status. Can be 'read' or 'unread'.
+            - in: query
+              name: since
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published at or after this time.
+            - in: query
+              name: until
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published before this time.
+            - in: query
+              name: fields
+              required: false
+              schema:
+                  type: string
+              description:
+                  Comma-separated list of entry fields to return. All fields are
+                  returned by default.
+            - in: header
+              name: If-None-Match
+              required: false
+              schema:
+                  type: string
+              description: ETag of a previous response to revalidate.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: List of entries belonging to the feed
+                content:
+                    application/json:
+                        schema: EntryListSchema
+            304:
+                description: Entries have not changed since the given ETag
+    """
+    user = get_current_user()
+
+    # Validated before the ETag, so an invalid request never gets a 304
+    try:
+        status = get_status_arg()
+        fields = get_fields_arg()
+        since = get_datetime_arg("since")
+        until = get_datetime_arg("until")
+    except exceptions.InvalidRequestError as e:
+        return make_bad_request(str(e))
+
+    try:
+        etag = make_etag(user, feed_id=feed_id)
+        if is_not_modified(etag):
+            return make_not_modified(etag)
+
+        entries = services.get_entries(
+            user,
+            feed_id=feed_id,
+            entry_status=status,
+            since=since,
+            until=until,
+            fields=fields,
+        )
+    except (exceptions.AuthorizationFailedError, ValueError) as e:
+        return make_error(str(e))
+
+    return make_cacheable(schemas.dump_entry_list(entries, fields=fields), etag)
+
+
+@app.route("/entries/<entry_id>", methods=["PUT"])
+@jwt_required()
+def change_entry_status(entry_id):
+    """
+    ---
+    put:
+        description: Mark an entry as read or unread.
+        parameters:
+            - in: body
+              required: true
+              schema:
+                  EntryStatusChangeRequestSchema
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MarshmallowErrorSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Entry's status changed successfully
+                content:
+                    application/json:
+                        schema: MessageSchema
+            404:
+                description: Entry not found
+                content:
+                    application/json:
+                        schema: MessageSchema
+
+    """
+    schema = schemas.EntryStatusChangeRequestSchema()
+    try:
+        body = schema.load(flask.request.json)
+    except ValidationError as err:
+        return schemas.MarshmallowErrorSchema().dump(dict(errors=err.messages)), 400
+
+    user = get_current_user()
+    try:
+        changed = services.change_entry_status(user, entry_id, body["status"])
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+
+    if changed:
+        return make_message("Status changed successfully"), 200
+    else:
+        return make_message("Entry not found"), 404
+
+
+@app.route("/entries/<entry_id>", methods=["GET"])
+@jwt_required()
+def get_entry(entry_id):
+    """
+    ---
+    get:
+        description:
+            Get a single entry, including its full summary. The list endpoints only
+            return a plain-text excerpt of the summary.
+        parameters:
+            - in: path
+              name: entry_id
+              required: true
+              schema:
+                  type: integer
+              description: Numeric ID of the entry
+        responses:
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: The entry
+                content:
+                    application/json:
+                        schema: EntryDetailSchema
+            404:
+                description: Entry not found
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    user = get_current_user()
+    try:
+        entry = services.get_entry(user, entry_id)
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+
+    if not entry:
+        return make_message("Entry not found"), 404
+
+    return schemas.dump_entry_detail(entry), 200
+
+
+@app.route("/entries/", methods=["GET"])
+@jwt_required()
+def get_entries():
+    """
+    ---
+    get:
+        description: Get entries across all feeds.
+        parameters:
+            - in: query
+              name: status
+              required: false
+              schema:
+                  type: string
+              description: Filter by entry status. Can be 'read' or 'unread'.
+            - in: query
+              name: since
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published at or after this time.
+            - in: query
+              name: until
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published before this time.
+            - in: query
+              name: fields
+              required: false
+              schema:
+                  type: string
+              description:
+                  Comma-separated list of entry fields to return. All fields are
+                  returned by default.
+            - in: header
+              name: If-None-Match
+              required: false
+              schema:
+                  type: string
+              description: ETag of a previous response to revalidate.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: List of entries belonging to the feed
+                content:
+                    application/json:
+                        schema: EntryListSchema
+            304:
+                description: Entries have not changed since the given ETag
+    """
+    user = get_current_user()
+
+    # Validated before the ETag, so an invalid request never gets a 304
+    try:
+        status = get_status_arg()
+        fields = get_fields_arg()
+        since = get_datetime_arg("since")
+        until = get_datetime_arg("until")
+    except exceptions.InvalidRequestError as e:
+        return make_bad_request(str(e))
+
+    try:
+        etag = make_etag(user)
+        if is_not_modified(etag):
+            return make_not_modified(etag)
+
+        entries = services.get_entries(
+            user,
+            entry_status=status,
+            since=since,
+            until=until,
+            fields=fields,
+        )
+    except (exceptions.AuthorizationFailedError, ValueError) as e:
+        return make_error(str(e))
+
+    return make_cacheable(schemas.dump_entry_list(entries, fields=fields), etag)
+
+
+@app.route("/entries/changes/", methods=["GET"])
+@jwt_required()
+def get_entry_changes():
+    """
+    ---
+    get:
+        description:
+            Get the entries which are created or whose status is changed after
+            the given cursor, and the entries which are removed (purged,
+            archived or deleted with their feed). Pass the returned `cursor` in
+            the next call to continue syncing.
+        parameters:
+            - in: query
+              name: cursor
+              required: false
+              schema:
+                  type: string
+              description:
+                  Cursor from the previous response. Without it, the changes
+                  are returned from the beginning.
+            - in: query
+              name: limit
+              required: false
+              schema:
+                  type: integer
+              description: Maximum number of changes to return.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: List of changes and the cursor of the next call
+                content:
+                    application/json:
+                        schema: EntryChangeListSchema
+    """
+    user = get_current_user()
+    cursor = flask.request.args.get("cursor")
+    limit = flask.request.args.get("limit", None, type=int)
+
+    try:
+        changes = services.get_entry_changes(user, cursor=cursor, limit=limit)
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+    except ValueError as e:
+        return make_bad_request(str(e))
+
+    response = schemas.dump_entry_change_list(
+        changes.entries,
+        removed=changes.removed,
+        cursor=changes.cursor,
+        has_more=changes.has_more,
+    )
+    return response, 200
+
+
+@app.route("/entries/search", methods=["GET"])
+@jwt_required()
+def search_entries():
+    """
+    ---
+    get:
+        description:
+            Full-text search over the entries of the user. Results are ordered by
+            relevance. Pass the returned `next_cursor` as `cursor` to get the next
+            page of results.
+        parameters:
+            - in: query
+              name: q
+              required: true
+              schema:
+                  type: string
+              description:
+                  Search query. Supports quoted phrases, `or` and `-` to exclude
+                  words.
+            - in: query
+              name: feed_id
+              required: false
+              schema:
+                  type: integer
+              description: Only search the entries of this feed.
+            - in: query
+              name: status
+              required: false
+              schema:
+                  type: string
+              description: Filter by entry status. Can be 'read' or 'unread'.
+            - in: query
+              name: limit
+              required: false
+              schema:
+                  type: integer
+              description: Maximum number of results to return.
+            - in: query
+              name: cursor
+              required: false
+              schema:
+                  type: string
+              description: Cursor of the next page, from a previous response.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Matching entries
+                content:
+                    application/json:
+                        schema: EntrySearchResultListSchema
+    """
+    user = get_current_user()
+    query = flask.request.args.get("q", "").strip()
+    feed_id = flask.request.args.get("feed_id", None, type=int)
+    status = flask.request.args.get("status")
+    limit = flask.request.args.get("limit", None, type=int)
+    cursor = flask.request.args.get("cursor")
+
+    if not query:
+        return make_bad_request("Search query is required")
+
+    try:
+        entries, next_cursor = services.search_entries(
+            user,
+            query,
+            feed_id=feed_id,
+            entry_status=status,
+            limit=limit,
+            cursor=cursor,
+        )
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+    except ValueError as e:
+        return make_bad_request(str(e))
+
+    response = schemas.dump_entry_search_result_list(entries, next_cursor=next_cursor)
+    return response, 200
+
+
+@app.route("/river/", methods=["GET"])
+@jwt_required()
+def get_river():
+    """
+    ---
+    get:
+        description:
+            Get the newest entries of each of the user's feeds in a single call.
+        parameters:
+            - in: query
+              name: per_feed
+              required: false
+              schema:
+                  type: integer
+              description: Number of entries to return for each feed.
+        responses:
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Feeds with their newest entries
+                content:
+                    application/json:
+                        schema: RiverSchema
+    """
+    user = get_current_user()
+    per_feed = flask.request.args.get("per_feed", None, type=int)
+
+    try:
+        feeds = services.get_river(user, per_feed=per_feed)
+    except exceptions.AuthorizationFailedError as e:
+        return make_error(str(e))
+
+    return schemas.dump_river(feeds), 200
+
+
+@app.route("/entries/export", methods=["GET"])
+@jwt_required()
+def export_entries():
+    """
+    ---
+    get:
+        description:
+            Export all entries of the user. The response is streamed, so it can be
+            used for archives of any size.
+        parameters:
+            - in: query
+              name: format
+              required: false
+              schema:
+                  type: string
+              description:
+                  Either 'json' (default) for a document like `GET /entries/`, or
+                  'ndjson' for one JSON entry per line.
+            - in: query
+              name: feed_id
+              required: false
+              schema:
+                  type: integer
+              description: Only export the entries of this feed.
+            - in: query
+              name: status
+              required: false
+              schema:
+                  type: string
+              description: Filter by entry status. Can be 'read' or 'unread'.
+            - in: query
+              name: since
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published at or after this time.
+            - in: query
+              name: until
+              required: false
+              schema:
+                  type: string
+                  format: date-time
+              description: Only return entries published before this time.
+            - in: query
+              name: fields
+              required: false
+              schema:
+                  type: string
+              description:
+                  Comma-separated list of entry fields to return. All fields are
+                  returned by default.
+        responses:
+            400:
+                description: Invalid request
+                content:
+                    application/json:
+                        schema: MessageSchema
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: All entries of the user
+                content:
+                    application/json:
+                        schema: EntryListSchema
+                    application/x-ndjson:
+                        schema: EntryDetailSchema
+    """
+    user = get_current_user()
+    export_format = flask.request.args.get("format", "json")
+    feed_id = flask.request.args.get("feed_id", None, type=int)
+
+    if export_format not in EXPORT_FORMATS:
+        return make_bad_request(f"Invalid format: {export_format}")
+
+    try:
+        status = get_status_arg()
+        fields = get_fields_arg(schemas.ENTRY_DETAIL_FIELDS)
+        since = get_datetime_arg("since")
+        until = get_datetime_arg("until")
+    except exceptions.InvalidRequestError as e:
+        return make_bad_request(str(e))
+
+    try:
+        entries = services.export_entries(
+            user,
+            feed_id=feed_id,
+            entry_status=status,
+            since=since,
+            until=until,
+            fields=fields,
+        )
+    except (exceptions.AuthorizationFailedError, ValueError) as e:
+        return make_error(str(e))
+
+    stream_func, mimetype = EXPORT_FORMATS[export_format]
+    stream = flask.stream_with_context(stream_func(entries, fields=fields))
+    return flask.Response(stream, mimetype=mimetype)
+
+
+EXPORT_FORMATS = {
+    "json": (schemas.stream_entry_list, "application/json"),
+    "ndjson": (schemas.stream_entry_ndjson, "application/x-ndjson"),
+}
+
+
+@app.route("/events/", methods=["GET"])
+@jwt_required()
+def get_events():
+    """
+    ---
+    get:
+        description:
+            Stream live events using Server-Sent Events. A `new-entries` event with
+            the `feed_id` and the `count` of new entries is sent whenever new
+            entries are saved for one of the user's feeds.
+        responses:
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Stream of events
+                content:
+                    text/event-stream:
+                        schema:
+                            type: string
+            503:
+                description: Too many event streams are open
+                content:
+                    application/json:
+                        schema: MessageSchema
+    """
+    user = get_current_user()
+    try:
+        stream = notifications.stream_new_entry_events(user.id)
+    except exceptions.ServiceBusyError as e:
+        response = flask.jsonify(make_message(str(e)))
+        response.status_code = 503
+        response.headers["Retry-After"] = str(settings.SSE_RECONNECT_SECONDS)
+        return response
+
+    response = flask.Response(stream, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/metrics/", methods=["GET"])
+@jwt_required()
+def get_metrics():
+    """
+    ---
+    get:
+        description:
+            Get the metrics of the API process that serves the request, such as
+            connection pool usage and checkout times. Only admins can call this.
+        responses:
+            401:
+                description: Unauthorized access
+                content:
+                    application/json:
+                        schema: MessageSchema
+            200:
+                description: Metrics of the process
+                content:
+                    application/json:
+                        schema:
+                            type: object
+    """
+    user = get_current_user()
+    return services.get_metrics(user)
 
 
 @app.route("/swagger.json")
@@ -448,11 +1469,25 @@ def create_swagger_spec():
 # Register endpoints with the API Spec
 with app.test_request_context():
     spec.path(view=authenticate)
+    spec.path(view=refresh_token)
     spec.path(view=create_user)
+    spec.path(view=delete_user)
     spec.path(view=register_feed)
+    spec.path(view=import_feeds)
+    spec.path(view=export_feeds)
     spec.path(view=unregister_feed)
     spec.path(view=force_run_feed)
     spec.path(view=get_feeds)
     spec.path(view=get_feed_entries)
+    spec.path(view=get_archived_entries)
+    spec.path(view=get_feed_health)
+    spec.path(view=set_feed_retention)
     spec.path(view=change_entry_status)
     spec.path(view=get_entries)
+    spec.path(view=get_entry)
+    spec.path(view=get_entry_changes)
+    spec.path(view=get_events)
+    spec.path(view=export_entries)
+    spec.path(view=search_entries)
+    spec.path(view=get_river)
+    spec.path(view=get_metrics)
@@ -1,6 +1,7 @@
 import click
 
-from feedcloud import constants, database, helpers
+from feedcloud import constants, database, helpers, maintenance, opml
+from feedcloud.api import services
 from feedcloud.ingest.scheduler import Scheduler
 
 
@@ -33,6 +34,132 @@ def init_database(delete_all):
     click.echo("Done")
 
 
+@database_group.command("backfill-excerpts")
+@click.option("--batch-size", default=1000, show_default=True)
+def backfill_excerpts(batch_size):
+    """
+    Compute the excerpt of the articles which were saved without one.
+    """
+    n_updated = maintenance.backfill_excerpts(batch_size=batch_size)
+    click.echo(f"Updated {n_updated} articles")
+
+
+@database_group.command("backfill-search")
+@click.option("--batch-size", default=1000, show_default=True)
+def backfill_search(batch_size):
+    """
+    Build the full-text search document of the articles which were saved without
+    one.
+    """
+    n_updated = maintenance.backfill_search_vectors(batch_size=batch_size)
+    click.echo(f"Updated {n_updated} articles")
+
+
+@database_group.command("rollup-runs")
+@click.option("--batch-size", default=1000, show_default=True)
+def rollup_runs(batch_size):
+    """
+    Roll up the old feed update runs into daily stats.
+    """
+    n_deleted = maintenance.rollup_feed_update_runs(batch_size=batch_size)
+    click.echo(f"Rolled up {n_deleted} runs")
+
+
+@database_group.command("purge-entries")
+@click.option("--batch-size", default=1000, show_default=True)
+def purge_entries(batch_size):
+    """
+    Delete the entries which are outside of the retention policy of their feed.
+    """
+    n_deleted = maintenance.purge_entries(batch_size=batch_size)
+    click.echo(f"Deleted {n_deleted} entries")
+
+
+@database_group.command("archive-entries")
+@click.option("--older-than-days", type=int, help="Defaults to ENTRY_ARCHIVE_AFTER_DAYS")
+@click.option("--segment-size", type=int, help="Defaults to ENTRY_ARCHIVE_SEGMENT_SIZE")
+def archive_entries(older_than_days, segment_size):
+    """
+    Move old entries from the entry table to compressed archive segments.
+    """
+    n_archived = maintenance.archive_entries(
+        older_than_days=older_than_days, segment_size=segment_size
+    )
+    click.echo(f"Archived {n_archived} entries")
+
+
+@database_group.command("delete-orphaned-articles")
+@click.option("--batch-size", default=1000, show_default=True)
+def delete_orphaned_articles(batch_size):
+    """
+    Delete the articles which are not used by any entry anymore.
+    """
+    n_deleted = maintenance.delete_orphaned_articles(batch_size=batch_size)
+    click.echo(f"Deleted {n_deleted} articles")
+
+
+@database_group.command("delete-old-entry-removals")
+@click.option("--batch-size", default=1000, show_default=True)
+def delete_old_entry_removals(batch_size):
+    """
+    Delete the tombstones of the entries which were removed more than
+    ENTRY_REMOVAL_RETENTION_DAYS days ago.
+    """
+    n_deleted = maintenance.delete_old_entry_removals(batch_size=batch_size)
+    click.echo(f"Deleted {n_deleted} entry removals")
+
+
+@database_group.command("convert-entries")
+@click.option("--batch-size", default=1000, show_default=True)
+def convert_entries(batch_size):
+    """
+    Move the content of the entries to the shared article table. Stop the
+    services before running this.
+    """
+    n_converted = maintenance.move_entry_content_to_articles(batch_size=batch_size)
+    click.echo(f"Converted {n_converted} entries")
+
+
+@database_group.command("compress-summaries")
+@click.option("--batch-size", default=1000, show_default=True)
+def compress_summaries(batch_size):
+    """
+    Compress the existing summaries which are larger than
+    ENTRY_SUMMARY_COMPRESSION_THRESHOLD.
+    """
+    n_compressed = maintenance.compress_summaries(batch_size=batch_size)
+    click.echo(f"Compressed {n_compressed} summaries")
+
+
+@database_group.command("delete-marked")
+@click.option("--batch-size", default=1000, show_default=True)
+def delete_marked(batch_size):
+    """
+    Remove the feeds and users which are marked as deleted.
+    """
+    n_deleted = maintenance.delete_marked_rows(batch_size=batch_size)
+    click.echo(f"Removed {n_deleted} feeds and users")
+
+
+@database_group.command("partition-entries")
+def partition_entries():
+    """
+    Convert the entry table to a partitioned table, as configured by the
+    ENTRY_PARTITIONING setting. The API and workers should be stopped first.
+    """
+    n_moved = maintenance.partition_entry_table()
+    click.echo(f"Moved {n_moved} entries")
+
+
+@database_group.command("create-partitions")
+def create_partitions():
+    """
+    Create the upcoming partitions of the entry table.
+    """
+    created = maintenance.create_entry_partitions()
+    click.echo(f"Created {len(created)} partitions")
+
+
 @cli.group("user")
 def user_group():
     """
@@ -61,11 +188,40 @@ def create_normal_user(username: str, password: str) -> None:
     create_user(username, password, is_admin=False)
 
 
+@user_group.command("import-opml")
+@click.option("--username", "-u", required=True)
+@click.argument("opml_file", type=click.File("rb"))
+def import_opml(username: str, opml_file) -> None:
+    """
+    Register all the feeds of an OPML file for a user.
+    """
+    with database.get_session() as session:
+        user = services.find_user(username, session, raise_error_if_missing=False)
+        if not user:
+            click.echo(f"User '{username}' not found.")
+            return
+
+        current_user = services.CurrentUser(
+            id=user.id, username=user.username, is_admin=user.is_admin
+        )
+
+    try:
+        urls = opml.parse_opml(opml_file.read())
+        added, existing = services.import_feeds(current_user, urls)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Added {added} feeds, {existing} were already registered")
+
+
 def create_user(username: str, password: str, *, is_admin: bool) -> None:
     User = database.User
 
     with database.get_session() as session:
-        if session.query(User).filter(User.username == username).count() != 0:
+        existing_users = session.query(User).filter(
+            User.username == username, User.deleted_at.is_(None)
+        )
+        if existing_users.count() != 0:
             click.echo(f"User '{username}' already exists.")
             return
 
@@ -1,2 +1,5 @@
 DEFAULT_ADMIN_USER = "root"
 SETTINGS_ENV_PREFIX = "FC_"
+
+# Postgres channel used to notify the API processes about new entries
+NEW_ENTRIES_CHANNEL = "feedcloud_new_entries"
@@ -1,35 +1,99 @@
+import datetime
+import time
+from typing import List, Optional
+
 import sqlalchemy as sa
 import sqlalchemy.orm
+import sqlalchemy.pool
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
-from feedcloud import settings
+from feedcloud import helpers, metrics, settings
 
 engine = None
+replica_engine = None
 Base = declarative_base()
 Session = sessionmaker()
+# Sessions for read-only queries. Bound to the replica if one is configured,
+# otherwise to the primary.
+ReadSession = sessionmaker()
+
+# Namespace of the per-feed advisory locks, see `lock_feed_entries`
+FEED_ENTRIES_LOCK_NAMESPACE = 1
 
 
 class User(Base):
     __tablename__ = "user"
-    __table_args__ = (sa.UniqueConstraint("username", name="username_idx"),)
+    # Deleted users keep their row until the cleanup is done, so only the
+    # usernames of the active users have to be unique.
+    __table_args__ = (
+        sa.Index(
+            "username_idx",
+            "username",
+            unique=True,
+            postgresql_where=sa.text("deleted_at IS NULL"),
+        ),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True)
     username = sa.Column(sa.Text, nullable=False)
     password_hash = sa.Column(sa.Text, nullable=False)
     is_admin = sa.Column(sa.Boolean, nullable=False, default=False)
 
+    # Set when the user is deleted. The user and its feeds are hidden right
+    # away, and the rows are removed in the background.
+    deleted_at = sa.Column(sa.DateTime)
+
     feeds = relationship("Feed", back_populates="user", passive_deletes=True)
 
 
 class Feed(Base):
     __tablename__ = "feed"
     __table_args__ = (
-        sa.UniqueConstraint("url", "user_id", name="url_user_id_idx"),
+        sa.Index(
+            "url_user_id_idx",
+            "url",
+            "user_id",
+            unique=True,
+            postgresql_where=sa.text("deleted_at IS NULL"),
+        ),
     )
 
     id = sa.Column(sa.Integer, primary_key=True)
     url = sa.Column(sa.Text, nullable=False)
 
+    # Imported feeds are not fetched before this time, so that a big import
+    # doesn't enqueue all of its feeds at once
+    first_fetch_at = sa.Column(sa.DateTime)
+
+    # Time of the last force-run which was queued. Further force-runs are
+    # coalesced with it for `FEED_FORCE_RUN_COALESCE_SECONDS`.
+    force_run_requested_at = sa.Column(sa.DateTime)
+
+    # Set when the scheduler enqueues a download. The feed is not enqueued again
+    # until it has run, see `Scheduler.find_feeds`.
+    enqueued_at = sa.Column(sa.DateTime)
+
+    # Set when the feed is deleted. The feed is hidden right away, and the
+    # entries and update runs are removed in the background in small batches.
+    deleted_at = sa.Column(sa.DateTime)
+
+    # Bumped by the changes which don't set a new `Entry.change_txid`: changing
+    # the feed's settings and removing its entries. Part of the data version of
+    # the API, see `services.get_data_version`.
+    version = sa.Column(sa.Integer, nullable=False, default=0, server_default="0")
+
+    # Entries published at or before this time have been purged (or archived).
+    # The publisher may still list them, so the worker doesn't save them again.
+    removed_until = sa.Column(sa.DateTime)
+
+    # Entry retention policy of the feed. NULL means the default from the
+    # `ENTRY_RETENTION_*` settings is used, and 0 disables the limit.
+    retention_max_age_days = sa.Column(sa.Integer)
+    retention_max_entries = sa.Column(sa.Integer)
+    retention_keep_unread = sa.Column(sa.Boolean)
+
     user_id = sa.Column(
         sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"), nullable=False
     )
@@ -47,7 +111,11 @@ class FeedUpdateRun(Base):
     STATUS_LIST = (FAILED, SUCCESS)
 
     __tablename__ = "feed_update_run"
-    __table_args__ = (sa.Index("feed_timestamp_idx", "feed_id", sa.desc("timestamp")),)
+    __table_args__ = (
+        sa.Index("feed_timestamp_idx", "feed_id", sa.desc("timestamp")),
+        # Used by the scheduler to measure the recent throughput of the workers
+        sa.Index("feed_update_run_timestamp_idx", "timestamp"),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True)
     timestamp = sa.Column(sa.DateTime, nullable=False)
@@ -64,6 +132,114 @@ class FeedUpdateRun(Base):
     feed = relationship("Feed", back_populates="update_runs")
 
 
+class FeedDailyStats(Base):
+    """
+    Daily totals of the update runs of a feed. Old `FeedUpdateRun` rows are
+    rolled up into this table, see `maintenance.rollup_feed_update_runs`.
+    """
+
+    __tablename__ = "feed_daily_stats"
+
+    feed_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("feed.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    day = sa.Column(sa.Date, primary_key=True)
+
+    n_success = sa.Column(sa.Integer, nullable=False, default=0)
+    n_failure = sa.Column(sa.Integer, nullable=False, default=0)
+    n_downloaded = sa.Column(sa.Integer, nullable=False, default=0)
+    n_ignored = sa.Column(sa.Integer, nullable=False, default=0)
+
+
+class SchedulerStatus(Base):
+    """
+    The state of the scheduler after its last run. The scheduler runs in its own
+    process, so it's stored here for `GET /metrics/`. There is a single row.
+    """
+
+    __tablename__ = "scheduler_status"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    # How long the most overdue feed which couldn't be enqueued has been waiting
+    lag_seconds = sa.Column(sa.Float, nullable=False)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+
+
+class CompressedText(sa.types.TypeDecorator):
+    """
+    A text column which is stored compressed once it's larger than
+    `settings.ENTRY_SUMMARY_COMPRESSION_THRESHOLD` bytes, see
+    `helpers.compress_text`.
+
+    Values are stored as bytes. Compressed and plain values can be mixed, so
+    compression can be enabled or disabled at any time. Values are only
+    decompressed when they are loaded, and the list queries don't load them.
+    """
+
+    impl = sa.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return helpers.compress_text(
+            value,
+            settings.ENTRY_SUMMARY_COMPRESSION_THRESHOLD,
+            settings.ENTRY_SUMMARY_COMPRESSION_LEVEL,
+        )
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return helpers.decompress_text(value)
+
+
+def _make_default_content_hash(context) -> str:
+    params = context.get_current_parameters()
+    return helpers.make_content_hash(params["link"], params["title"], params["summary"])
+
+
+class Article(Base):
+    """
+    The content of an entry.
+
+    The same article often shows up in several feeds, so the content is stored
+    once and shared by all of its entries. Articles are identified by a hash of
+    their normalized link and their content, see `helpers.make_content_hash`.
+    Articles without entries are removed by `maintenance.delete_orphaned_articles`.
+    """
+
+    # Columns of `Article` which can be read and set through `Entry`
+    FIELDS = ("title", "summary", "excerpt", "link")
+
+    __tablename__ = "article"
+    __table_args__ = (
+        sa.UniqueConstraint("content_hash", name="article_content_hash_idx"),
+        sa.Index("article_search_idx", "search_vector", postgresql_using="gin"),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    content_hash = sa.Column(sa.Text, nullable=False, default=_make_default_content_hash)
+    title = sa.Column(sa.Text, nullable=False)
+    summary = sa.Column(CompressedText, nullable=False)
+    # Plain-text and length-capped version of `summary` for the list endpoints
+    excerpt = sa.Column(sa.Text, nullable=False, server_default="")
+    link = sa.Column(sa.Text, nullable=False)
+    # Full-text search document, see `make_search_vector`
+    search_vector = sa.Column(TSVECTOR)
+    created_at = sa.Column(sa.DateTime, nullable=False, server_default=sa.func.now())
+
+
+def _article_field(field: str):
+    return association_proxy(
+        "article", field, creator=lambda value: Article(**{field: value})
+    )
+
+
 class Entry(Base):
     UNREAD = "unread"
     READ = "read"
@@ -72,31 +248,251 @@ class Entry(Base):
     __tablename__ = "entry"
     __table_args__ = (
         sa.UniqueConstraint("original_id", "feed_id", name="original_id_feed_idx"),
+        sa.Index("entry_feed_change_txid_idx", "feed_id", "change_txid"),
+        sa.Index("entry_feed_published_at_idx", "feed_id", sa.desc("published_at")),
+        sa.Index("entry_article_idx", "article_id"),
     )
 
     id = sa.Column(sa.Integer, primary_key=True)
 
     original_id = sa.Column(sa.Text, nullable=False)
-    title = sa.Column(sa.Text, nullable=False)
-    summary = sa.Column(sa.Text, nullable=False)
-    link = sa.Column(sa.Text, nullable=False)
     saved_at = sa.Column(sa.DateTime, nullable=False, server_default=sa.func.now())
     published_at = sa.Column(sa.DateTime, nullable=False)
 
     status = sa.Column(sa.Text, nullable=False, default=UNREAD)
+    # Transaction which saved the entry or changed its status last, see
+    # `current_txid`. Clients sync incrementally on it.
+    change_txid = sa.Column(
+        sa.BigInteger, nullable=False, server_default=sa.func.txid_current()
+    )
 
     feed_id = sa.Column(
         sa.Integer, sa.ForeignKey("feed.id", ondelete="CASCADE"), nullable=False
     )
     feed = relationship("Feed", back_populates="entries")
 
+    # The content is stored in the (shared) article. Queries need to join
+    # `Article` to filter or select these; the proxies are for ORM objects.
+    article_id = sa.Column(sa.Integer, sa.ForeignKey("article.id"), nullable=False)
+    article = relationship("Article")
+
+    title = _article_field("title")
+    summary = _article_field("summary")
+    excerpt = _article_field("excerpt")
+    link = _article_field("link")
+
+
+class EntryArchive(Base):
+    """
+    A segment of archived entries of a feed.
+
+    Old entries are moved out of the `entry` table in segments of consecutive
+    entries (by publish date), see `maintenance.archive_entries`. The entries
+    of a segment are stored together as zlib-compressed JSON. Segments are
+    never changed once written.
+    """
+
+    # Columns of `Entry` which are kept in the archive
+    FIELDS = (
+        "id",
+        "original_id",
+        "title",
+        "summary",
+        "excerpt",
+        "link",
+        "saved_at",
+        "published_at",
+        "status",
+    )
+
+    __tablename__ = "entry_archive"
+    __table_args__ = (
+        sa.Index(
+            "entry_archive_feed_published_at_idx",
+            "feed_id",
+            sa.desc("last_published_at"),
+        ),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    first_published_at = sa.Column(sa.DateTime, nullable=False)
+    last_published_at = sa.Column(sa.DateTime, nullable=False)
+    n_entries = sa.Column(sa.Integer, nullable=False)
+    created_at = sa.Column(sa.DateTime, nullable=False, server_default=sa.func.now())
+    payload = sa.Column(sa.LargeBinary, nullable=False)
+
+    feed_id = sa.Column(
+        sa.Integer, sa.ForeignKey("feed.id", ondelete="CASCADE"), nullable=False
+    )
+
+
+class EntryRemoval(Base):
+    __tablename__ = "entry_removal"
+    __table_args__ = (
+        sa.Index("entry_removal_user_change_txid_idx", "user_id", "change_txid"),
+        sa.Index("entry_removal_removed_at_idx", "removed_at"),
+    )
+
+    # Tombstone of entries which were purged, archived or deleted with their
+    # feed, so that clients which sync incrementally remove them as well. A
+    # NULL `entry_id` stands for all the entries of the feed. The feed can be
+    # gone already, so the user is stored too.
+    id = sa.Column(sa.Integer, primary_key=True)
+    entry_id = sa.Column(sa.Integer)
+    feed_id = sa.Column(sa.Integer, nullable=False)
+    user_id = sa.Column(
+        sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    )
+    change_txid = sa.Column(
+        sa.BigInteger, nullable=False, server_default=sa.func.txid_current()
+    )
+    removed_at = sa.Column(sa.DateTime, nullable=False, server_default=sa.func.now())
+
+
+def current_txid() -> sa.sql.ColumnElement:
+    """
+    Return the SQL expression for the ID of the current transaction, which is
+    stored with each change of the entries (`Entry.change_txid` and
+    `EntryRemoval.change_txid`).
+    """
+    return sa.func.txid_current()
+
+
+def committed_txid_limit() -> sa.sql.ColumnElement:
+    """
+    Return the SQL expression for the ID of the oldest transaction which is still
+    running. All the transactions with a lower ID have ended, so no change with a
+    lower `change_txid` can be committed anymore.
+
+    Transaction IDs are assigned in the order the transactions start writing,
+    not in the order they commit. Incremental sync only returns the changes
+    below this limit, so a client never moves past a change which becomes
+    visible later. Unlike serializing the writers, this only delays the sync
+    while a transaction is running.
+    """
+    return sa.func.txid_snapshot_xmin(sa.func.txid_current_snapshot())
+
+
+def lock_feed_entries(session: sqlalchemy.orm.Session, feed_id: int) -> None:
+    """
+    Take the lock which must be held while new entries of a feed are saved.
+    It's held until the transaction ends.
+
+    The same feed can be downloaded by several workers at the same time (e.g. a
+    force-run and a scheduled run). With the lock, one checks for existing
+    entries only after the other has committed its entries.
+    """
+    session.execute(
+        sa.select(sa.func.pg_advisory_xact_lock(FEED_ENTRIES_LOCK_NAMESPACE, feed_id))
+    )
+
+
+def make_search_vector(title, text) -> sa.sql.ColumnElement:
+    """
+    Build the SQL expression for `Article.search_vector`. Matches in the title are
+    weighted higher than matches in the text.
+    """
+    config = settings.SEARCH_TEXT_CONFIG
+    title_vector = sa.func.setweight(sa.func.to_tsvector(config, title), "A")
+    text_vector = sa.func.setweight(sa.func.to_tsvector(config, text), "B")
+    return title_vector.op("||")(text_vector)
+
+
+def make_search_query(query: str) -> sa.sql.ColumnElement:
+    """
+    Build a `tsquery` from a search string written by a user.
+    """
+    return sa.func.websearch_to_tsquery(settings.SEARCH_TEXT_CONFIG, query)
+
+
+class InstrumentedQueuePool(sa.pool.QueuePool):
+    """
+    A QueuePool which records in `metrics` how long it takes to check out a
+    connection. Slow checkouts mean that the pool is exhausted and callers are
+    waiting for a connection to be returned.
+    """
+
+    metrics_name = "db.pool"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sa.exc.TimeoutError:
+            metrics.increment(f"{self.metrics_name}.timeouts")
+            raise
+        finally:
+            metrics.observe(f"{self.metrics_name}.checkout", time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_name = self.metrics_name
+        return pool
+
+
+def create_engine(url: str, *, metrics_name: str) -> sa.engine.Engine:
+    """
+    Create an engine with the pool settings from `feedcloud.settings`.
+    """
+    new_engine = sa.create_engine(
+        url,
+        echo=False,
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.DATABASE_POOL_SIZE,
+        max_overflow=settings.DATABASE_MAX_OVERFLOW,
+        pool_timeout=settings.DATABASE_POOL_TIMEOUT_SECONDS,
+        pool_recycle=settings.DATABASE_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+    )
+    new_engine.pool.metrics_name = metrics_name
+    return new_engine
+
+
+def get_pool_status() -> dict:
+    """
+    Return the current usage of the connection pools.
+    """
+    status = {}
+    for name, e in (("primary", engine), ("replica", replica_engine)):
+        if e is None:
+            continue
+
+        status[name] = dict(
+            size=e.pool.size(),
+            checked_out=e.pool.checkedout(),
+            overflow=e.pool.overflow(),
+        )
+
+    return status
+
 
 def configure():
-    global engine
+    global engine, replica_engine
     if not engine:
-        engine = sa.create_engine(settings.DATABASE_URL, echo=False)
+        engine = create_engine(settings.DATABASE_URL, metrics_name="db.pool")
         Session.configure(bind=engine)
 
+        if settings.DATABASE_REPLICA_URL:
+            replica_engine = create_engine(
+                settings.DATABASE_REPLICA_URL, metrics_name="db.replica_pool"
+            )
+            ReadSession.configure(bind=replica_engine)
+        else:
+            ReadSession.configure(bind=engine)
+
+
+def reset():
+    """
+    Dispose the engines, so that the next call to `configure` creates them
+    again from the current settings.
+    """
+    global engine, replica_engine
+    for e in (engine, replica_engine):
+        if e is not None:
+            e.dispose()
+
+    engine = replica_engine = None
+
 
 def drop_all():
     configure()
@@ -105,9 +501,183 @@ def drop_all():
 
 def create_all():
     configure()
-    Base.metadata.create_all(engine)
+    if not settings.ENTRY_PARTITIONING:
+        Base.metadata.create_all(engine)
+        return
+
+    with engine.begin() as connection:
+        make_partitioned_metadata().create_all(connection)
+        create_entry_partitions(connection)
+
+
+def make_partitioned_metadata() -> sa.MetaData:
+    """
+    Return a copy of the metadata in which the `entry` table is partitioned as
+    configured by `settings.ENTRY_PARTITIONING`: "hash" on `feed_id` or "range"
+    on `saved_at`.
+
+    Postgres requires the partition key to be part of every unique constraint,
+    so the primary key becomes (id, <partition key>). With range partitioning
+    the (original_id, feed_id) constraint can't be enforced anymore; it becomes
+    a plain index and duplicates are only prevented by `FeedWorker`, which
+    saves the entries of a feed under `lock_feed_entries`.
+    """
+    method = settings.ENTRY_PARTITIONING
+    if method == "hash":
+        key = "feed_id"
+    elif method == "range":
+        key = "saved_at"
+    else:
+        raise ValueError(f"Invalid entry partitioning method: {method}")
+
+    metadata = sa.MetaData()
+    for table in Base.metadata.sorted_tables:
+        table.to_metadata(metadata)
+
+    entry = metadata.tables["entry"]
+    entry.dialect_options["postgresql"]["partition_by"] = f"{method.upper()} ({key})"
+
+    entry.c.id.autoincrement = True
+    entry.c[key].primary_key = True
+    entry.append_constraint(sa.PrimaryKeyConstraint(entry.c.id, entry.c[key]))
+
+    if method == "range":
+        [unique] = [c for c in entry.constraints if c.name == "original_id_feed_idx"]
+        entry.constraints.remove(unique)
+        sa.Index("original_id_feed_idx", entry.c.feed_id, entry.c.original_id)
+
+    return metadata
+
+
+def create_entry_partitions(
+    connection: sa.engine.Connection, *, since: Optional[datetime.date] = None
+) -> List[str]:
+    """
+    Create the missing partitions of the `entry` table and return their names.
+
+    With hash partitioning there are `ENTRY_HASH_PARTITIONS` partitions, which
+    are all created up front. With range partitioning there is one partition
+    per month, from the month of `since` (default: today) up to
+    `ENTRY_PARTITION_MONTHS_AHEAD` months ahead, plus a default partition for
+    any rows outside of those. The scheduler runs this with the maintenance
+    tasks, so the partitions exist before they're needed.
+
+    Postgres doesn't allow creating a partition while the default partition has
+    rows for its range. If that happened anyway (e.g. because the maintenance
+    tasks didn't run for a while), these rows are moved to the new partition.
+
+    Indexes are defined on the `entry` table, and Postgres creates them on each
+    new partition automatically.
+    """
+    existing = set(
+        connection.execute(
+            sa.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'entry'::regclass"
+            )
+        ).scalars()
+    )
+
+    partitions = {}
+    # Ranges of the range partitions, to move rows out of the default partition
+    ranges = {}
+    if settings.ENTRY_PARTITIONING == "hash":
+        modulus = settings.ENTRY_HASH_PARTITIONS
+        for remainder in range(modulus):
+            partitions[f"entry_p{remainder}"] = (
+                f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})"
+            )
+    else:
+        today = datetime.date.today()
+        month = (since or today).replace(day=1)
+        last_month = _add_months(
+            today.replace(day=1), settings.ENTRY_PARTITION_MONTHS_AHEAD
+        )
+
+        while month <= last_month:
+            next_month = _add_months(month, 1)
+            name = f"entry_{month:%Y_%m}"
+            partitions[name] = f"FOR VALUES FROM ('{month}') TO ('{next_month}')"
+            ranges[name] = (month, next_month)
+            month = next_month
+
+        partitions["entry_default"] = "DEFAULT"
+
+    created = []
+    for name, bounds in partitions.items():
+        if name in existing:
+            continue
+
+        if name in ranges and "entry_default" in existing:
+            _create_partition_from_default(connection, name, bounds, *ranges[name])
+        else:
+            connection.execute(
+                sa.text(f"CREATE TABLE {name} PARTITION OF entry {bounds}")
+            )
+        created.append(name)
+
+    return created
+
+
+def _create_partition_from_default(
+    connection: sa.engine.Connection,
+    name: str,
+    bounds: str,
+    start: datetime.date,
+    end: datetime.date,
+) -> None:
+    """
+    Create a range partition, moving its rows out of the default partition
+    first. Everything happens in the caller's transaction, so the rows never
+    disappear for other transactions.
+    """
+    columns = ", ".join(c.name for c in Base.metadata.tables["entry"].columns)
+    params = dict(start=start, end=end)
+    in_range = "saved_at >= :start AND saved_at < :end"
+
+    connection.execute(sa.text("LOCK TABLE entry_default IN EXCLUSIVE MODE"))
+    connection.execute(
+        sa.text(
+            f"CREATE TEMPORARY TABLE moved_entry AS "
+            f"SELECT {columns} FROM entry_default WHERE {in_range}"
+        ),
+        params,
+    )
+    connection.execute(sa.text(f"DELETE FROM entry_default WHERE {in_range}"), params)
+    connection.execute(sa.text(f"CREATE TABLE {name} PARTITION OF entry {bounds}"))
+    connection.execute(
+        sa.text(f"INSERT INTO entry ({columns}) SELECT {columns} FROM moved_entry")
+    )
+    connection.execute(sa.text("DROP TABLE moved_entry"))
+
+
+def _add_months(month: datetime.date, n_months: int) -> datetime.date:
+    year, month_index = divmod(month.month - 1 + n_months, 12)
+    return month.replace(year=month.year + year, month=month_index + 1)
 
 
 def get_session() -> sqlalchemy.orm.Session:
     configure()
     return Session()
+
+
+def get_read_session() -> sqlalchemy.orm.Session:
+    """
+    Return a session for read-only queries, which uses the replica database if
+    `DATABASE_REPLICA_URL` is set. The replica may lag behind the primary.
+    """
+    configure()
+    return ReadSession()
+
+
+def connect_unpooled():
+    """
+    Open a DBAPI connection which is not managed by the connection pool.
+
+    This is meant for long-lived connections (e.g. `LISTEN`) which should not
+    hold a connection from the pool forever.
+    """
+    configure()
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    return engine.dialect.connect(*cargs, **cparams)
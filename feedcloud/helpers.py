@@ -1,14 +1,252 @@
 import base64
+import binascii
+import collections
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+import zlib
+from html.parser import HTMLParser
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 
 import bcrypt
 
+from feedcloud import settings
 
-def hash_password(password: str) -> str:
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    """
+    Hash a password with bcrypt. The cost factor defaults to
+    `settings.PASSWORD_HASH_ROUNDS`.
+    """
     password_bytes = password.encode("utf-8")
-    hash = bcrypt.hashpw(password_bytes, bcrypt.gensalt())
+    salt = bcrypt.gensalt(rounds or settings.PASSWORD_HASH_ROUNDS)
+    hash = bcrypt.hashpw(password_bytes, salt)
     return base64.b64encode(hash).decode("utf-8")
 
 
 def check_password(plain_text_password: str, hashed_password: str) -> bool:
     hash = base64.b64decode(hashed_password)
     return bcrypt.checkpw(plain_text_password.encode("utf-8"), hash)
+
+
+def password_needs_rehash(hashed_password: str, rounds: Optional[int] = None) -> bool:
+    """
+    Return True if the password hash was made with a different cost factor than
+    `rounds`, which defaults to `settings.PASSWORD_HASH_ROUNDS`.
+    """
+    # A bcrypt hash looks like `$2b$<rounds>$<salt and hash>`
+    hash = base64.b64decode(hashed_password)
+    current_rounds = int(hash.split(b"$")[2])
+    return current_rounds != (rounds or settings.PASSWORD_HASH_ROUNDS)
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collect the text content of an HTML document, ignoring scripts and styles.
+    """
+
+    SKIPPED_TAGS = {"script", "style"}
+    BLOCK_TAGS = set(
+        "address article aside blockquote br dd div dl dt figcaption figure "
+        "footer h1 h2 h3 h4 h5 h6 header hr li main nav ol p pre section table "
+        "td th tr ul".split()
+    )
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """
+    Strip the tags from an HTML fragment and return its plain text, with
+    whitespace collapsed.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return " ".join("".join(parser.parts).split())
+
+
+def make_excerpt(html: str, max_length: int) -> str:
+    """
+    Make a plain-text excerpt of an HTML fragment which is at most `max_length`
+    characters long. Long texts are cut at a word boundary when possible.
+    """
+    text = html_to_text(html)
+    if len(text) <= max_length:
+        return text
+
+    cut = text[: max_length - 1]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+
+    return cut.rstrip() + "…"
+
+
+# Query parameters which only track where a visitor came from
+_TRACKING_PARAMETERS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+
+def normalize_link(link: str) -> str:
+    """
+    Normalize a link, so that the links of the same article in different feeds
+    compare equal: the scheme and host are lower-cased, and the fragment and
+    the tracking parameters are removed.
+    """
+    parts = urllib.parse.urlsplit(link.strip())
+    query = [
+        (key, value)
+        for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(_TRACKING_PARAMETERS)
+    ]
+    return urllib.parse.urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path,
+            urllib.parse.urlencode(query),
+            "",
+        )
+    )
+
+
+def make_content_hash(link: str, title: str, summary: str) -> str:
+    """
+    Return the hash which identifies an article, made of its normalized link
+    and its content.
+    """
+    data = json.dumps([normalize_link(link), title.strip(), summary.strip()])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Encode the position of the last item of a page as an opaque cursor string.
+    """
+    data = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """
+    Decode a cursor made by `encode_cursor`. Raise `ValueError` if it is invalid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+
+    return values
+
+
+def compress_json(value: Any) -> bytes:
+    """
+    Serialize a value to JSON and compress it with zlib.
+    """
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(data, 9)
+
+
+def decompress_json(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+# Prefix of the values made by `compress_text`. It never occurs in UTF-8.
+_COMPRESSED_TEXT_MARKER = b"\xff"
+
+
+def compress_text(text: str, min_size: int, level: int = 6) -> bytes:
+    """
+    Encode a text as UTF-8, and compress it with zlib if it's at least
+    `min_size` bytes long (0 disables compression) and compression saves space.
+    Compressed values start with a marker byte, so `decompress_text` can read
+    both kinds.
+    """
+    data = text.encode("utf-8")
+    if not min_size or len(data) < min_size:
+        return data
+
+    compressed = _COMPRESSED_TEXT_MARKER + zlib.compress(data, level)
+    if len(compressed) >= len(data):
+        return data
+
+    return compressed
+
+
+def decompress_text(data: bytes) -> str:
+    if data[:1] == _COMPRESSED_TEXT_MARKER:
+        data = zlib.decompress(data[1:])
+
+    return data.decode("utf-8")
+
+
+class TTLCache:
+    """
+    A thread-safe cache which holds at most `max_size` items, each for at most
+    `ttl` seconds. When the cache is full, the least recently used item is
+    evicted.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items: Dict[Hashable, Tuple[float, Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
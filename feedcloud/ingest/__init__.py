@@ -1,3 +1,3 @@
-from .tasks import download_feed  # noqa
+from .tasks import delete_feed, delete_user, download_feed, force_download_feed  # noqa
 
-all = ["download_feed"]
+all = ["delete_feed", "delete_user", "download_feed", "force_download_feed"]
@@ -1,17 +1,22 @@
+import collections
 import datetime
 import logging
 import time
-from typing import List
+from typing import List, Optional
 
 import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.dialects import postgresql
 
-from feedcloud import database, settings
+from feedcloud import database, metrics, settings
 from feedcloud.database import Feed, FeedUpdateRun
 
 from . import tasks
 
 logger = logging.getLogger("feedcloud.Scheduler")
 
+DueFeed = collections.namedtuple("DueFeed", "id due_at")
+
 
 class Scheduler:
     """
@@ -19,9 +24,22 @@ class Scheduler:
     schedules them for download.
 
     The actual download happens through the async workers in the background.
+    The scheduler only fills the download queue up to a backlog target which
+    follows the recent throughput of the workers. The due feeds which don't fit
+    are carried over to the next run, most overdue first.
+
+    The maintenance tasks are also scheduled from here, every
+    `MAINTENANCE_INTERVAL_SECONDS`.
     """
 
+    def __init__(self):
+        self._last_maintenance_at = None
+
     def run_forever(self):
+        # The scheduler doesn't serve `GET /metrics/`, so its metrics are logged
+        if settings.METRICS_LOG_INTERVAL_SECONDS > 0:
+            metrics.start_logging(settings.METRICS_LOG_INTERVAL_SECONDS)
+
         while True:
             try:
                 self.run_once()
@@ -32,53 +50,202 @@ class Scheduler:
 
     def run_once(self):
         logger.info("Going to pick up feeds...")
-        feeds = self.find_feeds()
-        logger.info(f"Found {len(feeds)} feed(s).")
+        limit = self.get_enqueue_limit()
+        now = datetime.datetime.now()
+
+        with database.get_session() as session:
+            feeds = self._find_due_feeds(session, limit=limit)
+            if feeds:
+                session.execute(
+                    sa.update(Feed)
+                    .where(Feed.id.in_([feed.id for feed in feeds]))
+                    .values(enqueued_at=now)
+                )
+                session.commit()
 
+        max_lag = 0.0
         for feed in feeds:
             tasks.download_feed.send(feed.id)
 
-    def find_feeds(self) -> List[Feed]:
+            # Time the feed has waited since it was due
+            if feed.due_at is not None:
+                lag = max((now - feed.due_at).total_seconds(), 0)
+                metrics.observe("scheduler.lag", lag)
+                max_lag = max(max_lag, lag)
+
+        metrics.increment("scheduler.enqueued", len(feeds))
+        carried_over_lag = self.get_lag()
+        self._save_status(carried_over_lag)
+        logger.info(
+            f"Enqueued {len(feeds)} feed(s), max lag: {max_lag:.0f}s, "
+            f"lag of the carried over feeds: {carried_over_lag:.0f}s."
+        )
+
+        self.schedule_maintenance()
+
+    def get_enqueue_limit(self) -> int:
         """
-        Find feeds that are ready to be downloaded.
+        Return how many feeds can be enqueued, which is the backlog target minus
+        the messages already waiting in the download queue.
 
-        This uses a LATERAL JOIN to find the last FeedUpdateRun for each
-        feed and check the values there.
+        The target is `TASK_SCHEDULER_BACKLOG_INTERVALS` scheduler intervals of
+        the update runs finished recently. If the workers are faster than that,
+        they empty the queue and finish more runs, so the target grows.
         """
+        window = settings.TASK_SCHEDULER_THROUGHPUT_WINDOW_SECONDS
+        since = datetime.datetime.now() - datetime.timedelta(seconds=window)
+
         with database.get_session() as session:
-            last_run_subq = (
-                session.query(FeedUpdateRun)
-                .filter(FeedUpdateRun.feed_id == Feed.id)
-                .order_by(FeedUpdateRun.timestamp.desc())
-                .limit(1)
-                .subquery()
-                .lateral()
+            n_runs = (
+                session.query(sa.func.count(FeedUpdateRun.id))
+                .filter(FeedUpdateRun.timestamp >= since)
+                .scalar()
             )
 
-            last_run = sa.alias(last_run_subq, "last_run")
-
-            # For each feed:
-            #    There should be no last run OR
-            #    a successful last run OR
-            #    a failed one which has a schedule date before 'now'
-            query = (
-                session.query(Feed, last_run)
-                .outerjoin(last_run, Feed.id == last_run.c.feed_id)
-                .filter(
-                    sa.or_(
-                        last_run.c.id == None,  # noqa  ('is None' won't work here)
-                        last_run.c.status != FeedUpdateRun.FAILED,
-                        sa.and_(
-                            last_run.c.status == FeedUpdateRun.FAILED,
-                            last_run.c.next_run_schedule
-                            != None,  # noqa (Same with None)
-                            last_run.c.next_run_schedule < datetime.datetime.now(),
-                        ),
-                    )
+        runs_per_interval = n_runs / window * settings.TASK_SCHEDULER_INTERVAL_SECONDS
+        target = runs_per_interval * settings.TASK_SCHEDULER_BACKLOG_INTERVALS
+        target = min(
+            max(int(target), settings.TASK_SCHEDULER_MIN_BACKLOG),
+            settings.TASK_SCHEDULER_MAX_BACKLOG,
+        )
+
+        backlog = tasks.get_queue_size(tasks.SCHEDULED_QUEUE)
+        logger.info(f"Download queue: {backlog} message(s), target: {target}.")
+
+        return max(target - backlog, 0)
+
+    def schedule_maintenance(self):
+        now = time.monotonic()
+        if (
+            self._last_maintenance_at is not None
+            and now - self._last_maintenance_at < settings.MAINTENANCE_INTERVAL_SECONDS
+        ):
+            return
+
+        logger.info("Scheduling maintenance tasks...")
+        tasks.rollup_feed_update_runs.send()
+        tasks.purge_entries.send()
+        tasks.archive_entries.send()
+        tasks.delete_orphaned_articles.send()
+        tasks.delete_old_entry_removals.send()
+        tasks.delete_marked_rows.send()
+        if settings.ENTRY_PARTITIONING == "range":
+            tasks.create_entry_partitions.send()
+        self._last_maintenance_at = now
+
+    def find_feeds(self, *, limit: Optional[int] = None) -> List[DueFeed]:
+        """
+        Find feeds that are ready to be downloaded, most overdue first.
+        """
+        with database.get_session() as session:
+            return self._find_due_feeds(session, limit=limit)
+
+    def get_lag(self) -> float:
+        """
+        Return how many seconds the most overdue feed which is still waiting to
+        be enqueued has been due, or 0 if no feed is waiting.
+        """
+        with database.get_session() as session:
+            due_feeds = self._query_due_feeds(session).subquery()
+            oldest_due_at = session.query(sa.func.min(due_feeds.c.due_at)).scalar()
+
+        if oldest_due_at is None:
+            return 0.0
+
+        return max((datetime.datetime.now() - oldest_due_at).total_seconds(), 0.0)
+
+    def _save_status(self, lag: float) -> None:
+        """
+        Store the lag for `GET /metrics/`, which runs in the API processes.
+        """
+        SchedulerStatus = database.SchedulerStatus
+        values = dict(id=1, lag_seconds=lag, updated_at=datetime.datetime.now())
+
+        with database.get_session() as session:
+            session.execute(
+                postgresql.insert(SchedulerStatus)
+                .values(values)
+                .on_conflict_do_update(index_elements=["id"], set_=values)
+            )
+            session.commit()
+
+    def _find_due_feeds(
+        self, session: sqlalchemy.orm.Session, *, limit: Optional[int] = None
+    ) -> List[DueFeed]:
+        query = self._query_due_feeds(session)
+        due_at = sa.literal_column("due_at")
+        query = query.order_by(sa.nullsfirst(due_at), Feed.id).limit(limit)
+        return [DueFeed(id=row.id, due_at=row.due_at) for row in query.all()]
+
+    def _query_due_feeds(self, session: sqlalchemy.orm.Session) -> sqlalchemy.orm.Query:
+        """
+        Return a query of the IDs and due times of the feeds which are ready to
+        be downloaded.
+
+        This uses a LATERAL JOIN to find the last FeedUpdateRun for each
+        feed and check the values there.
+        """
+        now = datetime.datetime.now()
+        enqueue_timeout = datetime.timedelta(
+            seconds=settings.TASK_SCHEDULER_ENQUEUE_TIMEOUT_SECONDS
+        )
+
+        last_run_subq = (
+            session.query(FeedUpdateRun)
+            .filter(FeedUpdateRun.feed_id == Feed.id)
+            .order_by(FeedUpdateRun.timestamp.desc())
+            .limit(1)
+            .subquery()
+            .lateral()
+        )
+
+        last_run = sa.alias(last_run_subq, "last_run")
+
+        # Feeds which never ran are due at their first fetch time (or right
+        # away), failed ones at their next run schedule and the others since
+        # their last run.
+        due_at = sa.case(
+            (last_run.c.id == None, Feed.first_fetch_at),  # noqa
+            (last_run.c.status == FeedUpdateRun.FAILED, last_run.c.next_run_schedule),
+            else_=last_run.c.timestamp,
+        )
+
+        # For each feed:
+        #    There should be no last run OR
+        #    a successful last run OR
+        #    a failed one which has a schedule date before 'now'
+        # and it shouldn't be waiting in the queue already.
+        query = (
+            session.query(Feed.id, due_at.label("due_at"))
+            .outerjoin(last_run, Feed.id == last_run.c.feed_id)
+            .filter(Feed.deleted_at.is_(None))
+            .filter(
+                sa.or_(
+                    Feed.first_fetch_at == None,  # noqa
+                    Feed.first_fetch_at <= now,
+                )
+            )
+            .filter(
+                sa.or_(
+                    last_run.c.id == None,  # noqa  ('is None' won't work here)
+                    last_run.c.status != FeedUpdateRun.FAILED,
+                    sa.and_(
+                        last_run.c.status == FeedUpdateRun.FAILED,
+                        last_run.c.next_run_schedule != None,  # noqa (Same with None)
+                        last_run.c.next_run_schedule < now,
+                    ),
+                )
+            )
+            .filter(
+                sa.or_(
+                    Feed.enqueued_at == None,  # noqa
+                    Feed.enqueued_at < now - enqueue_timeout,
+                    last_run.c.timestamp >= Feed.enqueued_at,
                 )
             )
+        )
 
-            return [row[0] for row in query.all()]
+        return query
 
 
 if __name__ == "__main__":
@@ -3,8 +3,9 @@ import logging
 import dramatiq
 from dramatiq.brokers.rabbitmq import RabbitmqBroker
 from dramatiq.brokers.stub import StubBroker
+from dramatiq.common import dq_name
 
-from feedcloud import database, settings
+from feedcloud import database, maintenance, metrics, settings
 from feedcloud.database import Feed
 
 from .parser import download_entries
@@ -13,22 +14,79 @@ from .worker import FeedWorker
 logger = logging.getLogger("feedcloud.Tasks")
 
 
+class MetricsLogging(dramatiq.Middleware):
+    """
+    Log the metrics of each worker process periodically, including the usage of
+    its connection pool. Only the API process serves `GET /metrics/`.
+    """
+
+    def after_worker_boot(self, broker, worker):
+        if settings.METRICS_LOG_INTERVAL_SECONDS > 0:
+            metrics.start_logging(
+                settings.METRICS_LOG_INTERVAL_SECONDS,
+                extra=lambda: dict(pools=database.get_pool_status()),
+            )
+
+
 if settings.IS_TESTING:
     broker = StubBroker(middleware=[])
     broker.emit_after("process_boot")
     dramatiq.set_broker(broker)
 else:
     broker = RabbitmqBroker(url=settings.BROKER_URL)
+    broker.add_middleware(MetricsLogging())
     dramatiq.set_broker(broker)
 
 
+# Work is split over three queues, so that each class of work can get its own
+# worker capacity (see docker-compose.prod.yml) and a user's force-run doesn't
+# wait behind the scheduler's backlog. Actors with a lower priority value are
+# also preferred by workers which consume more than one queue.
+#
+# The scheduled downloads keep using the "default" queue, so that no messages
+# are lost on upgrade.
+INTERACTIVE_QUEUE = "interactive"
+SCHEDULED_QUEUE = "default"
+BACKFILL_QUEUE = "backfill"
+
+
+def get_queue_size(queue_name: str) -> int:
+    """
+    Return the number of messages waiting in a queue, including the delayed
+    ones.
+    """
+    broker = dramatiq.get_broker()
+    if isinstance(broker, StubBroker):
+        queues = [broker.queues.get(name) for name in (queue_name, dq_name(queue_name))]
+        return sum(queue.qsize() for queue in queues if queue is not None)
+
+    ready, delayed, _ = broker.get_queue_message_counts(queue_name)
+    return ready + delayed
+
+
 # Setting max_retries to zero because FeedWorker and the Scheduler have
 # their own retry mechanism.
-@dramatiq.actor(max_retries=0)
+@dramatiq.actor(max_retries=0, queue_name=SCHEDULED_QUEUE, priority=10)
 def download_feed(feed_id):
+    _download_feed(feed_id)
+
+
+@dramatiq.actor(max_retries=0, queue_name=INTERACTIVE_QUEUE, priority=0)
+def force_download_feed(feed_id):
+    """
+    Download a feed on request of its user.
+    """
+    _download_feed(feed_id)
+
+
+def _download_feed(feed_id):
     logger.info(f"Downloading feed {feed_id}")
     with database.get_session() as session:
-        feed = session.query(Feed).filter(Feed.id == feed_id).one_or_none()
+        feed = (
+            session.query(Feed)
+            .filter(Feed.id == feed_id, Feed.deleted_at.is_(None))
+            .one_or_none()
+        )
         if not feed:
             logger.warn(f"Feed not found: feed_id={feed_id}")
             return
@@ -37,6 +95,7 @@ def download_feed(feed_id):
             feed,
             downloader=download_entries,
             failure_notifier=notify_user_on_failure.send,
+            session=session,
         )
         worker.start()
 
@@ -49,3 +108,48 @@ def notify_user_on_failure(feed_id):
     Simulate sending a notification to user about feed failure.
     """
     logger.info(f"Feed {feed_id} failed. Notifying user...")
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def rollup_feed_update_runs():
+    maintenance.rollup_feed_update_runs()
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def purge_entries():
+    maintenance.purge_entries()
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def archive_entries():
+    maintenance.archive_entries()
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def create_entry_partitions():
+    maintenance.create_entry_partitions()
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def delete_orphaned_articles():
+    maintenance.delete_orphaned_articles()
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def delete_old_entry_removals():
+    maintenance.delete_old_entry_removals()
+
+
+@dramatiq.actor(max_retries=3, queue_name=BACKFILL_QUEUE, priority=100)
+def delete_feed(feed_id):
+    maintenance.delete_feed(feed_id)
+
+
+@dramatiq.actor(max_retries=3, queue_name=BACKFILL_QUEUE, priority=100)
+def delete_user(user_id):
+    maintenance.delete_user(user_id)
+
+
+@dramatiq.actor(max_retries=0, queue_name=BACKFILL_QUEUE, priority=100)
+def delete_marked_rows():
+    maintenance.delete_marked_rows()
@@ -1,11 +1,14 @@
 import datetime
+import json
 import logging
 import time
-from typing import Iterable, Optional
+from typing import Dict, Iterable, Optional
 
+import sqlalchemy as sa
 import sqlalchemy.orm
+from sqlalchemy.dialects import postgresql
 
-from feedcloud import database, settings
+from feedcloud import constants, database, helpers, settings
 
 from .parser import ParseError
 from .types import FailureNotifier, FeedDownloader, FeedEntry
@@ -25,46 +28,70 @@ class FeedWorker:
         downloader: FeedDownloader,
         *,
         failure_notifier: FailureNotifier = None,
+        session: Optional[sqlalchemy.orm.Session] = None,
     ):
+        """
+        If `session` is given, it's used (and committed) instead of opening a
+        new one, so a task needs a single database connection.
+        """
         self.feed = feed
         self.downloader = downloader
         self.failure_notifier = failure_notifier
+        self.session = session
 
     def start(self):
+        if self.session is not None:
+            self._run(self.session)
+            return
+
         with database.get_session() as session:
-            try:
-                entries = self.downloader(self.feed.url)
-            except ParseError:
-                logger.exception("Failed to read entries from the feed")
-                self._save_failure_run(session)
-                session.commit()
-                return
-
-            self.save_entries(session, entries)
+            self._run(session)
+
+    def _run(self, session: sqlalchemy.orm.Session) -> None:
+        # End the current transaction, so the connection goes back to the pool
+        # while the feed is being downloaded.
+        url = self.feed.url
+        session.commit()
+
+        try:
+            entries = self.downloader(url)
+        except ParseError:
+            logger.exception("Failed to read entries from the feed")
+            self._save_failure_run(session)
             session.commit()
+            return
+
+        self.save_entries(session, entries)
+        session.commit()
 
     def save_entries(
         self, session: sqlalchemy.orm.Session, entries: Iterable[FeedEntry]
     ) -> None:
-        n_downloaded = 0
         n_ignored = 0
+        new_entries = {}
+
+        database.lock_feed_entries(session, self.feed.id)
+        removed_until = (
+            session.query(database.Feed.removed_until)
+            .filter(database.Feed.id == self.feed.id)
+            .scalar()
+        )
 
         for entry in entries:
-            if self.does_entry_exist(session, entry.id):
+            if (
+                entry.id in new_entries
+                or self.was_entry_removed(entry, removed_until)
+                or self.does_entry_exist(session, entry.id)
+            ):
                 n_ignored += 1
                 continue
 
-            published_date = self._make_datetime(entry.published_parsed)
-            db_entry = database.Entry(
-                feed_id=self.feed.id,
-                original_id=entry.id,
-                title=entry.title,
-                summary=entry.description,
-                link=entry.link,
-                published_at=published_date,
-            )
-            session.add(db_entry)
-            n_downloaded += 1
+            new_entries[entry.id] = entry
+
+        n_downloaded = self._insert_entries(session, new_entries.values())
+        n_ignored += len(new_entries) - n_downloaded
+        if n_downloaded:
+            self._notify_new_entries(session, n_downloaded)
 
         self._save_success_run(
             session,
@@ -72,6 +99,115 @@ class FeedWorker:
             n_ignored=n_ignored,
         )
 
+    def _insert_entries(
+        self, session: sqlalchemy.orm.Session, entries: Iterable[FeedEntry]
+    ) -> int:
+        """
+        Insert the entries and return how many were inserted.
+
+        Entries which were saved by another transaction in the meantime are
+        skipped (ON CONFLICT DO NOTHING) instead of failing the whole run.
+        """
+        entries = list(entries)
+        if not entries:
+            return 0
+
+        article_ids = self._resolve_articles(session, entries)
+        values = [
+            dict(
+                feed_id=self.feed.id,
+                original_id=entry.id,
+                article_id=article_ids[self._make_content_hash(entry)],
+                published_at=self._make_datetime(entry.published_parsed),
+            )
+            for entry in entries
+        ]
+
+        inserted = session.execute(
+            postgresql.insert(database.Entry)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(database.Entry.id)
+        )
+        return len(inserted.all())
+
+    def _resolve_articles(
+        self, session: sqlalchemy.orm.Session, entries: Iterable[FeedEntry]
+    ) -> Dict[str, int]:
+        """
+        Return the article IDs of the entries, keyed by their content hash. The
+        missing articles are inserted, all in a single statement.
+
+        The articles are locked (FOR KEY SHARE) until the transaction ends, so
+        they can't be removed as orphans before the new entries are saved.
+        """
+        Article = database.Article
+        entries_by_hash = {self._make_content_hash(e): e for e in entries}
+        if not entries_by_hash:
+            return {}
+
+        def find_articles(hashes):
+            rows = session.execute(
+                sa.select(Article.content_hash, Article.id)
+                .where(Article.content_hash.in_(hashes))
+                .with_for_update(key_share=True, read=True)
+            )
+            return dict(rows.all())
+
+        article_ids = find_articles(list(entries_by_hash))
+
+        missing = [h for h in entries_by_hash if h not in article_ids]
+        if missing:
+            values = [
+                self._make_article(content_hash, entries_by_hash[content_hash])
+                for content_hash in missing
+            ]
+            session.execute(
+                postgresql.insert(Article)
+                .values(values)
+                .on_conflict_do_nothing(index_elements=[Article.content_hash])
+            )
+            article_ids.update(find_articles(missing))
+
+        return article_ids
+
+    def _make_content_hash(self, entry: FeedEntry) -> str:
+        return helpers.make_content_hash(entry.link, entry.title, entry.description)
+
+    def _make_article(self, content_hash: str, entry: FeedEntry) -> dict:
+        return dict(
+            content_hash=content_hash,
+            title=entry.title,
+            summary=entry.description,
+            excerpt=helpers.make_excerpt(
+                entry.description, settings.ENTRY_EXCERPT_LENGTH
+            ),
+            search_vector=self._make_search_vector(entry),
+            link=entry.link,
+        )
+
+    def _make_search_vector(self, entry: FeedEntry) -> sa.sql.ColumnElement:
+        text = helpers.html_to_text(entry.description)
+        return database.make_search_vector(
+            entry.title, text[: settings.SEARCH_MAX_TEXT_LENGTH]
+        )
+
+    def _notify_new_entries(
+        self, session: sqlalchemy.orm.Session, n_entries: int
+    ) -> None:
+        """
+        Publish a notification about the new entries of this feed.
+
+        Postgres delivers the notification to the listeners only after the
+        transaction is committed, so they never see uncommitted entries.
+        """
+        payload = json.dumps(
+            dict(user_id=self.feed.user_id, feed_id=self.feed.id, count=n_entries)
+        )
+        session.execute(
+            sa.select(sa.func.pg_notify(constants.NEW_ENTRIES_CHANNEL, payload))
+        )
+
     def _save_success_run(
         self, session: sqlalchemy.orm.Session, *, n_downloaded: int, n_ignored: int
     ) -> None:
@@ -129,10 +265,25 @@ class FeedWorker:
         if self.failure_notifier:
             self.failure_notifier(self.feed.id)
 
+    def was_entry_removed(
+        self, entry: FeedEntry, removed_until: Optional[datetime.datetime]
+    ) -> bool:
+        """
+        Return whether the entry is as old as the entries of the feed which were
+        purged or archived, see `Feed.removed_until`.
+        """
+        if removed_until is None:
+            return False
+
+        return self._make_datetime(entry.published_parsed) <= removed_until
+
     def does_entry_exist(self, session: sqlalchemy.orm.Session, entry_id: str) -> bool:
         count = (
             session.query(database.Entry)
-            .filter(database.Entry.original_id == entry_id)
+            .filter(
+                database.Entry.feed_id == self.feed.id,
+                database.Entry.original_id == entry_id,
+            )
             .count()
         )
 
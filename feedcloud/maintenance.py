@@ -0,0 +1,925 @@
+import collections
+import datetime
+import logging
+import time
+from typing import Any, List, Optional, Set
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from sqlalchemy.dialects import postgresql
+
+from feedcloud import database, helpers, settings
+
+logger = logging.getLogger("feedcloud.Maintenance")
+
+
+def backfill_excerpts(batch_size: int = 1000) -> int:
+    """
+    Compute the excerpt of the existing articles which don't have one yet.
+
+    Articles are processed in batches ordered by their ID, each batch in its own
+    transaction. Return the number of updated articles.
+    """
+    Article = database.Article
+
+    last_id = 0
+    n_updated = 0
+
+    while True:
+        with database.get_session() as session:
+            rows = (
+                session.query(Article.id, Article.summary)
+                .filter(
+                    Article.id > last_id, Article.excerpt == "", Article.summary != ""
+                )
+                .order_by(Article.id)
+                .limit(batch_size)
+                .all()
+            )
+
+            if not rows:
+                break
+
+            excerpts = [
+                dict(
+                    id=row.id,
+                    excerpt=helpers.make_excerpt(
+                        row.summary, settings.ENTRY_EXCERPT_LENGTH
+                    ),
+                )
+                for row in rows
+            ]
+            session.bulk_update_mappings(Article, excerpts)
+            session.commit()
+
+        last_id = rows[-1].id
+        n_updated += len(rows)
+        logger.info(f"Updated the excerpt of {n_updated} articles so far")
+
+    return n_updated
+
+
+def backfill_search_vectors(batch_size: int = 1000) -> int:
+    """
+    Build the full-text search document of the existing articles which don't
+    have one yet.
+
+    Articles are processed in batches ordered by their ID, each batch in its own
+    transaction. Return the number of updated articles.
+    """
+    Article = database.Article
+    table = Article.__table__
+
+    update = (
+        table.update()
+        .where(table.c.id == sa.bindparam("article_id"))
+        .values(
+            search_vector=database.make_search_vector(
+                sa.bindparam("article_title"), sa.bindparam("article_text")
+            )
+        )
+    )
+
+    last_id = 0
+    n_updated = 0
+
+    while True:
+        with database.get_session() as session:
+            rows = (
+                session.query(Article.id, Article.title, Article.summary)
+                .filter(Article.id > last_id, Article.search_vector == None)  # noqa
+                .order_by(Article.id)
+                .limit(batch_size)
+                .all()
+            )
+
+            if not rows:
+                break
+
+            params = [
+                dict(
+                    article_id=row.id,
+                    article_title=row.title,
+                    article_text=helpers.html_to_text(row.summary)[
+                        : settings.SEARCH_MAX_TEXT_LENGTH
+                    ],
+                )
+                for row in rows
+            ]
+            session.execute(update, params)
+            session.commit()
+
+        last_id = rows[-1].id
+        n_updated += len(rows)
+        logger.info(f"Updated the search document of {n_updated} articles so far")
+
+    return n_updated
+
+
+def create_entry_partitions() -> List[str]:
+    """
+    Create the upcoming partitions of the `entry` table. With range partitioning
+    this runs with the other maintenance tasks.
+    """
+    if not settings.ENTRY_PARTITIONING:
+        raise ValueError("Entry partitioning is not enabled")
+
+    with database.get_session() as session:
+        created = database.create_entry_partitions(session.connection())
+        session.commit()
+
+    for name in created:
+        logger.info(f"Created partition {name}")
+
+    return created
+
+
+def partition_entry_table() -> int:
+    """
+    Convert an existing, unpartitioned `entry` table to a partitioned one, as
+    configured by `settings.ENTRY_PARTITIONING`. Return the number of moved
+    entries.
+
+    Everything happens in a single transaction which locks the table, so the
+    API and the workers will be blocked until it's done.
+    """
+    if not settings.ENTRY_PARTITIONING:
+        raise ValueError("Entry partitioning is not enabled")
+
+    with database.get_session() as session:
+        connection = session.connection()
+
+        is_partitioned = connection.execute(
+            sa.text(
+                "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'entry'::regclass"
+            )
+        ).scalar()
+        if is_partitioned:
+            raise ValueError("The entry table is already partitioned")
+
+        # Index and sequence names are unique per schema, so the ones of the old
+        # table need to be renamed before the new table is created
+        old_table = "entry_unpartitioned"
+        connection.execute(sa.text(f"ALTER TABLE entry RENAME TO {old_table}"))
+
+        index_names = connection.execute(
+            sa.text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+            dict(table=old_table),
+        ).scalars()
+        for name in list(index_names):
+            connection.execute(
+                sa.text(f"ALTER INDEX {name} RENAME TO {name}_unpartitioned")
+            )
+
+        sequence = connection.execute(
+            sa.text("SELECT pg_get_serial_sequence(:table, 'id')"),
+            dict(table=old_table),
+        ).scalar()
+        if sequence:
+            connection.execute(
+                sa.text(f"ALTER SEQUENCE {sequence} RENAME TO {old_table}_id_seq")
+            )
+
+        entry = database.make_partitioned_metadata().tables["entry"]
+        entry.create(connection)
+
+        since = connection.execute(
+            sa.text(f"SELECT min(saved_at) FROM {old_table}")
+        ).scalar()
+        database.create_entry_partitions(
+            connection, since=since.date() if since else None
+        )
+
+        columns = ", ".join(column.name for column in entry.columns)
+        result = connection.execute(
+            sa.text(f"INSERT INTO entry ({columns}) SELECT {columns} FROM {old_table}")
+        )
+        n_moved = result.rowcount
+
+        connection.execute(
+            sa.text(
+                "SELECT setval(pg_get_serial_sequence('entry', 'id'), max(id)) "
+                "FROM entry"
+            )
+        )
+        connection.execute(sa.text(f"DROP TABLE {old_table}"))
+        session.commit()
+
+    logger.info(f"Moved {n_moved} entries to the partitioned table")
+    return n_moved
+
+
+# Moves a batch of old update runs into the daily stats in a single statement,
+# so a run is never counted twice or lost. The newest run of each feed is kept.
+_ROLLUP_FEED_UPDATE_RUNS = sa.text("""
+    WITH moved AS (
+        DELETE FROM feed_update_run
+        WHERE id IN (
+            SELECT run.id FROM feed_update_run run
+            WHERE run.timestamp < :cutoff
+                AND EXISTS (
+                    SELECT 1 FROM feed_update_run newer
+                    WHERE newer.feed_id = run.feed_id
+                        AND newer.timestamp > run.timestamp
+                )
+            ORDER BY run.id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING feed_id, timestamp, status, n_downloaded, n_ignored
+    ),
+    rolled_up AS (
+        INSERT INTO feed_daily_stats
+            (feed_id, day, n_success, n_failure, n_downloaded, n_ignored)
+        SELECT
+            feed_id,
+            timestamp::date,
+            count(*) FILTER (WHERE status = :success),
+            count(*) FILTER (WHERE status = :failed),
+            sum(n_downloaded),
+            sum(n_ignored)
+        FROM moved
+        GROUP BY feed_id, timestamp::date
+        ON CONFLICT (feed_id, day) DO UPDATE SET
+            n_success = feed_daily_stats.n_success + excluded.n_success,
+            n_failure = feed_daily_stats.n_failure + excluded.n_failure,
+            n_downloaded = feed_daily_stats.n_downloaded + excluded.n_downloaded,
+            n_ignored = feed_daily_stats.n_ignored + excluded.n_ignored
+    )
+    SELECT count(*) FROM moved
+    """)
+
+
+def rollup_feed_update_runs(batch_size: Optional[int] = None) -> int:
+    """
+    Roll up the update runs older than `FEED_UPDATE_RUN_RETENTION_DAYS` into
+    `FeedDailyStats` and delete them. Return the number of deleted runs.
+
+    Runs are processed in batches, each in its own short transaction, with a
+    pause in between.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    cutoff = datetime.datetime.now() - datetime.timedelta(
+        days=settings.FEED_UPDATE_RUN_RETENTION_DAYS
+    )
+    params = dict(
+        cutoff=cutoff,
+        batch_size=batch_size,
+        success=database.FeedUpdateRun.SUCCESS,
+        failed=database.FeedUpdateRun.FAILED,
+    )
+
+    n_deleted = 0
+    while True:
+        with database.get_session() as session:
+            n_moved = session.execute(_ROLLUP_FEED_UPDATE_RUNS, params).scalar()
+            session.commit()
+
+        n_deleted += n_moved
+        if n_moved < batch_size:
+            break
+
+        logger.info(f"Rolled up {n_deleted} feed update runs so far")
+        time.sleep(settings.MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+    logger.info(f"Rolled up {n_deleted} feed update runs")
+    return n_deleted
+
+
+# Entry retention policy of a feed, see `purge_entries`
+RetentionPolicy = collections.namedtuple(
+    "RetentionPolicy", "max_age_days max_entries keep_unread"
+)
+
+
+def get_retention_policy(feed: database.Feed) -> RetentionPolicy:
+    """
+    Return the retention policy of a feed, falling back to the defaults from
+    the settings for the values which are not set on the feed.
+    """
+
+    def get_value(value, default):
+        return default if value is None else value
+
+    return RetentionPolicy(
+        max_age_days=get_value(
+            feed.retention_max_age_days, settings.ENTRY_RETENTION_MAX_AGE_DAYS
+        ),
+        max_entries=get_value(
+            feed.retention_max_entries, settings.ENTRY_RETENTION_MAX_ENTRIES
+        ),
+        keep_unread=get_value(
+            feed.retention_keep_unread, settings.ENTRY_RETENTION_KEEP_UNREAD
+        ),
+    )
+
+
+def purge_entries(batch_size: Optional[int] = None) -> int:
+    """
+    Delete the entries which are outside of the retention policy of their feed.
+    Return the number of deleted entries.
+
+    Feeds are processed one by one. The entries of a feed are deleted in small
+    batches which are found through the (feed_id, published_at) index, each in
+    its own short transaction and with a pause in between. This avoids long
+    locks, and gives autovacuum a steady trickle instead of a burst of dead rows.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    Entry = database.Entry
+    Feed = database.Feed
+
+    with database.get_session() as session:
+        feeds = (
+            session.query(
+                Feed.id,
+                Feed.retention_max_age_days,
+                Feed.retention_max_entries,
+                Feed.retention_keep_unread,
+            )
+            .filter(Feed.deleted_at.is_(None))
+            .order_by(Feed.id)
+            .all()
+        )
+
+    n_deleted = 0
+    for feed in feeds:
+        policy = get_retention_policy(feed)
+
+        if policy.max_age_days:
+            cutoff = datetime.datetime.now() - datetime.timedelta(
+                days=policy.max_age_days
+            )
+            old_entries = (
+                sa.select(Entry.id)
+                .where(Entry.feed_id == feed.id, Entry.published_at < cutoff)
+                .order_by(Entry.published_at)
+            )
+            if policy.keep_unread:
+                old_entries = old_entries.where(Entry.status != Entry.UNREAD)
+
+            n_deleted += _remove_entries_in_batches(feed.id, old_entries, batch_size)
+
+        if policy.max_entries:
+            newest_first = (
+                sa.select(Entry.id, Entry.status)
+                .where(Entry.feed_id == feed.id)
+                .order_by(Entry.published_at.desc(), Entry.id.desc())
+                .offset(policy.max_entries)
+                .subquery()
+            )
+            extra_entries = sa.select(newest_first.c.id)
+            if policy.keep_unread:
+                extra_entries = extra_entries.where(
+                    newest_first.c.status != Entry.UNREAD
+                )
+
+            n_deleted += _remove_entries_in_batches(feed.id, extra_entries, batch_size)
+
+    logger.info(f"Purged {n_deleted} entries")
+    return n_deleted
+
+
+def _remove_entries_in_batches(feed_id: int, ids: sa.sql.Select, batch_size: int) -> int:
+    """
+    Like `_delete_in_batches` for the entries of a feed, which also records
+    that they were removed, see `_mark_entries_removed`.
+    """
+    Entry = database.Entry
+    delete = (
+        sa.delete(Entry)
+        .where(Entry.id.in_(ids.limit(batch_size).scalar_subquery()))
+        .returning(Entry.id, Entry.published_at)
+        .execution_options(synchronize_session=False)
+    )
+
+    n_deleted = 0
+    while True:
+        with database.get_session() as session:
+            database.lock_feed_entries(session, feed_id)
+            removed = session.execute(delete).all()
+            if removed:
+                _mark_entries_removed(
+                    session,
+                    feed_id,
+                    [entry.id for entry in removed],
+                    max(entry.published_at for entry in removed),
+                )
+            session.commit()
+
+        n_deleted += len(removed)
+        if len(removed) < batch_size:
+            return n_deleted
+
+        time.sleep(settings.MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+
+def _mark_entries_removed(
+    session: sqlalchemy.orm.Session,
+    feed_id: int,
+    entry_ids: List[int],
+    published_at: datetime.datetime,
+) -> None:
+    """
+    Record that entries of the feed published up to `published_at` were removed,
+    so the worker doesn't save them again when the feed still lists them. The
+    version of the feed is bumped, since its entry lists have changed, and a
+    `database.EntryRemoval` is added for each entry for the clients which sync.
+
+    This must run in the transaction which removes the entries, while holding
+    `database.lock_feed_entries`.
+    """
+    Feed = database.Feed
+    EntryRemoval = database.EntryRemoval
+
+    user_id = session.query(Feed.user_id).filter(Feed.id == feed_id).scalar()
+    session.execute(
+        sa.insert(EntryRemoval),
+        [
+            dict(entry_id=entry_id, feed_id=feed_id, user_id=user_id)
+            for entry_id in entry_ids
+        ],
+    )
+    session.execute(
+        sa.update(Feed)
+        .where(Feed.id == feed_id)
+        .values(
+            removed_until=sa.func.greatest(Feed.removed_until, published_at),
+            version=Feed.version + 1,
+        )
+    )
+
+
+def _delete_in_batches(model: Any, ids: sa.sql.Select, batch_size: int) -> int:
+    """
+    Delete the rows of `model` whose IDs are returned by `ids`, `batch_size`
+    rows per transaction. Return the number of deleted rows.
+    """
+    delete = (
+        sa.delete(model)
+        .where(model.id.in_(ids.limit(batch_size).scalar_subquery()))
+        .execution_options(synchronize_session=False)
+    )
+
+    n_deleted = 0
+    while True:
+        with database.get_session() as session:
+            n_batch = session.execute(delete).rowcount
+            session.commit()
+
+        n_deleted += n_batch
+        if n_batch < batch_size:
+            return n_deleted
+
+        time.sleep(settings.MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+
+def archive_entries(
+    older_than_days: Optional[int] = None, segment_size: Optional[int] = None
+) -> int:
+    """
+    Move the entries published more than `older_than_days` days ago (default:
+    `ENTRY_ARCHIVE_AFTER_DAYS`) from the `entry` table to compressed archive
+    segments. Return the number of archived entries.
+
+    Archiving is disabled when `ENTRY_ARCHIVE_AFTER_DAYS` is 0, but an explicit
+    `older_than_days=0` archives everything published until now.
+
+    Each segment holds up to `segment_size` entries of one feed and is written
+    in the same transaction which deletes the entries, so nothing is lost or
+    archived twice. Archived entries are not saved again by the worker, see
+    `Feed.removed_until`.
+    """
+    if older_than_days is None:
+        older_than_days = settings.ENTRY_ARCHIVE_AFTER_DAYS
+        if not older_than_days:
+            return 0
+    if segment_size is None:
+        segment_size = settings.ENTRY_ARCHIVE_SEGMENT_SIZE
+
+    Entry = database.Entry
+    Article = database.Article
+    EntryArchive = database.EntryArchive
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    columns = [
+        getattr(Article if field in Article.FIELDS else Entry, field)
+        for field in EntryArchive.FIELDS
+    ]
+
+    with database.get_session() as session:
+        feed_ids = (
+            session.query(database.Feed.id)
+            .filter(database.Feed.deleted_at.is_(None))
+            .order_by(database.Feed.id)
+            .all()
+        )
+
+    n_archived = 0
+    for (feed_id,) in feed_ids:
+        while True:
+            with database.get_session() as session:
+                database.lock_feed_entries(session, feed_id)
+                entries = (
+                    session.query(*columns)
+                    .select_from(Entry)
+                    .join(Article, Entry.article_id == Article.id)
+                    .filter(Entry.feed_id == feed_id, Entry.published_at < cutoff)
+                    .order_by(Entry.published_at, Entry.id)
+                    .limit(segment_size)
+                    .all()
+                )
+
+                if not entries:
+                    break
+
+                payload = [
+                    [_to_json_value(value) for value in entry] for entry in entries
+                ]
+                segment = EntryArchive(
+                    feed_id=feed_id,
+                    first_published_at=entries[0].published_at,
+                    last_published_at=entries[-1].published_at,
+                    n_entries=len(entries),
+                    payload=helpers.compress_json(payload),
+                )
+                session.add(segment)
+
+                entry_ids = [entry.id for entry in entries]
+                session.query(Entry).filter(Entry.id.in_(entry_ids)).delete(
+                    synchronize_session=False
+                )
+                _mark_entries_removed(
+                    session, feed_id, entry_ids, entries[-1].published_at
+                )
+                session.commit()
+
+            n_archived += len(entries)
+            if len(entries) < segment_size:
+                break
+
+            time.sleep(settings.MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+    logger.info(f"Archived {n_archived} entries")
+    return n_archived
+
+
+def delete_feed(feed_id: int, batch_size: Optional[int] = None) -> bool:
+    """
+    Remove a feed which is marked as deleted, with all of its entries, archive
+    segments and update runs. Return `False` if the feed is not found or not
+    marked as deleted.
+
+    The children are deleted in batches, each in its own short transaction, so
+    that a big feed doesn't hold locks for minutes. The feed row itself goes
+    last; its remaining children (the daily stats) are removed by the cascade.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    Feed = database.Feed
+
+    with database.get_session() as session:
+        is_deleted = (
+            session.query(Feed.id)
+            .filter(Feed.id == feed_id, Feed.deleted_at.isnot(None))
+            .one_or_none()
+        )
+    if not is_deleted:
+        return False
+
+    n_deleted = 0
+    for model in (database.Entry, database.EntryArchive, database.FeedUpdateRun):
+        ids = sa.select(model.id).where(model.feed_id == feed_id)
+        n_deleted += _delete_in_batches(model, ids, batch_size)
+
+    with database.get_session() as session:
+        session.query(Feed).filter(Feed.id == feed_id).delete(synchronize_session=False)
+        session.commit()
+
+    logger.info(f"Deleted feed {feed_id} and {n_deleted} related rows")
+    return True
+
+
+def delete_user(user_id: int, batch_size: Optional[int] = None) -> bool:
+    """
+    Remove a user which is marked as deleted, with all of their feeds. Return
+    `False` if the user is not found or not marked as deleted.
+    """
+    User = database.User
+    Feed = database.Feed
+
+    with database.get_session() as session:
+        is_deleted = (
+            session.query(User.id)
+            .filter(User.id == user_id, User.deleted_at.isnot(None))
+            .one_or_none()
+        )
+        if not is_deleted:
+            return False
+
+        feed_ids = session.query(Feed.id).filter(Feed.user_id == user_id).all()
+
+    for (feed_id,) in feed_ids:
+        delete_feed(feed_id, batch_size)
+
+    with database.get_session() as session:
+        session.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        session.commit()
+
+    logger.info(f"Deleted user {user_id}")
+    return True
+
+
+def delete_marked_rows(batch_size: Optional[int] = None) -> int:
+    """
+    Remove all the feeds and users which are marked as deleted. Return the
+    number of removed feeds and users.
+
+    Deletions are normally done by the `delete_feed` and `delete_user` actors
+    right away. This picks up the ones which were interrupted or lost.
+    """
+    User = database.User
+    Feed = database.Feed
+
+    with database.get_session() as session:
+        feed_ids = (
+            session.query(Feed.id)
+            .join(User, Feed.user_id == User.id)
+            .filter(Feed.deleted_at.isnot(None), User.deleted_at.is_(None))
+            .order_by(Feed.id)
+            .all()
+        )
+        user_ids = (
+            session.query(User.id)
+            .filter(User.deleted_at.isnot(None))
+            .order_by(User.id)
+            .all()
+        )
+
+    n_deleted = 0
+    for (feed_id,) in feed_ids:
+        n_deleted += delete_feed(feed_id, batch_size)
+
+    for (user_id,) in user_ids:
+        n_deleted += delete_user(user_id, batch_size)
+
+    return n_deleted
+
+
+def delete_orphaned_articles(batch_size: Optional[int] = None) -> int:
+    """
+    Delete the articles which are not used by any entry anymore, e.g. because
+    their entries were purged, archived or deleted with their feed. Return the
+    number of deleted articles.
+
+    Articles which are locked by a worker that's about to save new entries for
+    them are skipped.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    Article = database.Article
+    Entry = database.Entry
+
+    orphans = (
+        sa.select(Article.id)
+        .where(~sa.exists().where(Entry.article_id == Article.id))
+        .order_by(Article.id)
+        .with_for_update(skip_locked=True)
+    )
+    n_deleted = _delete_in_batches(Article, orphans, batch_size)
+
+    logger.info(f"Deleted {n_deleted} orphaned articles")
+    return n_deleted
+
+
+def delete_old_entry_removals(batch_size: Optional[int] = None) -> int:
+    """
+    Delete the tombstones of the entries which were removed more than
+    `ENTRY_REMOVAL_RETENTION_DAYS` days ago. Return the number of deleted
+    tombstones.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    EntryRemoval = database.EntryRemoval
+    cutoff = datetime.datetime.now() - datetime.timedelta(
+        days=settings.ENTRY_REMOVAL_RETENTION_DAYS
+    )
+
+    old_removals = (
+        sa.select(EntryRemoval.id)
+        .where(EntryRemoval.removed_at < cutoff)
+        .order_by(EntryRemoval.removed_at)
+    )
+    n_deleted = _delete_in_batches(EntryRemoval, old_removals, batch_size)
+
+    logger.info(f"Deleted {n_deleted} entry removals")
+    return n_deleted
+
+
+def move_entry_content_to_articles(batch_size: Optional[int] = None) -> int:
+    """
+    Convert an `entry` table from before articles were shared: the content of
+    each entry is moved to an `Article` (entries with the same content share
+    one) and the old columns are dropped. Return the number of converted
+    entries.
+
+    Older tables don't have the excerpt and the search document of the entries
+    yet; these are computed from the title and the summary. The change
+    transaction and the indexes of the current schema are added as well.
+
+    Entries are converted in batches, each in its own transaction. The old
+    columns are only dropped at the end, so this can be resumed if it's
+    interrupted. The services must be stopped while it runs.
+    """
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    Article = database.Article
+
+    with database.get_session() as session:
+        connection = session.connection()
+        if "summary" not in _get_column_names(session, "entry"):
+            raise ValueError("The entry table is already converted")
+
+        Article.__table__.create(connection, checkfirst=True)
+        connection.execute(
+            sa.text(
+                "ALTER TABLE entry ADD COLUMN IF NOT EXISTS article_id integer "
+                "REFERENCES article (id), ADD COLUMN IF NOT EXISTS change_txid "
+                "bigint NOT NULL DEFAULT txid_current()"
+            )
+        )
+        existing = _get_column_names(session, "entry")
+        session.commit()
+
+    n_converted = 0
+    while True:
+        with database.get_session() as session:
+            rows = session.execute(
+                sa.text(
+                    "SELECT id, title, summary, link FROM entry "
+                    "WHERE article_id IS NULL ORDER BY id LIMIT :batch_size"
+                ),
+                dict(batch_size=batch_size),
+            ).all()
+
+            if not rows:
+                break
+
+            _insert_entry_articles(session, rows, existing)
+            session.commit()
+
+        n_converted += len(rows)
+        logger.info(f"Converted {n_converted} entries so far")
+
+    old_columns = ("search_vector",) + Article.FIELDS
+    drop_columns = ", ".join(f"DROP COLUMN IF EXISTS {name}" for name in old_columns)
+    with database.get_session() as session:
+        session.execute(
+            sa.text(
+                f"ALTER TABLE entry ALTER COLUMN article_id SET NOT NULL, {drop_columns}"
+            )
+        )
+        for index in database.Entry.__table__.indexes:
+            index.create(session.connection(), checkfirst=True)
+        session.commit()
+
+    return n_converted
+
+
+def _get_column_names(session: sqlalchemy.orm.Session, table_name: str) -> Set[str]:
+    rows = session.execute(
+        sa.text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table_name"
+        ),
+        dict(table_name=table_name),
+    )
+    return {row.column_name for row in rows}
+
+
+def _insert_entry_articles(
+    session: sqlalchemy.orm.Session, rows: List[Any], existing: Set[str]
+) -> None:
+    """
+    Create the articles of a batch of unconverted entries and link the entries
+    to them. The excerpt and the search document are copied from the entry if
+    it has them, otherwise they are computed like the worker does.
+    """
+    Article = database.Article
+
+    hashes = sa.values(
+        sa.column("entry_id", sa.Integer),
+        sa.column("content_hash", sa.Text),
+        sa.column("excerpt", sa.Text),
+        sa.column("search_text", sa.Text),
+        name="hashes",
+    ).data(
+        [
+            (
+                row.id,
+                helpers.make_content_hash(row.link, row.title, row.summary),
+                (
+                    None
+                    if "excerpt" in existing
+                    else helpers.make_excerpt(row.summary, settings.ENTRY_EXCERPT_LENGTH)
+                ),
+                (
+                    None
+                    if "search_vector" in existing
+                    else helpers.html_to_text(row.summary)[
+                        : settings.SEARCH_MAX_TEXT_LENGTH
+                    ]
+                ),
+            )
+            for row in rows
+        ]
+    )
+
+    names = {"id", "article_id", "search_vector"} | set(Article.FIELDS)
+    entry = sa.table("entry", *[sa.column(name) for name in names & existing])
+
+    content = []
+    for field in Article.FIELDS:
+        if field == "summary":
+            # Summaries are copied as they are, see `compress_summaries`
+            content.append(sa.func.convert_to(entry.c.summary, "UTF8"))
+        elif field == "excerpt" and "excerpt" not in existing:
+            content.append(hashes.c.excerpt)
+        else:
+            content.append(entry.c[field])
+
+    if "search_vector" in existing:
+        search_vector = entry.c.search_vector
+    else:
+        search_vector = database.make_search_vector(entry.c.title, hashes.c.search_text)
+
+    session.execute(
+        postgresql.insert(Article)
+        .from_select(
+            ["content_hash", "search_vector", *Article.FIELDS],
+            sa.select(hashes.c.content_hash, search_vector, *content).join(
+                hashes, hashes.c.entry_id == entry.c.id
+            ),
+        )
+        .on_conflict_do_nothing(index_elements=[Article.content_hash])
+    )
+    session.execute(
+        entry.update()
+        .where(
+            entry.c.id == hashes.c.entry_id,
+            Article.content_hash == hashes.c.content_hash,
+        )
+        .values(article_id=Article.id)
+    )
+
+
+def compress_summaries(batch_size: Optional[int] = None) -> int:
+    """
+    Compress the existing article summaries which are larger than
+    `ENTRY_SUMMARY_COMPRESSION_THRESHOLD` but were stored uncompressed. Return
+    the number of compressed summaries.
+
+    Articles are processed in batches ordered by their ID, each batch in its own
+    transaction.
+    """
+    threshold = settings.ENTRY_SUMMARY_COMPRESSION_THRESHOLD
+    if not threshold:
+        return 0
+
+    batch_size = batch_size or settings.MAINTENANCE_BATCH_SIZE
+    Article = database.Article
+    # The stored value, without decompressing it
+    summary = sa.type_coerce(Article.summary, sa.LargeBinary)
+
+    last_id = 0
+    n_compressed = 0
+
+    while True:
+        with database.get_session() as session:
+            rows = (
+                session.query(Article.id, Article.summary)
+                .filter(
+                    Article.id > last_id,
+                    sa.func.length(summary) >= threshold,
+                    sa.func.get_byte(summary, 0) != 0xFF,
+                )
+                .order_by(Article.id)
+                .limit(batch_size)
+                .all()
+            )
+
+            if not rows:
+                break
+
+            summaries = [dict(id=row.id, summary=row.summary) for row in rows]
+            session.bulk_update_mappings(Article, summaries)
+            session.commit()
+
+        last_id = rows[-1].id
+        n_compressed += len(rows)
+        logger.info(f"Compressed {n_compressed} summaries so far")
+        time.sleep(settings.MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+    return n_compressed
+
+
+def _to_json_value(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+
+    return value
@@ -0,0 +1,82 @@
+"""
+A minimal in-process metrics registry.
+
+Each process (API worker, dramatiq worker, scheduler) keeps its own values.
+The API serves its values through `GET /metrics/`, the other processes log
+them periodically, see `start_logging`.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger("feedcloud.Metrics")
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = collections.defaultdict(float)
+_timers: Dict[str, Dict[str, float]] = {}
+
+
+def increment(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Record a duration. The count, total and maximum duration are kept.
+    """
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = dict(count=0, total=0.0, max=0.0)
+
+        timer["count"] += 1
+        timer["total"] += seconds
+        timer["max"] = max(timer["max"], seconds)
+
+
+def snapshot() -> dict:
+    """
+    Return a copy of all the metrics.
+    """
+    with _lock:
+        return dict(
+            counters=dict(_counters),
+            timers={name: dict(timer) for name, timer in _timers.items()},
+        )
+
+
+def log_snapshot(extra: Optional[Callable[[], dict]] = None) -> None:
+    """
+    Log all the metrics as a single JSON line. The values returned by `extra`
+    are added to them.
+    """
+    values = snapshot()
+    if extra is not None:
+        values.update(extra())
+
+    logger.info(f"Metrics: {json.dumps(values, sort_keys=True)}")
+
+
+def start_logging(
+    interval_seconds: float, *, extra: Optional[Callable[[], dict]] = None
+) -> threading.Thread:
+    """
+    Call `log_snapshot` every `interval_seconds` on a daemon thread.
+    """
+
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                log_snapshot(extra)
+            except Exception:
+                logger.exception("Failed to log the metrics")
+
+    thread = threading.Thread(target=run, name="metrics-logger", daemon=True)
+    thread.start()
+    return thread
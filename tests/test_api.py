@@ -1,8 +1,17 @@
 import datetime
+import io
+import json
+import threading
 
 import flask
+import flask_jwt_extended
+import sqlalchemy as sa
 
-from feedcloud import database, helpers
+from feedcloud import database, helpers, maintenance, opml, settings
+from feedcloud.api import notifications, services
+from feedcloud.ingest import tasks
+from feedcloud.ingest.types import FeedEntry
+from feedcloud.ingest.worker import FeedWorker
 
 
 def test_authenticate_user(client, test_user):
@@ -29,6 +38,85 @@ def test_authenticate_user(client, test_user):
     assert "token" in resp.json
 
 
+def test_user_is_taken_from_token_claims(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    claims = flask_jwt_extended.decode_token(headers["Authorization"].split()[1])
+    assert claims["user_id"] == test_user.id
+    assert claims["is_admin"] is False
+
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, *args):
+        if 'FROM "user"' in statement:
+            statements.append(statement)
+
+    sa.event.listen(database.engine, "before_cursor_execute", record_statement)
+    try:
+        url = flask.url_for("get_feeds")
+        for _ in range(3):
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 200
+    finally:
+        sa.event.remove(database.engine, "before_cursor_execute", record_statement)
+
+    # The user is looked up once and then served from the cache
+    assert len(statements) == 1
+
+    # Deleting the user invalidates the cache
+    db_session.delete(test_user)
+    db_session.commit()
+
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 401
+    assert resp.json["message"] == "User not found"
+
+
+def test_refresh_token(client, test_user):
+    url = flask.url_for("authenticate")
+    resp = client.post(url, json=dict(username=test_user.username, password="test"))
+    assert resp.status_code == 200
+    refresh_token = resp.json["refresh_token"]
+
+    # A refresh token can't be used as an access token
+    headers = {"Authorization": f"Bearer {refresh_token}"}
+    resp = client.get(flask.url_for("get_feeds"), headers=headers)
+    assert resp.status_code == 422
+
+    resp = client.post(flask.url_for("refresh_token"), headers=headers)
+    assert resp.status_code == 200
+    assert "refresh_token" not in resp.json
+
+    headers = {"Authorization": f"Bearer {resp.json['token']}"}
+    resp = client.get(flask.url_for("get_feeds"), headers=headers)
+    assert resp.status_code == 200
+
+
+def test_password_is_rehashed_on_login(db_session, client, test_user):
+    assert not helpers.password_needs_rehash(test_user.password_hash)
+
+    settings.update_settings_from_dict({"PASSWORD_HASH_ROUNDS": 5})
+    try:
+        authenticate(client, test_user)
+        db_session.refresh(test_user)
+        assert not helpers.password_needs_rehash(test_user.password_hash)
+        assert helpers.check_password("test", test_user.password_hash)
+    finally:
+        settings.update_settings_from_dict({"PASSWORD_HASH_ROUNDS": 4})
+
+    # The old hash still works
+    authenticate(client, test_user)
+
+
+def test_login_is_rejected_when_busy(monkeypatch, client, test_user):
+    monkeypatch.setattr(services, "_password_check_slots", threading.Semaphore(0))
+
+    url = flask.url_for("authenticate")
+    resp = client.post(url, json=dict(username=test_user.username, password="test"))
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+
 def test_create_new_user(db_session, client):
     normal_user = database.User(
         username="normal", password_hash=helpers.hash_password("normal"), is_admin=False
@@ -101,7 +189,7 @@ def test_register_feed(db_session, client, test_user):
     assert feeds[0].url == "http://bla"
 
 
-def test_unregister_feed(db_session, client, test_user):
+def test_unregister_feed(db_session, client, test_user, broker, stub_worker):
     headers = authenticate(client, test_user)
 
     # 404; Feed doesn't exist yet
@@ -118,9 +206,138 @@ def test_unregister_feed(db_session, client, test_user):
     url = flask.url_for("unregister_feed", feed_id=feed.id)
     resp = client.delete(url, json=dict(url="http://bla"), headers=headers)
     assert resp.status_code == 200
+
+    # The feed is hidden right away, and removed in the background
+    resp = client.get(flask.url_for("get_feeds"), headers=headers)
+    assert resp.json["feeds"] == []
+    resp = client.delete(url, headers=headers)
+    assert resp.status_code == 404
+
+    # It can be registered again in the meantime
+    resp = client.post(
+        flask.url_for("register_feed"), json=dict(url="http://bla"), headers=headers
+    )
+    assert resp.status_code == 201
+
+    broker.join(tasks.BACKFILL_QUEUE)
+    stub_worker.join()
+
+    assert db_session.query(database.Feed).count() == 1
+
+
+def test_delete_user(db_session, client, test_user, broker, stub_worker):
+    admin = database.User(
+        username="admin", password_hash=helpers.hash_password("admin"), is_admin=True
+    )
+    db_session.add(admin)
+    db_session.add(database.Feed(user_id=test_user.id, url="http://bla"))
+    db_session.commit()
+
+    user_headers = authenticate(client, test_user)
+    admin_headers = authenticate(client, admin, "admin")
+
+    url = flask.url_for("delete_user", username=admin.username)
+    resp = client.delete(url, headers=user_headers)
+    assert resp.status_code == 401
+    resp = client.delete(url, headers=admin_headers)
+    assert resp.status_code == 400
+
+    url = flask.url_for("delete_user", username=test_user.username)
+    resp = client.delete(url, headers=admin_headers)
+    assert resp.status_code == 200
+    resp = client.delete(url, headers=admin_headers)
+    assert resp.status_code == 404
+
+    # The user can't use the API anymore, even with a valid token
+    resp = client.get(flask.url_for("get_feeds"), headers=user_headers)
+    assert resp.status_code == 401
+
+    broker.join(tasks.BACKFILL_QUEUE)
+    stub_worker.join()
+
+    assert db_session.query(database.User).count() == 1
     assert db_session.query(database.Feed).count() == 0
 
 
+OPML = b"""<?xml version="1.0"?>
+<opml version="2.0">
+  <head><title>Subscriptions</title></head>
+  <body>
+    <outline text="News">
+      <outline type="rss" text="A" xmlUrl="http://feed/a"/>
+      <outline type="rss" text="B" xmlUrl="http://feed/b"/>
+    </outline>
+    <outline type="rss" text="C &amp; D" xmlUrl="http://feed/c?x=1&amp;y=2"/>
+    <outline type="rss" text="A again" xmlUrl="http://feed/a"/>
+  </body>
+</opml>
+"""
+
+
+def test_import_feeds(monkeypatch, db_session, client, test_user):
+    monkeypatch.setattr(settings, "FEED_IMPORT_SPREAD_SECONDS", 300)
+    db_session.add(database.Feed(user_id=test_user.id, url="http://feed/b"))
+    db_session.commit()
+
+    headers = authenticate(client, test_user)
+    url = flask.url_for("import_feeds")
+
+    resp = client.post(url, data=OPML, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json == dict(added=2, existing=1)
+
+    feeds = db_session.query(database.Feed).order_by(database.Feed.id).all()
+    assert [feed.url for feed in feeds] == [
+        "http://feed/b",
+        "http://feed/a",
+        "http://feed/c?x=1&y=2",
+    ]
+    # The first fetch is spread over the window
+    first_fetch = feeds[2].first_fetch_at - feeds[1].first_fetch_at
+    assert first_fetch == datetime.timedelta(seconds=200)
+
+    # Uploaded as a file
+    data = dict(file=(io.BytesIO(OPML), "feeds.opml"))
+    resp = client.post(url, data=data, headers=headers)
+    assert resp.json == dict(added=0, existing=3)
+
+    resp = client.post(url, data=b"<opml", headers=headers)
+    assert resp.status_code == 400
+
+    # Entity declarations are rejected before they are expanded
+    laughs = (
+        b'<!DOCTYPE opml [<!ENTITY lol "lol">'
+        b'<!ENTITY lol2 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">]>'
+        b'<opml version="2.0"><body><outline xmlUrl="&lol2;"/></body></opml>'
+    )
+    resp = client.post(url, data=laughs, headers=headers)
+    assert resp.status_code == 400
+
+    monkeypatch.setattr(settings, "FEED_IMPORT_MAX_FEEDS", 2)
+    resp = client.post(url, data=OPML, headers=headers)
+    assert resp.status_code == 400
+
+    monkeypatch.setitem(flask.current_app.config, "MAX_CONTENT_LENGTH", 10)
+    resp = client.post(url, data=OPML, headers=headers)
+    assert resp.status_code == 413
+
+
+def test_export_feeds(db_session, client, test_user):
+    db_session.add_all(
+        [
+            database.Feed(user_id=test_user.id, url="http://feed/a"),
+            database.Feed(user_id=test_user.id, url="http://feed/c?x=1&y=2"),
+        ]
+    )
+    db_session.commit()
+
+    headers = authenticate(client, test_user)
+    resp = client.get(flask.url_for("export_feeds"), headers=headers)
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/x-opml"
+    assert opml.parse_opml(resp.data) == ["http://feed/a", "http://feed/c?x=1&y=2"]
+
+
 def test_force_run_feed(db_session, client, test_user, broker, stub_worker):
     headers = authenticate(client, test_user)
 
@@ -132,13 +349,72 @@ def test_force_run_feed(db_session, client, test_user, broker, stub_worker):
     url = flask.url_for("force_run_feed", feed_id=feed.id)
     resp = client.put(url, headers=headers)
     assert resp.status_code == 200
+    assert resp.json["status"] == "queued"
+    assert resp.json["last_run_at"] is None
 
-    broker.join("default")
+    broker.join(tasks.INTERACTIVE_QUEUE)
     stub_worker.join()
 
     assert db_session.query(database.FeedUpdateRun).count() == 1
 
 
+def test_force_run_skips_scheduled_backlog(db_session, client, test_user, broker):
+    feed = database.Feed(user_id=test_user.id, url="http://bla")
+    db_session.add(feed)
+    db_session.commit()
+
+    for _ in range(100):
+        tasks.download_feed.send(feed.id)
+
+    headers = authenticate(client, test_user)
+    url = flask.url_for("force_run_feed", feed_id=feed.id)
+    resp = client.put(url, headers=headers)
+    assert resp.status_code == 200
+
+    assert broker.queues[tasks.INTERACTIVE_QUEUE].qsize() == 1
+    assert broker.queues[tasks.SCHEDULED_QUEUE].qsize() == 100
+
+
+def test_force_run_is_coalesced(db_session, client, test_user, broker):
+    feed = database.Feed(user_id=test_user.id, url="http://bla")
+    db_session.add(feed)
+    db_session.commit()
+
+    headers = authenticate(client, test_user)
+    url = flask.url_for("force_run_feed", feed_id=feed.id)
+
+    statuses = [client.put(url, headers=headers).json["status"] for _ in range(5)]
+    assert statuses == ["queued"] + ["pending"] * 4
+    assert broker.queues[tasks.INTERACTIVE_QUEUE].qsize() == 1
+
+    # The queued run has finished
+    run_dt = datetime.datetime.now()
+    db_session.add(
+        database.FeedUpdateRun(
+            feed_id=feed.id,
+            timestamp=run_dt,
+            status=database.FeedUpdateRun.SUCCESS,
+        )
+    )
+    db_session.commit()
+
+    resp = client.put(url, headers=headers)
+    assert resp.json["status"] == "completed"
+    assert resp.json["last_run_at"] == run_dt.isoformat()
+    assert broker.queues[tasks.INTERACTIVE_QUEUE].qsize() == 1
+
+    # Once the window has passed, a new run is queued
+    db_session.refresh(feed)
+    feed.force_run_requested_at -= datetime.timedelta(
+        seconds=settings.FEED_FORCE_RUN_COALESCE_SECONDS + 1
+    )
+    db_session.commit()
+
+    resp = client.put(url, headers=headers)
+    assert resp.json["status"] == "queued"
+    assert broker.queues[tasks.INTERACTIVE_QUEUE].qsize() == 2
+
+
 def test_get_feeds(db_session, client, test_user):
     another_user = database.User(username="another", password_hash="...")
     db_session.add(another_user)
@@ -163,6 +439,37 @@ def test_get_feeds(db_session, client, test_user):
     assert response_urls == {"user-1-feed-1", "user-1-feed-2"}
 
 
+def test_reads_use_the_replica(replica_db, db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    with database.get_read_session() as session:
+        session.add(
+            database.User(id=test_user.id, username="test", password_hash="unused")
+        )
+        session.add(database.Feed(user_id=test_user.id, url="replica"))
+        session.commit()
+
+    url = flask.url_for("get_feeds")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert [feed["url"] for feed in resp.json["feeds"]] == ["replica"]
+
+    # Writes go to the primary, and the user reads their own writes from there
+    resp = client.post(
+        flask.url_for("register_feed"), json=dict(url="primary"), headers=headers
+    )
+    assert resp.status_code == 201
+
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert [feed["url"] for feed in resp.json["feeds"]] == ["primary"]
+
+    # Once the window has passed, reads go to the replica again
+    services._recent_writes.clear()
+    resp = client.get(url, headers=headers)
+    assert [feed["url"] for feed in resp.json["feeds"]] == ["replica"]
+
+
 def test_list_entries_for_a_feed(db_session, client, test_user):
     headers = authenticate(client, test_user)
 
@@ -358,3 +665,865 @@ def test_get_all_entries(db_session, client, test_user):
         assert resp.status_code == 200
         titles = [e["title"] for e in resp.json["entries"]]
         assert titles == expected_titles
+
+
+def test_get_entry_changes(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    entries = []
+    for idx in range(3):
+        entry = database.Entry(
+            title=f"entry {idx}",
+            feed_id=feed.id,
+            published_at=datetime.datetime.now(),
+            original_id=f"e-{idx}",
+            summary="",
+            link="",
+        )
+        entries.append(entry)
+
+    db_session.add_all(entries)
+    db_session.commit()
+
+    # Initial sync, paginated
+    url = flask.url_for("get_entry_changes", limit=2)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert [e["title"] for e in resp.json["entries"]] == ["entry 0", "entry 1"]
+    assert resp.json["has_more"]
+
+    url = flask.url_for("get_entry_changes", cursor=resp.json["cursor"], limit=2)
+    resp = client.get(url, headers=headers)
+    assert [e["title"] for e in resp.json["entries"]] == ["entry 2"]
+    assert not resp.json["has_more"]
+    cursor = resp.json["cursor"]
+
+    # Nothing has changed since the last sync
+    url = flask.url_for("get_entry_changes", cursor=cursor)
+    resp = client.get(url, headers=headers)
+    assert resp.json["entries"] == []
+    assert resp.json["removed"] == []
+    assert resp.json["cursor"] == cursor
+
+    # A status change shows up as a new change
+    url = flask.url_for("change_entry_status", entry_id=entries[0].id)
+    resp = client.put(url, json={"status": "read"}, headers=headers)
+    assert resp.status_code == 200
+
+    url = flask.url_for("get_entry_changes", cursor=cursor)
+    resp = client.get(url, headers=headers)
+    changes = resp.json["entries"]
+    assert [(e["title"], e["status"]) for e in changes] == [("entry 0", "read")]
+    assert resp.json["cursor"] != cursor
+    cursor = resp.json["cursor"]
+
+    # Removed entries and feeds are reported as well
+    maintenance._remove_entries_in_batches(
+        feed.id,
+        sa.select(database.Entry.id).where(database.Entry.id == entries[1].id),
+        10,
+    )
+    url = flask.url_for("unregister_feed", feed_id=feed.id)
+    resp = client.delete(url, headers=headers)
+    assert resp.status_code == 200
+
+    url = flask.url_for("get_entry_changes", cursor=cursor)
+    resp = client.get(url, headers=headers)
+    assert resp.json["entries"] == []
+    assert resp.json["removed"] == [
+        dict(entry_id=entries[1].id, feed_id=feed.id),
+        dict(entry_id=None, feed_id=feed.id),
+    ]
+
+    url = flask.url_for("get_entry_changes", cursor="bla")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def test_entry_changes_wait_for_running_transactions(db_session, test_user):
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    entries = [
+        database.Entry(
+            title=f"entry {idx}",
+            feed_id=feed.id,
+            published_at=datetime.datetime.now(),
+            original_id=f"e-{idx}",
+            summary="",
+            link=f"http://entry/{idx}",
+        )
+        for idx in range(2)
+    ]
+    db_session.add_all(entries)
+    db_session.commit()
+
+    user = services.get_current_user(test_user.id)
+    cursor = services.get_entry_changes(user).cursor
+
+    # A slow transaction starts writing first, but doesn't commit yet
+    with database.get_session() as session:
+        session.execute(
+            sa.update(database.Entry)
+            .where(database.Entry.id == entries[0].id)
+            .values(status=database.Entry.READ, change_txid=database.current_txid())
+        )
+
+        # A second change doesn't wait for it...
+        services.change_entry_status(user, entries[1].id, database.Entry.READ)
+
+        # ...but it isn't returned yet, so the cursor can't move past the first
+        changes = services.get_entry_changes(user, cursor=cursor)
+        assert changes.entries == []
+        assert changes.cursor == cursor
+
+        session.commit()
+
+    changes = services.get_entry_changes(user, cursor=cursor)
+    assert [e.title for e in changes.entries] == ["entry 0", "entry 1"]
+
+
+def test_list_endpoints_support_conditional_get(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    entry = database.Entry(
+        title="entry",
+        feed_id=feed.id,
+        published_at=datetime.datetime.now(),
+        original_id="e-1",
+        summary="",
+        link="",
+    )
+    db_session.add(entry)
+    db_session.commit()
+
+    urls = [
+        flask.url_for("get_feeds"),
+        flask.url_for("get_entries"),
+        flask.url_for("get_feed_entries", feed_id=feed.id),
+    ]
+
+    etags = {}
+    for url in urls:
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        etags[url] = resp.headers["ETag"]
+
+        resp = client.get(url, headers={**headers, "If-None-Match": etags[url]})
+        assert resp.status_code == 304
+        assert resp.data == b""
+
+    # Changing the status of an entry invalidates the entry lists
+    url = flask.url_for("change_entry_status", entry_id=entry.id)
+    resp = client.put(url, json={"status": "read"}, headers=headers)
+    assert resp.status_code == 200
+
+    for url in urls[1:]:
+        resp = client.get(url, headers={**headers, "If-None-Match": etags[url]})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etags[url]
+
+    # Registering a new feed invalidates the feed list
+    url = flask.url_for("register_feed")
+    resp = client.post(url, json=dict(url="another-feed"), headers=headers)
+    assert resp.status_code == 201
+
+    url = urls[0]
+    resp = client.get(url, headers={**headers, "If-None-Match": etags[url]})
+    assert resp.status_code == 200
+    assert len(resp.json["feeds"]) == 2
+
+    # Invalid requests are rejected before the ETag is checked
+    for url in (
+        flask.url_for("get_entries", status="bogus"),
+        flask.url_for("get_feed_entries", feed_id=feed.id, status="bogus"),
+    ):
+        resp = client.get(url, headers={**headers, "If-None-Match": "*"})
+        assert resp.status_code == 400
+
+
+def test_retention_changes_and_purges_change_the_etag(
+    monkeypatch, db_session, client, test_user
+):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    now = datetime.datetime.now()
+    for idx in range(3):
+        entry = database.Entry(
+            title="entry",
+            feed_id=feed.id,
+            published_at=now - datetime.timedelta(days=idx * 10),
+            original_id=f"e-{idx}",
+            summary="",
+            link=f"http://feed/{idx}",
+            status=database.Entry.READ,
+        )
+        db_session.add(entry)
+    db_session.commit()
+
+    feeds_url = flask.url_for("get_feeds")
+    entries_url = flask.url_for("get_entries")
+    feeds_etag = client.get(feeds_url, headers=headers).headers["ETag"]
+    entries_etag = client.get(entries_url, headers=headers).headers["ETag"]
+
+    # The retention policy is part of the feed list
+    url = flask.url_for("set_feed_retention", feed_id=feed.id)
+    body = dict(max_age_days=5, max_entries=0, keep_unread=False)
+    resp = client.put(url, json=body, headers=headers)
+    assert resp.status_code == 200
+
+    resp = client.get(feeds_url, headers={**headers, "If-None-Match": feeds_etag})
+    assert resp.status_code == 200
+    assert resp.json["feeds"][0]["retention_max_age_days"] == 5
+
+    # Purged entries disappear from the entry list
+    entries_etag = client.get(entries_url, headers=headers).headers["ETag"]
+    assert maintenance.purge_entries() == 2
+
+    resp = client.get(entries_url, headers={**headers, "If-None-Match": entries_etag})
+    assert resp.status_code == 200
+    assert len(resp.json["entries"]) == 1
+
+
+def test_new_entry_events(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    url = flask.url_for("get_events")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+
+    stream = iter(resp.response)
+    assert next(stream) == b": connected\n\n"
+    assert notifications.listener.wait_until_ready(timeout=5)
+
+    entries = [
+        FeedEntry(
+            id="entry-1",
+            title="",
+            description="",
+            link="http://feed/1",
+            published_parsed=datetime.datetime(2021, 11, 24, 10, 0, 0).timetuple(),
+        )
+    ]
+    FeedWorker(feed, lambda url: entries).start()
+
+    event = next(stream).decode("utf-8")
+    assert event.startswith("event: new-entries\n")
+    data = json.loads(event.split("data: ")[1])
+    assert data == dict(feed_id=feed.id, count=1)
+
+    resp.close()
+
+
+def test_event_streams_are_limited(monkeypatch, db_session, client, test_user):
+    monkeypatch.setattr(settings, "SSE_MAX_CONNECTIONS", 1)
+    headers = authenticate(client, test_user)
+    url = flask.url_for("get_events")
+
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+
+    rejected = client.get(url, headers=headers)
+    assert rejected.status_code == 503
+    assert "Retry-After" in rejected.headers
+
+    # Closing the stream frees its slot, even if it was never read
+    resp.close()
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    resp.close()
+
+
+def test_export_entries(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    start_dt = datetime.datetime.now() - datetime.timedelta(days=1)
+    for idx in range(250):
+        entry = database.Entry(
+            title=f"entry {idx}",
+            feed_id=feed.id,
+            published_at=start_dt + datetime.timedelta(minutes=idx),
+            original_id=f"e-{idx}",
+            summary="",
+            link="",
+        )
+        db_session.add(entry)
+
+    db_session.commit()
+
+    resp = client.get(flask.url_for("get_entries"), headers=headers)
+    expected_entries = resp.json["entries"]
+    assert len(expected_entries) == 250
+
+    # Exports contain the full summary as well
+    for entry in expected_entries:
+        entry["summary"] = ""
+
+    url = flask.url_for("export_entries")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert json.loads(resp.data) == dict(entries=expected_entries)
+
+    url = flask.url_for("export_entries", format="ndjson")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    lines = resp.data.decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == expected_entries
+
+    url = flask.url_for("export_entries", format="xml")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def test_entries_with_sparse_fieldsets(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    entry = database.Entry(
+        title="entry",
+        feed_id=feed.id,
+        published_at=datetime.datetime.now(),
+        original_id="e-1",
+        summary="<p>A very long summary</p>",
+        link="",
+    )
+    db_session.add(entry)
+    db_session.commit()
+
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(database.engine, "before_cursor_execute", record_statement)
+    try:
+        url = flask.url_for("get_entries", fields="id,title")
+        resp = client.get(url, headers=headers)
+    finally:
+        sa.event.remove(database.engine, "before_cursor_execute", record_statement)
+
+    assert resp.status_code == 200
+    assert resp.json["entries"] == [dict(id=entry.id, title="entry")]
+    assert not any("article.summary" in statement for statement in statements)
+
+    url = flask.url_for("get_feed_entries", feed_id=feed.id, fields="title")
+    resp = client.get(url, headers=headers)
+    assert resp.json["entries"] == [dict(title="entry")]
+
+    url = flask.url_for("export_entries", format="ndjson", fields="id")
+    resp = client.get(url, headers=headers)
+    assert json.loads(resp.data) == dict(id=entry.id)
+
+    url = flask.url_for("get_entries", fields="title,password_hash")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def test_entry_lists_return_excerpts(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    entry = database.Entry(
+        title="entry",
+        feed_id=feed.id,
+        published_at=datetime.datetime.now(),
+        original_id="e-1",
+        summary="<p>The full summary</p>",
+        excerpt="The full summary",
+        link="",
+    )
+    db_session.add(entry)
+    db_session.commit()
+
+    resp = client.get(flask.url_for("get_entries"), headers=headers)
+    assert resp.status_code == 200
+    [listed_entry] = resp.json["entries"]
+    assert listed_entry["excerpt"] == "The full summary"
+    assert "summary" not in listed_entry
+
+    resp = client.get(flask.url_for("get_entry", entry_id=entry.id), headers=headers)
+    assert resp.status_code == 200
+    assert resp.json["summary"] == "<p>The full summary</p>"
+    assert resp.json["excerpt"] == "The full summary"
+
+    resp = client.get(flask.url_for("get_entry", entry_id=entry.id + 1), headers=headers)
+    assert resp.status_code == 404
+
+
+def test_search_entries(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed1 = database.Feed(user_id=test_user.id, url="feed-1")
+    feed2 = database.Feed(user_id=test_user.id, url="feed-2")
+    db_session.add_all([feed1, feed2])
+    db_session.commit()
+
+    published = datetime.datetime(2021, 11, 24, 10, 0, 0).timetuple()
+    feed1_entries = [
+        FeedEntry("e-1", "Python release", "<p>Nothing else</p>", "", published),
+        FeedEntry("e-2", "Weekly news", "<p>A new python release</p>", "", published),
+        FeedEntry("e-3", "Gardening", "<p>Roses and tulips</p>", "", published),
+    ]
+    feed2_entries = [
+        FeedEntry("e-4", "Snakes", "<p>Pythons of the world</p>", "", published),
+    ]
+    FeedWorker(feed1, lambda url: feed1_entries).start()
+    FeedWorker(feed2, lambda url: feed2_entries).start()
+
+    # Matches in the title rank higher
+    url = flask.url_for("search_entries", q="python")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    titles = [e["title"] for e in resp.json["entries"]]
+    assert titles[0] == "Python release"
+    assert set(titles) == {"Python release", "Weekly news", "Snakes"}
+    assert resp.json["next_cursor"] is None
+
+    # Paginate through the results
+    titles = []
+    cursor = None
+    while True:
+        url = flask.url_for("search_entries", q="python", limit=1, cursor=cursor)
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        titles += [e["title"] for e in resp.json["entries"]]
+        cursor = resp.json["next_cursor"]
+        if not cursor:
+            break
+
+    assert titles[0] == "Python release"
+    assert len(titles) == 3
+    assert set(titles) == {"Python release", "Weekly news", "Snakes"}
+
+    # Filter by feed
+    url = flask.url_for("search_entries", q="python", feed_id=feed2.id)
+    resp = client.get(url, headers=headers)
+    assert [e["title"] for e in resp.json["entries"]] == ["Snakes"]
+
+    url = flask.url_for("search_entries", q="python", cursor="invalid")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+    url = flask.url_for("search_entries")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def test_filter_entries_by_time_range(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    start_dt = datetime.datetime(2021, 11, 24, 10, 0, 0)
+    for idx in range(5):
+        entry = database.Entry(
+            title=f"entry {idx}",
+            feed_id=feed.id,
+            published_at=start_dt + datetime.timedelta(days=idx),
+            original_id=f"e-{idx}",
+            summary="",
+            link="",
+        )
+        db_session.add(entry)
+
+    db_session.commit()
+
+    test_table = [
+        (dict(since="2021-11-26T10:00:00"), ["entry 4", "entry 3", "entry 2"]),
+        (dict(until="2021-11-26T10:00:00"), ["entry 1", "entry 0"]),
+        (dict(since="2021-11-25", until="2021-11-27"), ["entry 2", "entry 1"]),
+    ]
+
+    for args, expected_titles in test_table:
+        for endpoint, extra_args in [
+            ("get_entries", {}),
+            ("get_feed_entries", dict(feed_id=feed.id)),
+        ]:
+            url = flask.url_for(endpoint, **args, **extra_args)
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 200
+            titles = [e["title"] for e in resp.json["entries"]]
+            assert titles == expected_titles
+
+    url = flask.url_for("get_entries", since="yesterday")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def record_time_range_statements():
+    """
+    Record the statements which filter entries by their publish date, until the
+    returned function is called.
+    """
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, *args):
+        if "entry.published_at >=" in statement:
+            statements.append((statement, parameters))
+
+    def stop():
+        sa.event.remove(database.engine, "before_cursor_execute", record_statement)
+        return statements
+
+    sa.event.listen(database.engine, "before_cursor_execute", record_statement)
+    return stop
+
+
+def explain(statement, parameters):
+    # The test table is tiny, so a sequential scan is always cheaper. Disable it
+    # to see which index the planner would choose on a large table.
+    with database.engine.connect() as connection:
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        plan = connection.exec_driver_sql("EXPLAIN " + statement, parameters)
+        return "\n".join(row[0] for row in plan)
+
+
+def test_time_range_query_uses_index(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    stop_recording = record_time_range_statements()
+    try:
+        url = flask.url_for("get_feed_entries", feed_id=feed.id, since="2021-11-24")
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+    finally:
+        statements = stop_recording()
+
+    [(statement, parameters)] = statements
+    assert "entry_feed_published_at_idx" in explain(statement, parameters)
+
+
+def test_cross_feed_time_range_query_uses_index(db_session, test_user):
+    feeds = [database.Feed(user_id=test_user.id, url=f"feed-{i}") for i in range(3)]
+    db_session.add_all(feeds)
+    db_session.commit()
+
+    user = services.get_current_user(test_user.id)
+    stop_recording = record_time_range_statements()
+    try:
+        services.get_entries(
+            user,
+            since=datetime.datetime(2021, 11, 24),
+            until=datetime.datetime(2021, 11, 25),
+        )
+    finally:
+        statements = stop_recording()
+
+    [(statement, parameters)] = statements
+    plan = explain(statement, parameters)
+    # Each feed of the user is looked up in the index with the time range,
+    # instead of reading all entries of the feeds
+    assert "entry_feed_published_at_idx" in plan
+    assert "published_at >=" in plan.split("entry_feed_published_at_idx", 1)[1]
+
+
+def test_get_river(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed1 = database.Feed(user_id=test_user.id, url="feed-1")
+    feed2 = database.Feed(user_id=test_user.id, url="feed-2")
+    empty_feed = database.Feed(user_id=test_user.id, url="empty")
+    db_session.add_all([feed1, feed2, empty_feed])
+    db_session.flush()
+
+    start_dt = datetime.datetime.now() - datetime.timedelta(days=1)
+    for feed in [feed1, feed2]:
+        for idx in range(4):
+            entry = database.Entry(
+                title=f"{feed.url} entry {idx}",
+                feed_id=feed.id,
+                published_at=start_dt + datetime.timedelta(hours=idx),
+                original_id=f"e-{idx}",
+                summary="",
+                link="",
+            )
+            db_session.add(entry)
+
+    db_session.commit()
+
+    url = flask.url_for("get_river", per_feed=2)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+
+    river = {
+        feed["url"]: [e["title"] for e in feed["entries"]] for feed in resp.json["feeds"]
+    }
+    assert river == {
+        "feed-1": ["feed-1 entry 3", "feed-1 entry 2"],
+        "feed-2": ["feed-2 entry 3", "feed-2 entry 2"],
+        "empty": [],
+    }
+
+
+def test_get_metrics(db_session, client, test_user):
+    admin = database.User(
+        username="admin", password_hash=helpers.hash_password("admin"), is_admin=True
+    )
+    db_session.add(admin)
+    db_session.commit()
+
+    url = flask.url_for("get_metrics")
+    resp = client.get(url, headers=authenticate(client, test_user))
+    assert resp.status_code == 401
+
+    resp = client.get(url, headers=authenticate(client, admin, "admin"))
+    assert resp.status_code == 200
+
+    checkout = resp.json["timers"]["db.pool.checkout"]
+    assert checkout["count"] > 0
+    assert checkout["max"] >= 0
+    assert resp.json["pools"]["primary"]["size"] == settings.DATABASE_POOL_SIZE
+    # The scheduler hasn't run yet
+    assert resp.json["scheduler"]["lag_seconds"] is None
+
+    status = database.SchedulerStatus(
+        id=1, lag_seconds=42, updated_at=datetime.datetime(2021, 12, 1)
+    )
+    db_session.add(status)
+    db_session.commit()
+
+    resp = client.get(url, headers=authenticate(client, admin, "admin"))
+    assert resp.json["scheduler"] == dict(
+        lag_seconds=42, updated_at="2021-12-01T00:00:00"
+    )
+
+
+def test_get_feed_health(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    url = flask.url_for("get_feed_health", feed_id=1)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 404
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.flush()
+
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+    db_session.add(
+        database.FeedDailyStats(
+            feed_id=feed.id,
+            day=yesterday,
+            n_success=10,
+            n_failure=1,
+            n_downloaded=5,
+            n_ignored=20,
+        )
+    )
+    for status in (database.FeedUpdateRun.FAILED, database.FeedUpdateRun.SUCCESS):
+        db_session.add(
+            database.FeedUpdateRun(
+                feed_id=feed.id,
+                timestamp=datetime.datetime.combine(yesterday, datetime.time(12)),
+                status=status,
+                n_downloaded=1,
+            )
+        )
+    db_session.add(
+        database.FeedUpdateRun(
+            feed_id=feed.id,
+            timestamp=datetime.datetime.now(),
+            status=database.FeedUpdateRun.SUCCESS,
+            n_downloaded=3,
+        )
+    )
+    db_session.commit()
+
+    url = flask.url_for("get_feed_health", feed_id=feed.id)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json["feed_id"] == feed.id
+    assert resp.json["last_run"]["n_downloaded"] == 3
+
+    # Rolled-up stats and recent runs of the same day are added up
+    assert resp.json["days"] == [
+        dict(
+            day=today.isoformat(),
+            n_success=1,
+            n_failure=0,
+            n_downloaded=3,
+            n_ignored=0,
+        ),
+        dict(
+            day=yesterday.isoformat(),
+            n_success=11,
+            n_failure=2,
+            n_downloaded=7,
+            n_ignored=20,
+        ),
+    ]
+
+    resp = client.get(
+        flask.url_for("get_feed_health", feed_id=feed.id, days=1), headers=headers
+    )
+    assert [day["day"] for day in resp.json["days"]] == [today.isoformat()]
+
+
+def test_set_feed_retention(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    body = dict(max_age_days=30, max_entries=None, keep_unread=True)
+    url = flask.url_for("set_feed_retention", feed_id=1)
+    resp = client.put(url, json=body, headers=headers)
+    assert resp.status_code == 404
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    url = flask.url_for("set_feed_retention", feed_id=feed.id)
+    resp = client.put(url, json=dict(body, max_entries=-1), headers=headers)
+    assert resp.status_code == 400
+
+    resp = client.put(url, json=body, headers=headers)
+    assert resp.status_code == 200
+
+    resp = client.get(flask.url_for("get_feeds"), headers=headers)
+    [feed_json] = resp.json["feeds"]
+    assert feed_json["retention_max_age_days"] == 30
+    assert feed_json["retention_max_entries"] is None
+    assert feed_json["retention_keep_unread"] is True
+
+
+def test_get_archived_entries(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    url = flask.url_for("get_archived_entries", feed_id=1)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 404
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    published = datetime.datetime(2020, 1, 1)
+    entries = [
+        FeedEntry(
+            id=f"entry-{idx}",
+            title=f"Entry {idx}",
+            description=f"<p>Summary {idx}</p>",
+            link="",
+            published_parsed=(published + datetime.timedelta(days=idx)).timetuple(),
+        )
+        for idx in range(5)
+    ]
+    FeedWorker(feed, lambda url: entries).start()
+    maintenance.archive_entries(older_than_days=1, segment_size=2)
+    assert db_session.query(database.Entry).count() == 0
+
+    url = flask.url_for("get_archived_entries", feed_id=feed.id)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert [e["original_id"] for e in resp.json["entries"]] == [
+        f"entry-{idx}" for idx in reversed(range(5))
+    ]
+
+    entry = resp.json["entries"][0]
+    assert entry["summary"] == "<p>Summary 4</p>"
+    assert entry["excerpt"] == "Summary 4"
+    assert entry["published_at"] == "2020-01-05T00:00:00"
+    assert entry["feed_id"] == feed.id
+
+    url = flask.url_for(
+        "get_archived_entries",
+        feed_id=feed.id,
+        since="2020-01-02",
+        until="2020-01-05",
+        limit=2,
+    )
+    resp = client.get(url, headers=headers)
+    assert [e["original_id"] for e in resp.json["entries"]] == ["entry-3", "entry-2"]
+
+    url = flask.url_for(
+        "get_archived_entries",
+        feed_id=feed.id,
+        since="2020-01-02",
+        until="2020-01-05",
+        limit=2,
+        cursor=resp.json["next_cursor"],
+    )
+    resp = client.get(url, headers=headers)
+    assert [e["original_id"] for e in resp.json["entries"]] == ["entry-1"]
+    assert resp.json["next_cursor"] is None
+
+    url = flask.url_for("get_archived_entries", feed_id=feed.id, cursor="bla")
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 400
+
+
+def test_get_archived_entries_pagination(db_session, client, test_user):
+    headers = authenticate(client, test_user)
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    # Pages end in the middle of entries with the same publish date
+    published = datetime.datetime(2020, 1, 1)
+    entries = [
+        FeedEntry(
+            id=f"entry-{idx}",
+            title=f"Entry {idx}",
+            description=f"<p>Summary {idx}</p>",
+            link="",
+            published_parsed=(published + datetime.timedelta(days=idx // 3)).timetuple(),
+        )
+        for idx in range(7)
+    ]
+    FeedWorker(feed, lambda url: entries).start()
+    maintenance.archive_entries(older_than_days=1, segment_size=3)
+
+    seen = []
+    cursor = None
+    while True:
+        args = dict(limit=2, cursor=cursor) if cursor else dict(limit=2)
+        url = flask.url_for("get_archived_entries", feed_id=feed.id, **args)
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        assert len(resp.json["entries"]) <= 2
+        seen += [e["original_id"] for e in resp.json["entries"]]
+
+        cursor = resp.json["next_cursor"]
+        if not cursor:
+            break
+
+    assert sorted(seen) == [f"entry-{idx}" for idx in range(7)]
+    assert len(seen) == 7
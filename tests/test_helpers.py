@@ -1,3 +1,5 @@
+import time
+
 from feedcloud import helpers
 
 
@@ -6,3 +8,67 @@ def test_password_hash():
     hash = helpers.hash_password(password_str)
     assert helpers.check_password(password_str, hash)
     assert not helpers.check_password("invalid password", hash)
+
+
+def test_password_needs_rehash():
+    hash = helpers.hash_password("some password", rounds=4)
+    assert not helpers.password_needs_rehash(hash, rounds=4)
+    assert helpers.password_needs_rehash(hash, rounds=5)
+
+
+def test_make_excerpt():
+    html = """
+        <p>Hello &amp; <b>wel</b>come!</p>
+        <script>alert('ignored');</script>
+        <ul><li>First</li><li>Second</li></ul>
+    """
+    assert helpers.make_excerpt(html, 100) == "Hello & welcome! First Second"
+
+    html = "<p>" + "word " * 100 + "</p>"
+    excerpt = helpers.make_excerpt(html, 32)
+    assert len(excerpt) <= 32
+    assert excerpt == "word " * 5 + "word…"
+
+
+def test_make_content_hash():
+    link = "https://Example.com/post?id=1&utm_source=rss#comments"
+    assert helpers.normalize_link(link) == "https://example.com/post?id=1"
+
+    content_hash = helpers.make_content_hash(link, "Title", "Summary")
+    assert content_hash == helpers.make_content_hash(
+        "https://example.com/post?id=1", " Title", "Summary "
+    )
+    assert content_hash != helpers.make_content_hash(link, "Title", "Other")
+
+
+def test_compress_text():
+    text = "<p>Ünïcödé text</p>" * 20
+    assert helpers.compress_text(text, 0) == text.encode("utf-8")
+    assert helpers.compress_text("short", 100) == b"short"
+
+    compressed = helpers.compress_text(text, 100)
+    assert len(compressed) < len(text)
+    assert helpers.decompress_text(compressed) == text
+    assert helpers.decompress_text(text.encode("utf-8")) == text
+
+
+def test_ttl_cache():
+    cache = helpers.TTLCache(max_size=2, ttl=60)
+    cache.set(1, "one")
+    cache.set(2, "two")
+    assert cache.get(1) == "one"
+
+    # The least recently used item is evicted
+    cache.set(3, "three")
+    assert cache.get(2) is None
+    assert cache.get(1) == "one"
+    assert cache.get(3) == "three"
+
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert len(cache) == 1
+
+    cache = helpers.TTLCache(max_size=2, ttl=0.01)
+    cache.set(1, "one")
+    time.sleep(0.02)
+    assert cache.get(1) is None
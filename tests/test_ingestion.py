@@ -1,15 +1,18 @@
 import datetime
+import json
+import logging
 import pathlib
 import time
 from typing import Iterable
 
+import dramatiq
 import pytest
 
 import feedcloud.ingest.worker
-from feedcloud import settings
+from feedcloud import database, metrics, settings
 from feedcloud.api import services
 from feedcloud.database import Entry, Feed, FeedUpdateRun
-from feedcloud.ingest import parser
+from feedcloud.ingest import parser, tasks
 from feedcloud.ingest.scheduler import Scheduler
 from feedcloud.ingest.types import FeedEntry
 from feedcloud.ingest.worker import FeedWorker
@@ -58,6 +61,60 @@ def test_worker_saves_entries(db_session, test_user):
     assert runs[0].status == FeedUpdateRun.SUCCESS
 
 
+def test_worker_uses_the_given_session(db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.commit()
+
+    pool = database.engine.pool
+    checked_out = []
+
+    def downloader(url):
+        checked_out.append(pool.checkedout())
+        return []
+
+    # Make the session hold a connection, like the task does after loading
+    # the feed
+    feed = db_session.query(Feed).filter(Feed.id == feed.id).one()
+    assert pool.checkedout() == 1
+
+    worker = FeedWorker(feed, downloader, session=db_session)
+    worker.start()
+
+    # No connection is held while downloading, and no other session is opened
+    assert checked_out == [0]
+    assert db_session.query(FeedUpdateRun).count() == 1
+    assert pool.checkedout() == 1
+
+
+def test_worker_shares_articles_between_feeds(db_session, test_user):
+    feeds = [Feed(url=f"feed-{idx}", user_id=test_user.id) for idx in range(2)]
+    db_session.add_all(feeds)
+    db_session.commit()
+
+    published = make_time_tuple(datetime.datetime(2021, 11, 24, 10, 0, 0))
+    entries = [
+        FeedEntry(
+            id=f"entry-{idx}",
+            title=f"Title {idx}",
+            description="<p>Summary</p>",
+            link=f"http://feed/{idx}?utm_medium=feed",
+            published_parsed=published,
+        )
+        for idx in range(3)
+    ]
+
+    for feed in feeds:
+        FeedWorker(feed, FakeDownloader(entries)).start()
+
+    assert db_session.query(Entry).count() == 6
+    assert db_session.query(database.Article).count() == 3
+
+    entry = db_session.query(Entry).filter(Entry.feed_id == feeds[1].id).first()
+    assert entry.title.startswith("Title")
+    assert entry.excerpt == "Summary"
+
+
 def test_worker_avoids_duplicates(db_session, test_user):
     feed = Feed(url="bla", user_id=test_user.id)
     db_session.add(feed)
@@ -92,6 +149,35 @@ def test_worker_avoids_duplicates(db_session, test_user):
     assert len(db_entries) == 1
 
 
+def test_worker_ignores_entries_saved_concurrently(monkeypatch, db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.commit()
+
+    entries = [
+        FeedEntry(
+            id=f"entry-{idx}",
+            title="",
+            description="",
+            link=f"http://feed/{idx}",
+            published_parsed=make_time_tuple(datetime.datetime(2021, 11, 24, 10, 0, 0)),
+        )
+        for idx in range(2)
+    ]
+    FeedWorker(feed, FakeDownloader(entries[:1])).start()
+
+    # Another worker saved the first entry after the existence check
+    monkeypatch.setattr(FeedWorker, "does_entry_exist", lambda *args: False)
+    FeedWorker(feed, FakeDownloader(entries)).start()
+
+    assert db_session.query(Entry).count() == 2
+    last_run = (
+        db_session.query(FeedUpdateRun).order_by(FeedUpdateRun.timestamp.desc()).first()
+    )
+    assert last_run.status == FeedUpdateRun.SUCCESS
+    assert (last_run.n_downloaded, last_run.n_ignored) == (1, 1)
+
+
 def get_test_xml_file_path() -> str:
     xml_file = pathlib.Path(__file__).parent / "rss_feed.xml"
     file_path = str(xml_file.absolute())
@@ -141,13 +227,39 @@ def test_worker_saves_failed_feed_runs(db_session, test_user):
     assert notification_feed_id == feed.id
 
 
+def test_metrics_are_logged(caplog, db_session):
+    with caplog.at_level(logging.INFO, logger="feedcloud.Metrics"):
+        metrics.log_snapshot(extra=lambda: dict(pools=database.get_pool_status()))
+
+    message = caplog.records[-1].getMessage()
+    values = json.loads(message.split("Metrics: ", 1)[1])
+    assert values["timers"]["db.pool.checkout"]["count"] > 0
+    assert values["pools"]["primary"]["size"] == settings.DATABASE_POOL_SIZE
+
+
 def test_scheduler_picks_correct_feeds(db_session, test_user):
     not_run_feed = Feed(url="not_run", user_id=test_user.id)
     successful_feed = Feed(url="successful", user_id=test_user.id)
     once_failed_feed = Feed(url="once_failed", user_id=test_user.id)
     totally_failed_feed = Feed(url="totally_failed", user_id=test_user.id)
+    # Imported feeds wait for their first fetch time
+    imported_feed = Feed(
+        url="imported",
+        user_id=test_user.id,
+        first_fetch_at=datetime.datetime.now() + datetime.timedelta(hours=1),
+    )
+    deleted_feed = Feed(
+        url="deleted", user_id=test_user.id, deleted_at=datetime.datetime.now()
+    )
     db_session.add_all(
-        [not_run_feed, successful_feed, once_failed_feed, totally_failed_feed]
+        [
+            not_run_feed,
+            successful_feed,
+            once_failed_feed,
+            totally_failed_feed,
+            imported_feed,
+            deleted_feed,
+        ]
     )
     db_session.flush()
 
@@ -202,6 +314,59 @@ def test_scheduler_picks_correct_feeds(db_session, test_user):
     }
 
 
+def test_scheduler_limits_backlog(monkeypatch, db_session, test_user, broker):
+    monkeypatch.setattr(settings, "TASK_SCHEDULER_MIN_BACKLOG", 3)
+
+    now = datetime.datetime.now()
+    feeds = [Feed(url=f"http://feed/{i}", user_id=test_user.id) for i in range(5)]
+    db_session.add_all(feeds)
+    db_session.commit()
+
+    # The feeds have been due for 1 to 5 hours, the last feed the longest
+    for i, feed in enumerate(feeds):
+        db_session.add(
+            FeedUpdateRun(
+                feed_id=feed.id,
+                timestamp=now - datetime.timedelta(hours=i + 1),
+                status=FeedUpdateRun.SUCCESS,
+            )
+        )
+    db_session.commit()
+
+    def take_enqueued_feed_ids():
+        queue = broker.queues[tasks.SCHEDULED_QUEUE]
+        feed_ids = []
+        while not queue.empty():
+            feed_ids.append(dramatiq.Message.decode(queue.get_nowait()).args[0])
+            queue.task_done()
+        return feed_ids
+
+    scheduler = Scheduler()
+    scheduler.run_once()
+    assert tasks.get_queue_size(tasks.SCHEDULED_QUEUE) == 3
+
+    # The queue is full, so nothing is added
+    scheduler.run_once()
+    assert tasks.get_queue_size(tasks.SCHEDULED_QUEUE) == 3
+
+    # Most overdue first
+    assert take_enqueued_feed_ids() == [feeds[4].id, feeds[3].id, feeds[2].id]
+    assert scheduler.get_lag() >= 2 * 3600
+
+    # The lag of the last run is stored for the API
+    status = db_session.get(database.SchedulerStatus, 1)
+    assert status.lag_seconds >= 2 * 3600
+
+    # The rest is carried over, and the enqueued feeds are not enqueued again
+    # before they have run
+    scheduler.run_once()
+    assert take_enqueued_feed_ids() == [feeds[1].id, feeds[0].id]
+
+    assert scheduler.find_feeds() == []
+    assert scheduler.get_lag() == 0
+    assert metrics.snapshot()["timers"]["scheduler.lag"]["max"] >= 5 * 3600
+
+
 def test_simulate_backoff_mechanism(
     monkeypatch, db_session, client, test_user, broker, stub_worker
 ):
@@ -250,8 +415,8 @@ def test_simulate_backoff_mechanism(
     db_session.add(feed)
     db_session.commit()
 
-    services.force_run_feed(test_user.username, feed.id)
-    broker.join("default")
+    services.force_run_feed(services.get_current_user(test_user.id), feed.id)
+    broker.join(tasks.INTERACTIVE_QUEUE)
     stub_worker.join()
     assert db_session.query(FeedUpdateRun).count() == max_runs + 1
 
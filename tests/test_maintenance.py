@@ -0,0 +1,466 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+
+from feedcloud import database, maintenance, settings
+from feedcloud.database import Article, Entry, Feed, FeedDailyStats, FeedUpdateRun
+from feedcloud.ingest.types import FeedEntry
+from feedcloud.ingest.worker import FeedWorker
+
+
+def test_backfill_excerpts(db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.flush()
+
+    for idx in range(5):
+        entry = Entry(
+            feed_id=feed.id,
+            original_id=f"e-{idx}",
+            title="",
+            summary=f"<p>Summary <i>{idx}</i></p>",
+            link="",
+            published_at=datetime.datetime.now(),
+        )
+        db_session.add(entry)
+
+    db_session.commit()
+
+    assert maintenance.backfill_excerpts(batch_size=2) == 5
+
+    excerpts = [e.excerpt for e in db_session.query(Entry).order_by(Entry.id)]
+    assert excerpts == [f"Summary {idx}" for idx in range(5)]
+
+    # Nothing is left to do
+    assert maintenance.backfill_excerpts(batch_size=2) == 0
+
+
+def test_backfill_search_vectors(db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.flush()
+
+    for idx in range(3):
+        entry = Entry(
+            feed_id=feed.id,
+            original_id=f"e-{idx}",
+            title=f"Title {idx}",
+            summary="<p>Some <b>searchable</b> text</p>",
+            link="",
+            published_at=datetime.datetime.now(),
+        )
+        db_session.add(entry)
+
+    db_session.commit()
+
+    assert maintenance.backfill_search_vectors(batch_size=2) == 3
+    assert maintenance.backfill_search_vectors(batch_size=2) == 0
+
+    query = database.make_search_query("searchable")
+    matches = db_session.query(Article).filter(Article.search_vector.op("@@")(query))
+    assert matches.count() == 3
+
+
+def make_run(feed, timestamp, status=FeedUpdateRun.SUCCESS, n_downloaded=0):
+    return FeedUpdateRun(
+        feed_id=feed.id,
+        timestamp=timestamp,
+        status=status,
+        n_downloaded=n_downloaded,
+    )
+
+
+def test_rollup_feed_update_runs(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    idle_feed = Feed(url="idle", user_id=test_user.id)
+    db_session.add_all([feed, idle_feed])
+    db_session.flush()
+
+    old_day = datetime.datetime.now() - datetime.timedelta(days=30)
+    for hour in range(5):
+        db_session.add(make_run(feed, old_day.replace(hour=hour), n_downloaded=2))
+    db_session.add(make_run(feed, old_day.replace(hour=6), FeedUpdateRun.FAILED))
+    db_session.add(make_run(feed, datetime.datetime.now()))
+
+    # The last run of a feed is kept, no matter how old it is
+    db_session.add(make_run(idle_feed, old_day))
+    db_session.commit()
+
+    assert maintenance.rollup_feed_update_runs(batch_size=2) == 6
+
+    [stats] = db_session.query(FeedDailyStats).all()
+    assert stats.feed_id == feed.id
+    assert stats.day == old_day.date()
+    assert (stats.n_success, stats.n_failure) == (5, 1)
+    assert stats.n_downloaded == 10
+
+    runs = db_session.query(FeedUpdateRun).all()
+    assert {run.feed_id for run in runs} == {feed.id, idle_feed.id}
+    assert len(runs) == 2
+
+    # Nothing is left to do
+    assert maintenance.rollup_feed_update_runs(batch_size=2) == 0
+
+
+def test_purge_entries(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+    monkeypatch.setattr(settings, "ENTRY_RETENTION_MAX_ENTRIES", 4)
+
+    # Uses the default policy: the newest 4 entries and unread ones are kept
+    default_feed = Feed(url="default", user_id=test_user.id)
+    # Only keeps entries of the last 10 days, read or not
+    recent_feed = Feed(
+        url="recent",
+        user_id=test_user.id,
+        retention_max_age_days=10,
+        retention_max_entries=0,
+        retention_keep_unread=False,
+    )
+    db_session.add_all([default_feed, recent_feed])
+    db_session.flush()
+
+    now = datetime.datetime.now()
+    for feed in (default_feed, recent_feed):
+        for idx in range(8):
+            entry = Entry(
+                feed_id=feed.id,
+                original_id=f"e-{idx}",
+                title="",
+                summary="",
+                link=f"http://{feed.url}/{idx}",
+                published_at=now - datetime.timedelta(days=idx * 3),
+                status=Entry.UNREAD if idx == 6 else Entry.READ,
+            )
+            db_session.add(entry)
+
+    db_session.commit()
+
+    assert maintenance.purge_entries(batch_size=2) == 3 + 4
+
+    def get_remaining(feed):
+        entries = db_session.query(Entry).filter(Entry.feed_id == feed.id)
+        return sorted(entry.original_id for entry in entries)
+
+    assert get_remaining(default_feed) == ["e-0", "e-1", "e-2", "e-3", "e-6"]
+    assert get_remaining(recent_feed) == ["e-0", "e-1", "e-2", "e-3"]
+
+    assert maintenance.purge_entries(batch_size=2) == 0
+
+
+def test_purged_entries_are_not_saved_again(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(
+        url="bla",
+        user_id=test_user.id,
+        retention_max_entries=2,
+        retention_keep_unread=False,
+    )
+    db_session.add(feed)
+    db_session.commit()
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    entries = [
+        FeedEntry(
+            id=f"e-{idx}",
+            title="",
+            description="",
+            link=f"http://feed/{idx}",
+            published_parsed=(now - datetime.timedelta(days=idx)).timetuple(),
+        )
+        for idx in range(4)
+    ]
+    FeedWorker(feed, lambda url: entries[1:]).start()
+    assert maintenance.purge_entries() == 1
+
+    # The publisher still lists the purged entry, and a new one
+    FeedWorker(feed, lambda url: entries).start()
+
+    remaining = db_session.query(Entry.original_id).filter(Entry.feed_id == feed.id)
+    assert sorted(row.original_id for row in remaining) == ["e-0", "e-1", "e-2"]
+
+
+def test_archive_entries(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.flush()
+
+    now = datetime.datetime.now()
+    for idx in range(5):
+        entry = Entry(
+            feed_id=feed.id,
+            original_id=f"e-{idx}",
+            title=f"Title {idx}",
+            summary="",
+            link="",
+            published_at=now - datetime.timedelta(days=100 * idx),
+        )
+        db_session.add(entry)
+
+    db_session.commit()
+
+    # Archiving is disabled by default
+    assert maintenance.archive_entries() == 0
+
+    assert maintenance.archive_entries(older_than_days=150, segment_size=2) == 3
+    assert [e.original_id for e in db_session.query(Entry).order_by(Entry.id)] == [
+        "e-0",
+        "e-1",
+    ]
+
+    segments = (
+        db_session.query(database.EntryArchive)
+        .order_by(database.EntryArchive.first_published_at)
+        .all()
+    )
+    assert [segment.n_entries for segment in segments] == [2, 1]
+
+    assert maintenance.archive_entries(older_than_days=150, segment_size=2) == 0
+
+    # An explicit 0 is not the default, it archives everything published so far
+    monkeypatch.setattr(settings, "ENTRY_ARCHIVE_SEGMENT_SIZE", 1)
+    assert maintenance.archive_entries(older_than_days=0) == 2
+    assert db_session.query(Entry).count() == 0
+    assert db_session.query(database.EntryArchive).count() == 4
+
+
+def test_archived_entries_are_not_saved_again(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.commit()
+
+    # A podcast feed which lists all of its episodes
+    now = datetime.datetime.now().replace(microsecond=0)
+    entries = [
+        FeedEntry(
+            id=f"e-{idx}",
+            title="",
+            description="",
+            link=f"http://feed/{idx}",
+            published_parsed=(now - datetime.timedelta(days=100 * idx)).timetuple(),
+        )
+        for idx in range(4)
+    ]
+    FeedWorker(feed, lambda url: entries).start()
+    assert maintenance.archive_entries(older_than_days=150) == 2
+
+    FeedWorker(feed, lambda url: entries).start()
+    assert db_session.query(Entry).count() == 2
+    assert maintenance.archive_entries(older_than_days=150) == 0
+    assert db_session.query(database.EntryArchive).count() == 1
+
+
+def test_delete_feed(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    other_feed = Feed(url="other", user_id=test_user.id)
+    db_session.add_all([feed, other_feed])
+    db_session.flush()
+
+    now = datetime.datetime.now()
+    for f in (feed, other_feed):
+        for idx in range(5):
+            entry = Entry(
+                feed_id=f.id,
+                original_id=f"e-{idx}",
+                title="",
+                summary="",
+                link=f"http://{f.url}/{idx}",
+                published_at=now,
+            )
+            db_session.add(entry)
+        db_session.add(make_run(f, now))
+    db_session.commit()
+
+    # Feeds which are not marked as deleted are left alone
+    assert not maintenance.delete_feed(feed.id, batch_size=2)
+
+    feed.deleted_at = now
+    db_session.commit()
+
+    assert maintenance.delete_marked_rows(batch_size=2) == 1
+    assert db_session.query(Feed.id).all() == [(other_feed.id,)]
+    assert db_session.query(Entry).count() == 5
+    assert db_session.query(FeedUpdateRun).count() == 1
+
+    assert maintenance.delete_marked_rows(batch_size=2) == 0
+
+
+def test_delete_orphaned_articles(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.flush()
+
+    for idx in range(5):
+        entry = Entry(
+            feed_id=feed.id,
+            original_id=f"e-{idx}",
+            title=f"Title {idx}",
+            summary="",
+            link="",
+            published_at=datetime.datetime.now(),
+        )
+        db_session.add(entry)
+    db_session.commit()
+
+    db_session.query(Entry).filter(Entry.original_id < "e-3").delete()
+    db_session.commit()
+
+    assert maintenance.delete_orphaned_articles(batch_size=2) == 3
+    assert db_session.query(Article).count() == 2
+    assert maintenance.delete_orphaned_articles(batch_size=2) == 0
+
+
+def test_delete_old_entry_removals(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    now = datetime.datetime.now()
+    for days in (1, 29, 31, 40, 50):
+        removal = database.EntryRemoval(
+            entry_id=days,
+            feed_id=1,
+            user_id=test_user.id,
+            removed_at=now - datetime.timedelta(days=days),
+        )
+        db_session.add(removal)
+    db_session.commit()
+
+    assert maintenance.delete_old_entry_removals(batch_size=2) == 3
+    remaining = db_session.query(database.EntryRemoval.entry_id).order_by("entry_id")
+    assert [entry_id for (entry_id,) in remaining] == [1, 29]
+
+
+def test_move_entry_content_to_articles(monkeypatch, db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.commit()
+
+    # The entry table as it was before articles were shared
+    db_session.execute(
+        sa.text(
+            "ALTER TABLE entry DROP COLUMN article_id, "
+            "ADD COLUMN title text NOT NULL, ADD COLUMN summary text NOT NULL, "
+            "ADD COLUMN excerpt text NOT NULL DEFAULT '', "
+            "ADD COLUMN link text NOT NULL, ADD COLUMN search_vector tsvector"
+        )
+    )
+    db_session.execute(sa.text("DROP TABLE article"))
+    for idx in range(5):
+        db_session.execute(
+            sa.text(
+                "INSERT INTO entry (feed_id, original_id, title, summary, link, "
+                "published_at, status) VALUES (:feed_id, :original_id, :title, "
+                "'Summary', 'http://feed/1', now(), 'unread')"
+            ),
+            dict(feed_id=feed.id, original_id=f"e-{idx}", title=f"Title {idx % 2}"),
+        )
+    db_session.commit()
+
+    assert maintenance.move_entry_content_to_articles(batch_size=2) == 5
+    assert db_session.query(Article).count() == 2
+
+    entries = db_session.query(Entry).order_by(Entry.id).all()
+    assert [e.title for e in entries] == ["Title 0", "Title 1"] * 2 + ["Title 0"]
+
+    with pytest.raises(ValueError):
+        maintenance.move_entry_content_to_articles()
+
+
+def test_move_entry_content_to_articles_from_first_schema(db_session, test_user):
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.commit()
+
+    # The entry table of the first release, without excerpts, search documents
+    # and change transactions
+    db_session.execute(sa.text("DROP TABLE entry"))
+    db_session.execute(sa.text("DROP TABLE article"))
+    db_session.execute(
+        sa.text(
+            "CREATE TABLE entry (id serial PRIMARY KEY, original_id text NOT NULL, "
+            "title text NOT NULL, summary text NOT NULL, link text NOT NULL, "
+            "saved_at timestamp NOT NULL DEFAULT now(), "
+            "published_at timestamp NOT NULL, status text NOT NULL, "
+            "feed_id integer NOT NULL REFERENCES feed (id) ON DELETE CASCADE, "
+            "CONSTRAINT original_id_feed_idx UNIQUE (original_id, feed_id))"
+        )
+    )
+    for idx in range(3):
+        db_session.execute(
+            sa.text(
+                "INSERT INTO entry (feed_id, original_id, title, summary, link, "
+                "published_at, status) VALUES (:feed_id, :original_id, :title, "
+                ":summary, :link, now(), 'unread')"
+            ),
+            dict(
+                feed_id=feed.id,
+                original_id=f"e-{idx}",
+                title=f"Title {idx}",
+                summary=f"<p>Summary <i>{idx}</i></p>",
+                link=f"http://feed/{idx}",
+            ),
+        )
+    db_session.commit()
+
+    assert maintenance.move_entry_content_to_articles(batch_size=2) == 3
+
+    entries = db_session.query(Entry).order_by(Entry.id).all()
+    assert [e.excerpt for e in entries] == [f"Summary {idx}" for idx in range(3)]
+    assert all(e.change_txid for e in entries)
+
+    # The computed search documents work
+    n_found = (
+        db_session.query(Article)
+        .filter(Article.search_vector.op("@@")(database.make_search_query("title")))
+        .count()
+    )
+    assert n_found == 3
+
+    indexes = sa.inspect(db_session.connection()).get_indexes("entry")
+    assert "entry_feed_change_txid_idx" in {index["name"] for index in indexes}
+
+
+def test_compress_summaries(monkeypatch, db_session, test_user):
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_PAUSE_SECONDS", 0)
+
+    feed = Feed(url="bla", user_id=test_user.id)
+    db_session.add(feed)
+    db_session.flush()
+
+    for idx in range(3):
+        entry = Entry(
+            feed_id=feed.id,
+            original_id=f"e-{idx}",
+            title=f"Title {idx}",
+            summary="<p>Summary</p>" * 10 * idx,
+            link="",
+            published_at=datetime.datetime.now(),
+        )
+        db_session.add(entry)
+    db_session.commit()
+
+    # Compression is disabled by default
+    assert maintenance.compress_summaries() == 0
+
+    monkeypatch.setattr(settings, "ENTRY_SUMMARY_COMPRESSION_THRESHOLD", 200)
+    assert maintenance.compress_summaries(batch_size=1) == 1
+    assert maintenance.compress_summaries(batch_size=1) == 0
+
+    stored = sa.type_coerce(Article.summary, sa.LargeBinary)
+    sizes = db_session.query(sa.func.length(stored)).order_by(Article.id).all()
+    assert [size for (size,) in sizes][:2] == [0, 140]
+    assert sizes[2][0] < 280
+
+    db_session.expire_all()
+    summaries = [e.summary for e in db_session.query(Entry).order_by(Entry.id)]
+    assert summaries == ["<p>Summary</p>" * 10 * idx for idx in range(3)]
@@ -0,0 +1,212 @@
+import datetime
+import threading
+
+import dramatiq
+import flask
+import pytest
+import sqlalchemy as sa
+
+from feedcloud import database, maintenance, settings
+from feedcloud.ingest import tasks
+from feedcloud.ingest.scheduler import Scheduler
+from feedcloud.ingest.types import FeedEntry
+from feedcloud.ingest.worker import FeedWorker
+
+from .test_api import authenticate
+
+
+def get_partitions():
+    with database.engine.connect() as connection:
+        return set(
+            connection.execute(
+                sa.text(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = 'entry'::regclass"
+                )
+            ).scalars()
+        )
+
+
+def enable_partitioning(monkeypatch, method):
+    monkeypatch.setattr(settings, "ENTRY_PARTITIONING", method)
+    monkeypatch.setattr(settings, "ENTRY_HASH_PARTITIONS", 4)
+
+
+@pytest.fixture
+def hash_partitioning(monkeypatch, clean_db):
+    enable_partitioning(monkeypatch, "hash")
+    database.drop_all()
+    database.create_all()
+    yield
+    database.drop_all()
+
+
+@pytest.fixture
+def range_partitioning(monkeypatch, clean_db):
+    enable_partitioning(monkeypatch, "range")
+    database.drop_all()
+    database.create_all()
+    yield
+    database.drop_all()
+
+
+def make_entries(n):
+    published = datetime.datetime(2021, 11, 24).timetuple()
+    return [
+        FeedEntry(
+            id=f"entry-{i}",
+            title=f"Entry {i}",
+            description="",
+            link=f"http://feed/{i}",
+            published_parsed=published,
+        )
+        for i in range(n)
+    ]
+
+
+def test_hash_partitioning(hash_partitioning, db_session, client, test_user):
+    assert get_partitions() == {"entry_p0", "entry_p1", "entry_p2", "entry_p3"}
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    FeedWorker(feed, lambda url: make_entries(3)).start()
+    # Duplicates are still detected
+    FeedWorker(feed, lambda url: make_entries(3)).start()
+    assert db_session.query(database.Entry).count() == 3
+
+    headers = authenticate(client, test_user)
+    url = flask.url_for("get_feed_entries", feed_id=feed.id)
+    resp = client.get(url, headers=headers)
+    assert resp.status_code == 200
+    assert len(resp.json["entries"]) == 3
+
+    # A feed's entries are read from a single partition
+    query = db_session.query(database.Entry).filter(database.Entry.feed_id == feed.id)
+    statement = query.statement.compile(
+        dialect=database.engine.dialect, compile_kwargs=dict(literal_binds=True)
+    )
+    plan = db_session.execute(sa.text(f"EXPLAIN {statement}")).scalars().all()
+    scanned = {p for p in get_partitions() if any(p in line for line in plan)}
+    assert len(scanned) == 1
+
+
+def test_range_partitioning(range_partitioning, db_session, test_user):
+    month = datetime.date.today().replace(day=1)
+    partitions = get_partitions()
+    assert f"entry_{month:%Y_%m}" in partitions
+    assert "entry_default" in partitions
+    assert len(partitions) == settings.ENTRY_PARTITION_MONTHS_AHEAD + 2
+
+    # Nothing is missing, so nothing new is created
+    assert maintenance.create_entry_partitions() == []
+
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    FeedWorker(feed, lambda url: make_entries(3)).start()
+    FeedWorker(feed, lambda url: make_entries(3)).start()
+    assert db_session.query(database.Entry).count() == 3
+
+
+def test_concurrent_workers_dont_duplicate_entries(
+    range_partitioning, db_session, test_user
+):
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    # Another worker is saving the first entry of the feed
+    with database.get_session() as session:
+        database.lock_feed_entries(session, feed.id)
+        FeedWorker(feed, lambda url: make_entries(1)).save_entries(
+            session, make_entries(1)
+        )
+
+        thread = threading.Thread(
+            target=FeedWorker(feed, lambda url: make_entries(2)).start
+        )
+        thread.start()
+        thread.join(timeout=0.5)
+        assert thread.is_alive()
+
+        session.commit()
+
+    thread.join()
+    original_ids = db_session.query(database.Entry.original_id).all()
+    assert sorted(row.original_id for row in original_ids) == ["entry-0", "entry-1"]
+
+
+def test_missing_range_partition_is_created_later(
+    monkeypatch, range_partitioning, db_session, test_user, broker
+):
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    # An entry saved after the last partition lands in the default partition
+    months_ahead = settings.ENTRY_PARTITION_MONTHS_AHEAD + 1
+    month = database._add_months(datetime.date.today().replace(day=1), months_ahead)
+    FeedWorker(feed, lambda url: make_entries(2)).start()
+    db_session.query(database.Entry).filter(
+        database.Entry.original_id == "entry-0"
+    ).update({database.Entry.saved_at: month + datetime.timedelta(days=3)})
+    db_session.commit()
+
+    def get_partition(original_id):
+        partition = db_session.execute(
+            sa.text(
+                "SELECT tableoid::regclass::text FROM entry WHERE original_id = :id"
+            ),
+            dict(id=original_id),
+        ).scalar()
+        # Don't hold a lock on the entry table while partitions are created
+        db_session.commit()
+        return partition
+
+    assert get_partition("entry-0") == "entry_default"
+
+    # The maintenance tasks create the partitions
+    monkeypatch.setattr(settings, "ENTRY_PARTITION_MONTHS_AHEAD", months_ahead)
+    Scheduler().schedule_maintenance()
+    actors = [
+        dramatiq.Message.decode(message).actor_name
+        for message in list(broker.queues[tasks.BACKFILL_QUEUE].queue)
+    ]
+    assert "create_entry_partitions" in actors
+
+    assert maintenance.create_entry_partitions() == [f"entry_{month:%Y_%m}"]
+    assert get_partition("entry-0") == f"entry_{month:%Y_%m}"
+    assert db_session.query(database.Entry).count() == 2
+
+
+@pytest.mark.parametrize("method", ["hash", "range"])
+def test_partition_existing_entry_table(monkeypatch, db_session, test_user, method):
+    feed = database.Feed(user_id=test_user.id, url="feed")
+    db_session.add(feed)
+    db_session.commit()
+
+    FeedWorker(feed, lambda url: make_entries(5)).start()
+    db_session.commit()
+
+    enable_partitioning(monkeypatch, method)
+    assert maintenance.partition_entry_table() == 5
+    assert get_partitions()
+
+    with pytest.raises(ValueError):
+        maintenance.partition_entry_table()
+
+    entries = db_session.query(database.Entry).order_by(database.Entry.id).all()
+    assert [e.original_id for e in entries] == [f"entry-{i}" for i in range(5)]
+
+    # New entries continue the old IDs
+    FeedWorker(feed, lambda url: make_entries(6)).start()
+    new_entry = (
+        db_session.query(database.Entry)
+        .filter(database.Entry.original_id == "entry-5")
+        .one()
+    )
+    assert new_entry.id > entries[-1].id
@@ -0,0 +1,70 @@
+import datetime
+
+import flask
+
+from feedcloud import database
+from feedcloud.api import schemas
+
+
+def make_entries():
+    return [
+        database.Entry(
+            id=1,
+            feed_id=10,
+            original_id="e-1",
+            title="Some title",
+            summary="<p>Some summary</p>",
+            excerpt="Some summary",
+            link="http://feed/1",
+            published_at=datetime.datetime(2021, 11, 24, 10, 30, 15, 123),
+            status=database.Entry.UNREAD,
+        ),
+        database.Entry(
+            id=2,
+            feed_id=10,
+            original_id="e-2",
+            title="Ünïcödé",
+            summary="",
+            link="",
+            published_at=datetime.datetime(2021, 11, 24),
+            status=None,
+        ),
+    ]
+
+
+def test_fast_entry_list_serializer_matches_marshmallow():
+    entries = make_entries()
+
+    expected = schemas.EntryListSchema().dump(dict(entries=entries))
+    result = schemas.dump_entry_list(entries)
+    assert result == expected
+    assert flask.json.dumps(result) == flask.json.dumps(expected)
+
+
+def test_fast_feed_list_serializer_matches_marshmallow():
+    feeds = [database.Feed(id=1, url="http://feed/1"), database.Feed(id=2, url="")]
+
+    expected = schemas.FeedListSchema().dump(dict(feeds=feeds))
+    assert schemas.dump_feed_list(feeds) == expected
+
+
+def test_fast_entry_change_list_serializer_matches_marshmallow():
+    entries = make_entries()
+
+    removed = [
+        database.EntryRemoval(entry_id=3, feed_id=10),
+        database.EntryRemoval(entry_id=None, feed_id=11),
+    ]
+
+    data = dict(entries=entries, removed=removed, cursor="abc", has_more=False)
+    expected = schemas.EntryChangeListSchema().dump(data)
+    result = schemas.dump_entry_change_list(
+        entries, removed=removed, cursor="abc", has_more=False
+    )
+    assert result == expected
+
+
+def test_fast_entry_detail_serializer_matches_marshmallow():
+    for entry in make_entries():
+        expected = schemas.EntryDetailSchema().dump(entry)
+        assert schemas.dump_entry_detail(entry) == expected